@@ -0,0 +1,184 @@
+''' Deterministic synthetic CIFTI/GIFTI files at HCP scale.
+
+    The meshes are (Fibonacci) spheres with the number of vertices of the
+    HCP meshes, placed as two hemispheres inside the MNI 2mm volume, and
+    the grayordinates follow the HCP layout: both cortices without a
+    medial wall plus subcortical voxels, 91282 of them by default. Data are
+    pseudo-random but seeded, so every run writes the same bytes, and they
+    are generated and written one block at a time. '''
+import os
+
+import nibabel
+import numpy as np
+from scipy.spatial import ConvexHull
+
+from citrix import stream, structures
+from citrix.build import cifti as build_cifti
+from citrix.build import gifti as build_gifti
+from citrix.cifti import BrainModel, MatrixIndicesMap, VertexIndices
+
+MESH_SIZES = {'32k': 32492, '164k': 163842}
+
+# HCP counts of the 91k grayordinates
+CORTEX_VERTICES = {structures.CORTEX_LEFT: 29696,
+                   structures.CORTEX_RIGHT: 29716}
+SUBCORTICAL_VOXELS = 31870
+
+# MNI152 2mm volume
+VOLUME_SHAPE = (91, 109, 91)
+VOLUME_AFFINE = np.array([[-2., 0, 0, 90], [0, 2, 0, -126],
+                          [0, 0, 2, -72], [0, 0, 0, 1]])
+
+HEMISPHERE_CENTERS = {structures.CORTEX_LEFT: (-35., -18., 12.),
+                      structures.CORTEX_RIGHT: (35., -18., 12.)}
+HEMISPHERE_RADII = (30., 65., 45.)
+
+BLOCK_BYTES = 2 ** 26
+
+
+def sphere(n_vertices):
+    ''' Unit sphere triangulated from a Fibonacci lattice of n_vertices
+        points, with triangles facing outwards '''
+    i = np.arange(n_vertices) + .5
+    z = 1 - 2 * i / n_vertices
+    radius = np.sqrt(1 - z ** 2)
+    phi = i * np.pi * (3 - np.sqrt(5))
+    vertices = np.stack([radius * np.cos(phi), radius * np.sin(phi), z],
+                        axis=1)
+
+    triangles = ConvexHull(vertices).simplices
+    a, b, c = (vertices[triangles[:, k]] for k in range(3))
+    inwards = np.einsum('ij,ij->i', np.cross(b - a, c - a), a) < 0
+    triangles[inwards] = triangles[inwards][:, [0, 2, 1]]
+    return vertices, triangles
+
+
+def hemisphere(structure, n_vertices):
+    ''' (vertices, triangles, cifti vertices) of a synthetic hemisphere.
+        The cifti vertices leave out a medial wall facing the other
+        hemisphere, sized as in the HCP meshes '''
+    unit, triangles = sphere(n_vertices)
+    vertices = unit * HEMISPHERE_RADII + HEMISPHERE_CENTERS[structure]
+
+    n_cortex = int(round(CORTEX_VERTICES[structure] * n_vertices /
+                         MESH_SIZES['32k']))
+    medial = unit[:, 0] if structure == structures.CORTEX_LEFT else -unit[:, 0]
+    cortex = np.sort(np.argsort(medial, kind='stable')[:n_cortex])
+    return vertices, triangles, cortex
+
+
+def write_surfaces(directory, n_vertices=MESH_SIZES['32k']):
+    ''' Writes a surface per hemisphere, returns {structure: filename} '''
+    filenames = {}
+    for structure, name in [(structures.CORTEX_LEFT, 'L'),
+                            (structures.CORTEX_RIGHT, 'R')]:
+        vertices, triangles, _ = hemisphere(structure, n_vertices)
+        filename = os.path.join(directory, '{}.{}.surf.gii'.format(name,
+                                                                   n_vertices))
+        build_gifti.mesh(vertices, triangles, structure).save(filename)
+        filenames[structure] = filename
+    return filenames
+
+
+def subcortical_voxels(n_voxels=SUBCORTICAL_VOXELS):
+    ''' Voxels of an ellipsoid between the hemispheres, split in a left and
+        a right structure '''
+    center = nibabel.affines.apply_affine(np.linalg.inv(VOLUME_AFFINE),
+                                          (0., -18., 0.))
+    ijk = np.indices(VOLUME_SHAPE).reshape(3, -1).T
+    distance = np.linalg.norm((ijk - center) / (1., 1.3, 1.), axis=1)
+    voxels = ijk[np.sort(np.argsort(distance, kind='stable')[:n_voxels])]
+
+    left = voxels[:, 0] >= center[0]  # i grows towards the left (x < 0)
+    return {structures.THALAMUS_LEFT: voxels[left],
+            structures.THALAMUS_RIGHT: voxels[~left]}
+
+
+def brain_models_map(n_vertices=MESH_SIZES['32k'],
+                     n_voxels=SUBCORTICAL_VOXELS, dimension=1):
+    ''' BRAIN_MODELS index map with the HCP layout '''
+    index_map = MatrixIndicesMap([dimension], 'CIFTI_INDEX_TYPE_BRAIN_MODELS')
+    offset = 0
+    for structure in [structures.CORTEX_LEFT, structures.CORTEX_RIGHT]:
+        _, _, cortex = hemisphere(structure, n_vertices)
+        index_map.append(BrainModel(offset, len(cortex),
+                                    'CIFTI_MODEL_TYPE_SURFACE', structure,
+                                    n_vertices,
+                                    vertex_indices=VertexIndices(cortex.tolist())))
+        offset += len(cortex)
+
+    if n_voxels > 0:
+        for structure, voxels in subcortical_voxels(n_voxels).items():
+            index_map.append(BrainModel(
+                offset, len(voxels), 'CIFTI_MODEL_TYPE_VOXELS', structure,
+                voxel_indices_ijk=nibabel.cifti2.Cifti2VoxelIndicesIJK(
+                    voxels.tolist())))
+            offset += len(voxels)
+        transform = nibabel.cifti2.Cifti2TransformationMatrixVoxelIndicesIJKtoXYZ(
+            -3, VOLUME_AFFINE)
+        index_map.volume = nibabel.cifti2.Cifti2Volume(VOLUME_SHAPE, transform)
+    return index_map
+
+
+def _random_columns(shape, seed):
+    ''' Seeded pseudo-random (rows, columns) data, in blocks of columns '''
+    n_rows, n_columns = shape
+    step = max(1, BLOCK_BYTES // (4 * n_rows))
+    for start in range(0, n_columns, step):
+        stop = min(start + step, n_columns)
+        rng = np.random.default_rng((seed, start))
+        yield rng.standard_normal((n_rows, stop - start), dtype=np.float32)
+
+
+def _write(filename, rows, columns, intent, blocks):
+    matrix = nibabel.cifti2.Cifti2Matrix()
+    matrix.append(rows)
+    matrix.append(columns)
+    header = nibabel.cifti2.Cifti2Header(matrix)
+    image = nibabel.Cifti2Image(stream.empty(header.matrix.get_data_shape()),
+                                header)
+    image.nifti_header.set_intent(intent)
+    stream.write_blocks(filename, image, blocks, axis=-1)
+
+
+def write_dtseries(filename, n_frames, n_vertices=MESH_SIZES['32k'],
+                   n_voxels=SUBCORTICAL_VOXELS, seed=0):
+    ''' Writes a dtseries of n_frames frames over the HCP grayordinates '''
+    columns = brain_models_map(n_vertices, n_voxels)
+    series = MatrixIndicesMap([0], 'CIFTI_INDEX_TYPE_SERIES',
+                              number_of_series_points=n_frames,
+                              series_exponent=0, series_start=0,
+                              series_step=.72, series_unit='SECOND')
+    n_grayordinates = sum(bm.index_count for bm in columns.brain_models)
+    _write(filename, series, columns,
+           'NIFTI_INTENT_CONNECTIVITY_DENSE_SERIES',
+           _random_columns((n_frames, n_grayordinates), seed))
+
+
+def write_dlabel(filename, n_labels=360, n_vertices=MESH_SIZES['32k'],
+                 n_voxels=SUBCORTICAL_VOXELS, seed=0):
+    ''' Writes a dlabel with n_labels contiguous parcels along the
+        grayordinates '''
+    columns = brain_models_map(n_vertices, n_voxels)
+    brain_models = list(columns.brain_models)
+    n_grayordinates = sum(bm.index_count for bm in brain_models)
+
+    rng = np.random.default_rng(seed)
+    keys = list(range(n_labels + 1))
+    names = ['???'] + ['parcel_{}'.format(k) for k in keys[1:]]
+    colors = [[0., 0., 0., 0.]] + rng.random((n_labels, 4)).tolist()
+    table = build_cifti.label_table(keys, names, colors)
+
+    labels = (np.arange(n_grayordinates) * n_labels // n_grayordinates + 1)
+    build_cifti.write_dlabel(filename, labels[None].astype(np.float32),
+                             brain_models, table, VOLUME_SHAPE, VOLUME_AFFINE)
+
+
+def write_dconn(filename, n_vertices=2562, n_voxels=1000, seed=0):
+    ''' Writes a (symmetric layout) dconn; a full 91k dconn takes 33GB, so
+        coarser meshes are used by default '''
+    rows = brain_models_map(n_vertices, n_voxels, dimension=0)
+    columns = brain_models_map(n_vertices, n_voxels, dimension=1)
+    n_grayordinates = sum(bm.index_count for bm in rows.brain_models)
+    _write(filename, rows, columns, 'NIFTI_INTENT_CONNECTIVITY_DENSE',
+           _random_columns((n_grayordinates, n_grayordinates), seed))
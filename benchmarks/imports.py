@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+''' Start-up time of citrix: importing the package and its modules, and
+    running the ctrx_* scripts with --help.
+
+    Each measure runs a fresh interpreter, the fastest of -repeat runs is
+    kept. The time of a bare interpreter is reported too, as a baseline:
+
+        python benchmarks/imports.py -out imports.json '''
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ['citrix', 'citrix.cifti', 'citrix.gifti', 'citrix.cli.batch']
+
+
+def run(command, repeat):
+    ''' Fastest wall time of command, in seconds '''
+    environment = dict(os.environ, PYTHONPATH=ROOT)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, env=environment, check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def commands():
+    ''' name -> command of each measure '''
+    measures = {'python': [sys.executable, '-c', 'pass']}
+    for module in MODULES:
+        measures['import ' + module] = [sys.executable, '-c',
+                                        'import ' + module]
+    for script in sorted(glob.glob(os.path.join(ROOT, 'scripts', 'ctrx_*'))):
+        measures[os.path.basename(script) + ' --help'] = [sys.executable,
+                                                          script, '--help']
+    return measures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=('Measures the start-up '
+                                                  'time of citrix'))
+    parser.add_argument('-out', dest='out', default='imports.json',
+                        help='JSON file where the results are written')
+    parser.add_argument('-repeat', dest='repeat', type=int, default=5,
+                        help='runs of each measure, the fastest is kept')
+    args = parser.parse_args()
+
+    results = []
+    for name, command in commands().items():
+        seconds = run(command, args.repeat)
+        results.append({'name': name, 'seconds': seconds})
+        print('{:40s} {:.3f}s'.format(name, seconds), file=sys.stderr)
+
+    with open(args.out, 'w') as f:
+        json.dump({'parameters': vars(args), 'results': results}, f,
+                  indent=2)
+
+
+if __name__ == "__main__":
+    main()
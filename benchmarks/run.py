@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+''' Benchmarks of citrix on synthetic HCP-scale files.
+
+    Each benchmark runs in a forked process, which reports its wall time
+    and how much its peak resident memory rose above the memory it started
+    with (the pages inherited from the parent are not counted). The peak
+    of memory traced by Python (numpy included) is measured by another
+    run, since tracing slows allocations down. Results are written as
+    JSON, and two result files can be compared with -compare:
+
+        python benchmarks/run.py -out before.json
+        python benchmarks/run.py -out after.json -compare before.json '''
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import nibabel
+import numpy as np
+
+import citrix
+from citrix import gifti, profiling, stream, utils
+from citrix.cli.cifti_average import cifti_average
+from citrix.cli.dlabel_to_nifti import dlabel_to_nifti
+from citrix.cli.dtseries_to_nifti import dtseries_to_nifti
+from citrix.cli.sparsify_dconn import sparsify_dconn
+
+import generators
+
+
+def prepare(directory, args):
+    ''' Writes the synthetic inputs, returns their filenames '''
+    n_vertices = generators.MESH_SIZES[args.mesh]
+    files = {'surfaces': generators.write_surfaces(directory, n_vertices)}
+
+    files['dtseries'] = os.path.join(directory, 'a.dtseries.nii')
+    generators.write_dtseries(files['dtseries'], args.frames, n_vertices)
+    files['dtseries.gz'] = files['dtseries'] + '.gz'
+    stream.compress(files['dtseries'], files['dtseries.gz'])
+
+    files['dlabel'] = os.path.join(directory, 'a.dlabel.nii')
+    generators.write_dlabel(files['dlabel'], n_vertices=n_vertices)
+
+    files['dconns'] = []
+    for seed in range(args.subjects):
+        filename = os.path.join(directory, '{}.dconn.nii'.format(seed))
+        generators.write_dconn(filename, args.dconn_vertices,
+                               args.dconn_voxels, seed)
+        files['dconns'].append(filename)
+    return files
+
+
+def benchmarks(files, directory):
+    ''' name -> function of each benchmark '''
+    surfaces = list(files['surfaces'].values())
+
+    def output(name):
+        return os.path.join(directory, name)
+
+    return {
+        'probe_header.dtseries': lambda: utils.probe_header(files['dtseries']),
+        'read_brain_structure.surface':
+            lambda: gifti.read_brain_structure(surfaces[0]),
+        'load.dtseries': lambda: citrix.load(files['dtseries']),
+        'load.dlabel': lambda: citrix.load(files['dlabel']),
+        'load.dconn': lambda: citrix.load(files['dconns'][0]),
+        'load.surface': lambda: citrix.load(surfaces[0]),
+        'grayordinates.dtseries':
+            lambda: citrix.load(files['dtseries']).grayordinates("COLUMN"),
+        'read.dtseries':
+            lambda: np.asarray(citrix.load(files['dtseries']).dataobj),
+        'read.dtseries.gz':
+            lambda: np.asarray(citrix.load(files['dtseries.gz']).dataobj),
+        'dtseries_to_nifti':
+            lambda: dtseries_to_nifti(files['dtseries'], output('a.nii'),
+                                      surfaces),
+        'dtseries_to_nifti.gz':
+            lambda: dtseries_to_nifti(files['dtseries'], output('a.nii.gz'),
+                                      surfaces),
+        'dlabel_to_nifti':
+            lambda: dlabel_to_nifti(files['dlabel'], output('l.nii'),
+                                    surface_files=surfaces),
+        'cifti_average.mean':
+            lambda: cifti_average(files['dconns'], output('mean.dconn.nii')),
+        'cifti_average.variance':
+            lambda: cifti_average(files['dconns'], output('var.dconn.nii'),
+                                  'variance'),
+        'sparsify_dconn.top_k':
+            lambda: sparsify_dconn(files['dconns'][0], output('top.npz'),
+                                   top_k=100),
+        'sparsify_dconn.threshold':
+            lambda: sparsify_dconn(files['dconns'][0], output('thr.npz'),
+                                   threshold=3.),
+    }
+
+
+def _time(function):
+    # the peak is reset to the current resident memory where possible,
+    # otherwise the baseline is the peak of the parent, inherited by fork
+    profiling.reset_peak_rss()
+    baseline = profiling.peak_rss()
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds,
+            'peak_rss_bytes': profiling.peak_rss() - baseline}
+
+
+def _trace(function):
+    tracemalloc.start()
+    try:
+        function()
+        return {'traced_peak_bytes': tracemalloc.get_traced_memory()[1]}
+    finally:
+        tracemalloc.stop()
+
+
+def _measure(run, function, connection):
+    try:
+        result = run(function)
+        result['error'] = None
+        connection.send(result)
+    except Exception as e:
+        connection.send({'error': '{}: {}'.format(type(e).__name__, e)})
+
+
+def _fork(run, function):
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_measure, args=(run, function, sender))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def measure(function):
+    ''' Runs function in a forked process for its time and resident memory,
+        then in another one, with tracemalloc, for its traced memory '''
+    result = _fork(_time, function)
+    if result['error'] is None:
+        result.update(_fork(_trace, function))
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'nibabel': nibabel.__version__,
+            'machine': platform.machine(), 'system': platform.system(),
+            'cpus': os.cpu_count()}
+
+
+def compare(results, reference):
+    ''' Prints the ratio of each measure to the one of a reference run '''
+    previous = {r['name']: r for r in reference['results']}
+    print('{:32s} {:>10s} {:>8s} {:>10s} {:>8s}'.format(
+        'benchmark', 'seconds', 'ratio', 'peak MB', 'ratio'))
+    for result in results['results']:
+        if result.get('error') is not None:
+            continue
+        old = previous.get(result['name'])
+        ratios = ['', '']
+        if old is not None and old.get('error') is None:
+            ratios = ['{:.2f}'.format(result[k] / max(old[k], 1e-12))
+                      for k in ('seconds', 'peak_rss_bytes')]
+        print('{:32s} {:10.3f} {:>8s} {:10.1f} {:>8s}'.format(
+            result['name'], result['seconds'], ratios[0],
+            result['peak_rss_bytes'] / 2 ** 20, ratios[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=('Benchmarks citrix on '
+                                                  'synthetic HCP-scale files'))
+    parser.add_argument('-out', dest='out', default='benchmarks.json',
+                        help='JSON file where the results are written')
+    parser.add_argument('-mesh', dest='mesh', default='32k',
+                        choices=sorted(generators.MESH_SIZES),
+                        help='resolution of the surfaces and grayordinates')
+    parser.add_argument('-frames', dest='frames', type=int, default=100,
+                        help='frames of the dtseries')
+    parser.add_argument('-subjects', dest='subjects', type=int, default=3,
+                        help='number of dconns averaged')
+    parser.add_argument('-dconn_vertices', dest='dconn_vertices', type=int,
+                        default=2562, help='vertices per hemisphere of dconns')
+    parser.add_argument('-dconn_voxels', dest='dconn_voxels', type=int,
+                        default=1000, help='subcortical voxels of dconns')
+    parser.add_argument('-repeat', dest='repeat', type=int, default=1,
+                        help='runs of each benchmark, the fastest is kept')
+    parser.add_argument('-only', dest='only', nargs='+', default=None,
+                        help='names (or prefixes) of the benchmarks to run')
+    parser.add_argument('-workdir', dest='workdir', default=None,
+                        help='directory of the synthetic files (temporary '
+                             'by default)')
+    parser.add_argument('-compare', dest='compare', default=None,
+                        help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as directory:
+        start = time.perf_counter()
+        files = prepare(directory, args)
+        print('Synthetic files written in {:.1f}s'.format(
+            time.perf_counter() - start), file=sys.stderr)
+
+        results = []
+        for name, function in benchmarks(files, directory).items():
+            if args.only and not any(name.startswith(o) for o in args.only):
+                continue
+            runs = [measure(function) for _ in range(args.repeat)]
+            failed = [r for r in runs if r['error'] is not None]
+            if failed:
+                result = failed[0]
+            else:
+                result = min(runs, key=lambda r: r['seconds'])
+            result['name'] = name
+            results.append(result)
+            print('{:32s} {}'.format(name, 'FAILED ' + result['error']
+                                     if result['error'] else
+                                     '{:.3f}s'.format(result['seconds'])),
+                  file=sys.stderr)
+
+    output = {'environment': environment(),
+              'parameters': vars(args), 'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(output, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
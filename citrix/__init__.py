@@ -1,23 +1,71 @@
-import nibabel
+import importlib
 
-from . import utils, cifti, gifti, build
+from . import profiling
 
+# Submodules imported on first access (e.g. citrix.cifti), so that importing
+# citrix, or running a ctrx_* script with --help, does not pay for nibabel,
+# scipy and the rest of the dependencies until they are needed
+_LAZY_SUBMODULES = ['utils', 'cifti', 'gifti', 'build']
+
+__all__ = _LAZY_SUBMODULES + ['load', 'save', 'profiling']
+
+
+def __getattr__(name):
+    if name in _LAZY_SUBMODULES:
+        module = importlib.import_module('.' + name, __name__)
+        globals()[name] = module
+        return module
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__,
+                                                                    name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+@profiling.profiled('citrix.load')
 def load(filename):
-    """Loading function that can handle gifti, nifti and cifti files"""
+    """Loading function that can handle gifti, nifti and cifti files, and
+       the sparse dconns of connectivity.SparseDenseConnectivity.
+
+       Only the header of nifti files is sniffed to tell whether they are
+       cifti files, so that each file is parsed once. Compressed files are
+       inflated on several threads, see parallel_gzip"""
     if filename.endswith('gii'):
+        from . import gifti
         return gifti.load(filename)
     elif filename.endswith('nii') or filename.endswith('nii.gz'):
+        from . import cifti, utils
         if utils.is_cifti(filename):
             return cifti.load(filename)
+        elif filename.endswith('.gz'):
+            from . import parallel_gzip
+            return parallel_gzip.load(filename)
         else:
+            import nibabel
             return nibabel.load(filename)
+    elif filename.endswith('npz'):
+        from . import connectivity
+        return connectivity.load(filename)
     else:
-        raise ValueError("We can only load NIFTI (nii) or GIFTI (gii) files")
+        raise ValueError("We can only load NIFTI (nii), GIFTI (gii) or "
+                         "sparse connectivity (npz) files")
+
+@profiling.profiled('citrix.save')
+def save(filename, data, header=None, affine=None, version=2,
+         compresslevel=None, block_size=None):
+    ''' Simple wrapper around nibabel.save for CIFTI/NIFTI files.
 
-def save(filename, data, header=None, affine=None, version=2):
-    ''' Simple wrapper around nibabel.save for CIFTI/NIFTI files '''
+        .gz files are compressed in blocks of block_size bytes on several
+        threads, at compresslevel (see parallel_gzip) '''
+    import nibabel
     if version == 1:
         nif_image = nibabel.Nifti1Image(data, affine, header)
     else:
         nif_image = nibabel.Nifti2Image(data, affine, header)
-    nibabel.save(nif_image, filename)
+
+    if filename.endswith('.gz'):
+        from . import parallel_gzip
+        parallel_gzip.save(nif_image, filename, compresslevel, block_size)
+    else:
+        nibabel.save(nif_image, filename)
@@ -1,7 +1,7 @@
 import numpy as np
 import nibabel
 
-from .. import indices, models
+from .. import indices, models, stream
 from ..cifti import DenseLabels
 
 def label_table(keys, labels, colors):
@@ -40,15 +40,55 @@ def label_table(keys, labels, colors):
     return label_table
 
 
-def dlabel(data, structures, label_table, volume_shape=None, affine=np.eye(4)):
-    """Builds a citrix.cifti.d dlabel cifti"""
+def surface_model(structure, vertices, n_vertices, offset=0):
+    """Builds the brain model of some vertices of a surface
+
+       Parameters
+       ----------
+       structure: str
+           brain structure of the surface
+       vertices: list
+           vertex indices of the grayordinates
+       n_vertices: int
+           number of vertices of the surface
+       offset: int
+           index of the first grayordinate of the model
+
+       Returns
+       -------
+       brain_model: nibabel.cifti2.Cifti2BrainModel"""
+    vertices = np.asarray(vertices, dtype=int).tolist()
+    return nibabel.cifti2.Cifti2BrainModel(
+        offset, len(vertices), models.SURFACE, structure, n_vertices,
+        vertex_indices=nibabel.cifti2.Cifti2VertexIndices(vertices))
 
-    mip_labels = nibabel.cifti2.Cifti2MatrixIndicesMap([0], indices.LABELS)
-    named_map = nibabel.cifti2.Cifti2NamedMap('labels', None, label_table)
-    mip_labels.append(named_map)
 
-    mip_brain_models = nibabel.cifti2.Cifti2MatrixIndicesMap([1], indices.BRAIN_MODELS)
-    for s in structures: mip_brain_models .append(s)
+def voxel_model(structure, voxels, offset=0):
+    """Builds the brain model of some (n, 3) voxels (ijk) of a volume
+       structure, see surface_model"""
+    voxels = np.asarray(voxels, dtype=int).reshape(-1, 3).tolist()
+    return nibabel.cifti2.Cifti2BrainModel(
+        offset, len(voxels), models.VOXEL, structure,
+        voxel_indices_ijk=nibabel.cifti2.Cifti2VoxelIndicesIJK(voxels))
+
+
+def brain_models_map(structures, volume_shape=None, affine=np.eye(4),
+                     dimension=1):
+    """Builds a BRAIN_MODELS index map
+
+       Parameters
+       ----------
+       structures: list
+           nibabel.cifti2.Cifti2BrainModel, see surface_model and voxel_model
+       volume_shape: tuple
+           shape of the volume, needed if there are voxel models
+       affine: array (4, 4)
+           transformation of the voxel indices to coordinates (in mm)
+       dimension: int
+           dimension of the matrix the map applies to"""
+    mip_brain_models = nibabel.cifti2.Cifti2MatrixIndicesMap([dimension],
+                                                             indices.BRAIN_MODELS)
+    for s in structures: mip_brain_models.append(s)
 
     if any([s.model_type == models.VOXEL for s in structures]):
         if volume_shape is None:
@@ -58,43 +98,201 @@ def dlabel(data, structures, label_table, volume_shape=None, affine=np.eye(4)):
         transform.matrix = affine
         mip_brain_models.volume = nibabel.cifti2.Cifti2Volume(volume_shape,
                                                               transform)
+    return mip_brain_models
+
+
+def dlabel_header(structures, label_table, volume_shape=None,
+                  affine=np.eye(4)):
+    """Builds the header of a dlabel cifti"""
+
+    mip_labels = nibabel.cifti2.Cifti2MatrixIndicesMap([0], indices.LABELS)
+    named_map = nibabel.cifti2.Cifti2NamedMap('labels', None, label_table)
+    mip_labels.append(named_map)
+
+    mip_brain_models = brain_models_map(structures, volume_shape, affine)
 
     matrix = nibabel.cifti2.Cifti2Matrix()
     matrix.append(mip_labels)
     matrix.append(mip_brain_models)
 
-    header = nibabel.cifti2.Cifti2Header(matrix)
+    return nibabel.cifti2.Cifti2Header(matrix)
+
+
+def dlabel(data, structures, label_table, volume_shape=None, affine=np.eye(4)):
+    """Builds a citrix.cifti.d dlabel cifti"""
+
+    header = dlabel_header(structures, label_table, volume_shape, affine)
 
     return nibabel.cifti2.Cifti2Image(data[None, :], header, None)
 
 
-def pdconn(data, parcels, structures, volume_shape=None, affine=np.eye(4)):
-    """Builds a pdconn cifti"""
+def pdconn_header(parcels, structures, volume_shape=None, affine=np.eye(4)):
+    """Builds the header of a pdconn cifti"""
 
     mip_parcels = nibabel.cifti2.Cifti2MatrixIndicesMap([1], indices.PARCELS)
-    mip_brain_models = nibabel.cifti2.Cifti2MatrixIndicesMap([0], indices.BRAIN_MODELS)
+    mip_brain_models = brain_models_map(structures, volume_shape, affine,
+                                        dimension=0)
 
     for p in parcels: mip_parcels.append(p)
-   
+
     for s in structures:
-        mip_brain_models.append(s)
-        
         if s.model_type == models.SURFACE:
             mip_parcels.append(nibabel.cifti2.Cifti2Surface(s.brain_structure, s.surface_number_of_vertices))
 
-    if any([s.model_type == models.VOXEL for s in structures]):
-        if volume_shape is None:
-            raise ValueError("A structure is of type voxel, "
-                             "but no volume dimension was given")
-        transform = nibabel.cifti2.Cifti2TransformationMatrixVoxelIndicesIJKtoXYZ(-3)
-        transform.matrix = affine
-        mip_brain_models.volume = nibabel.cifti2.Cifti2Volume(volume_shape,
-                                                              transform)
-
     matrix = nibabel.cifti2.Cifti2Matrix()
     matrix.append(mip_parcels)
     matrix.append(mip_brain_models)
 
-    header = nibabel.cifti2.Cifti2Header(matrix)
+    return nibabel.cifti2.Cifti2Header(matrix)
+
+
+def pdconn(data, parcels, structures, volume_shape=None, affine=np.eye(4)):
+    """Builds a pdconn cifti"""
+
+    header = pdconn_header(parcels, structures, volume_shape, affine)
 
     return nibabel.cifti2.Cifti2Image(data, header, None)
+
+
+def series_map(n_frames, step=1., dimension=0):
+    """Builds a SERIES index map of n_frames frames, step seconds apart"""
+    return nibabel.cifti2.Cifti2MatrixIndicesMap(
+        [dimension], indices.SERIES, number_of_series_points=n_frames,
+        series_exponent=0, series_start=0, series_step=step,
+        series_unit='SECOND')
+
+
+def scalars_map(names, dimension=0):
+    """Builds a SCALARS index map with a named map per name"""
+    mip_scalars = nibabel.cifti2.Cifti2MatrixIndicesMap([dimension],
+                                                        indices.SCALARS)
+    for name in names:
+        mip_scalars.append(nibabel.cifti2.Cifti2NamedMap(name))
+    return mip_scalars
+
+
+def _dense(data, rows, structures, intent, volume_shape, affine):
+    matrix = nibabel.cifti2.Cifti2Matrix()
+    matrix.append(rows)
+    matrix.append(brain_models_map(structures, volume_shape, affine))
+    image = nibabel.cifti2.Cifti2Image(data, nibabel.cifti2.Cifti2Header(matrix))
+    image.nifti_header.set_intent(intent)
+    return image
+
+
+def dtseries(data, structures, step=1., volume_shape=None, affine=np.eye(4)):
+    """Builds a dtseries cifti of (frames, grayordinates) data, the frames
+       being step seconds apart. See brain_models_map for the rest of the
+       parameters"""
+    return _dense(data, series_map(data.shape[0], step), structures,
+                  'NIFTI_INTENT_CONNECTIVITY_DENSE_SERIES', volume_shape,
+                  affine)
+
+
+def dscalar(data, structures, names=None, volume_shape=None,
+            affine=np.eye(4)):
+    """Builds a dscalar cifti of (maps, grayordinates) data. The maps are
+       named after their index if names is None"""
+    if names is None:
+        names = [str(i) for i in range(data.shape[0])]
+    return _dense(data, scalars_map(names), structures,
+                  'NIFTI_INTENT_CONNECTIVITY_DENSE_SCALARS', volume_shape,
+                  affine)
+
+
+def dconn(data, structures, volume_shape=None, affine=np.eye(4)):
+    """Builds a dconn cifti, with the same brain models along both
+       dimensions"""
+    rows = brain_models_map(structures, volume_shape, affine, dimension=0)
+    return _dense(data, rows, structures,
+                  'NIFTI_INTENT_CONNECTIVITY_DENSE', volume_shape, affine)
+
+
+def _write(filename, header, intent, source, dtype, axis):
+    shape = header.matrix.get_data_shape()
+    image = nibabel.cifti2.Cifti2Image(stream.empty(shape, dtype), header)
+    image.nifti_header.set_intent(intent)
+    stream.write_blocks(filename, image, source, axis)
+
+
+def write_dlabel(filename, source, structures, label_table, volume_shape=None,
+                 affine=np.eye(4), dtype=np.float32):
+    """Writes a dlabel cifti without holding its labels in memory.
+
+       The header is written first, then the labels of source, one block of
+       grayordinates at a time: source is an array-like (e.g. a memmap) of
+       shape (1, grayordinates), read in blocks, or an iterable yielding
+       the labels of consecutive grayordinates. See build.cifti.dlabel for
+       the rest of the parameters"""
+    header = dlabel_header(structures, label_table, volume_shape, affine)
+    _write(filename, header, 'NIFTI_INTENT_CONNECTIVITY_DENSE_LABELS',
+           source, dtype, axis=-1)
+
+
+def write_pdconn(filename, source, parcels, structures, volume_shape=None,
+                 affine=np.eye(4), dtype=np.float32):
+    """Writes a pdconn cifti without holding its matrix in memory.
+
+       The header is written first, then the rows of source, one block of
+       rows at a time: source is an array-like (e.g. a memmap) of shape
+       (grayordinates, parcels), read in blocks, or an iterable (e.g. a
+       generator) yielding blocks of consecutive rows. See build.cifti.pdconn
+       for the rest of the parameters"""
+    header = pdconn_header(parcels, structures, volume_shape, affine)
+    _write(filename, header, 'NIFTI_INTENT_CONNECTIVITY_PARCELLATED_DENSE',
+           source, dtype, axis=0)
+
+
+def parcel(name, vertices=None, voxels=None):
+    """Builds a cifti parcel
+
+       Parameters
+       ----------
+       name: str
+           name of the parcel
+       vertices: dict
+           maps each surface structure in the parcel to its vertex indices
+       voxels: array (n, 3)
+           voxel indices (ijk) of the parcel in the volume
+
+       Returns
+       -------
+       parcel: nibabel.cifti2.Cifti2Parcel"""
+    cifti_vertices = []
+    if vertices is not None:
+        for structure, indices_ in vertices.items():
+            cifti_vertices.append(nibabel.cifti2.Cifti2Vertices(
+                structure, np.asarray(indices_, dtype=int).tolist()))
+
+    voxel_indices = None
+    if voxels is not None and len(voxels) > 0:
+        voxel_indices = nibabel.cifti2.Cifti2VoxelIndicesIJK(
+            np.asarray(voxels, dtype=int).reshape(-1, 3).tolist())
+
+    return nibabel.cifti2.Cifti2Parcel(name, voxel_indices, cifti_vertices)
+
+
+def parcels_map(parcels, surfaces, volume=None, dimension=1):
+    """Builds a PARCELS index map
+
+       Parameters
+       ----------
+       parcels: list
+           nibabel.cifti2.Cifti2Parcel, see parcel
+       surfaces: list
+           (brain structure, number of vertices) of each surface the
+           parcels refer to
+       volume: nibabel.cifti2.Cifti2Volume
+           volume the voxels of the parcels refer to, if any
+       dimension: int
+           dimension of the matrix the map applies to"""
+    mip_parcels = nibabel.cifti2.Cifti2MatrixIndicesMap([dimension],
+                                                        indices.PARCELS)
+    for structure, n_vertices in surfaces:
+        mip_parcels.append(nibabel.cifti2.Cifti2Surface(structure, n_vertices))
+    for p in parcels: mip_parcels.append(p)
+
+    if volume is not None:
+        mip_parcels.volume = volume
+
+    return mip_parcels
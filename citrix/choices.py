@@ -0,0 +1,21 @@
+''' Names of the methods accepted by the tools. They only depend on the
+    standard library, so that command line parsers can offer them as
+    choices without importing the modules that implement them '''
+
+# ctrx_cifti_average, see cli.cifti_average
+AVERAGE_MODES = ['mean', 'variance', 'logodds']
+
+# ctrx_dlabel_to_nifti, see cli.dlabel_to_nifti.splat_labels
+COLLISION_RULES = ['majority', 'nearest']
+
+# 'mean' and 'median' of the grayordinates of each parcel, 'pc1' the
+# projection onto their first principal component
+PARCEL_REDUCERS = ['mean', 'median', 'pc1']
+
+# 'trilinear': interpolation between the 8 voxels around each point.
+# 'nearest': the voxel whose center is nearest to each point.
+SAMPLING_METHODS = ['trilinear', 'nearest']
+
+# ctrx_preprocess, see preprocessing.normalize. 'demean' removes the mean of
+# each time series, 'zscore' also divides it by its standard deviation
+NORMALIZATIONS = ['zscore', 'demean']
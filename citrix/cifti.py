@@ -1,7 +1,10 @@
 import abc
 from warnings import warn
 
+import numpy as np
+
 import nibabel
+from nibabel.arrayproxy import ArrayProxy, reshape_dataobj
 
 from nibabel.cifti2 import Cifti2MatrixIndicesMap as MatrixIndicesMap
 from nibabel.cifti2 import Cifti2BrainModel as BrainModel
@@ -13,19 +16,64 @@ from nibabel.cifti2 import Cifti2Parcel as Parcel
 from nibabel.cifti2 import Cifti2Vertices as Vertices
 from nibabel.cifti2 import Cifti2VertexIndices as VertexIndices
 
+from . import models, parallel_gzip, profiling, stream
+from .grayordinates import GrayordinateIndex
+
+CIFTI_FILE_TYPES = {'.dconn.nii': 'DenseDenseConnectivity',
+                    '.dtseries.nii': 'DenseTimeSeries',
+                    '.dscalar.nii': 'DenseScalar',
+                    '.dlabel.nii': 'DenseLabels',
+                    '.ptseries.nii': 'ParcelTimeSeries',
+                    '.pscalar.nii': 'ParcelScalar'}
+
+# Memory used by each block of data read from compressed files
+BLOCK_BYTES = 2 ** 27
+
+# NIFTI intent codes of the CIFTI file types
+CIFTI_INTENTS = {3001: 'DenseDenseConnectivity',
+                 3002: 'DenseTimeSeries',
+                 3006: 'DenseScalar',
+                 3007: 'DenseLabels',
+                 3004: 'ParcelTimeSeries',
+                 3008: 'ParcelScalar'}
+
+
+@profiling.profiled('cifti.load')
 def load(filename):
-    cifti_file_types = {'.dconn.nii': DenseDenseConnectivity,
-                        '.dtseries.nii': DenseTimeSeries,
-                        '.dscalar.nii': DenseScalar,
-                        '.dlabel.nii': DenseLabels}
+    with profiling.stage('header'):
+        if filename.endswith('.gz'):
+            nib = parallel_gzip.load(filename)
+        else:
+            nib = nibabel.load(filename)
+    Class = cifti_class(filename, nib)
 
-    for file_extension, Class in cifti_file_types.items():
+    if Class is None:
+        warn("Citrix doesn't know how to handle this file type")
+        return nib
+
+    with profiling.stage('from_nibabel'):
+        return Class.from_nibabel(nib)
+
+
+def cifti_class(filename, nib=None):
+    """Returns the citrix class for a file, from its extension or, failing
+       that, from the intent code of the already loaded image nib"""
+    if filename.endswith('.gz'):
+        filename = filename[:-len('.gz')]
+
+    for file_extension, class_name in CIFTI_FILE_TYPES.items():
         if filename.endswith(file_extension):
-            nib = nibabel.load(filename)
-            return Class.from_nibabel(nib)
+            return globals()[class_name]
+
+    if nib is not None:
+        if isinstance(nib, nibabel.Cifti2Image):
+            intent = int(nib.nifti_header['intent_code'])
+        else:
+            intent = int(nib.header['intent_code'])
+        if intent in CIFTI_INTENTS:
+            return globals()[CIFTI_INTENTS[intent]]
 
-    warn("Citrix doesn't know how to handle this file type")
-    return nibabel.load(filename)
+    return None
 
 
 class Cifti(nibabel.Cifti2Image):
@@ -38,6 +86,79 @@ class Cifti(nibabel.Cifti2Image):
     def column(self):
         return self.header.matrix.get_index_map(1)
 
+    def grayordinates(self, direction="COLUMN"):
+        """GrayordinateIndex of the brain models of a direction ("ROW" or
+           "COLUMN"). It is built on first use and cached"""
+        if direction not in ["ROW", "COLUMN"]:
+            raise ValueError("direction should be ROW or COLUMN")
+
+        if not hasattr(self, '_grayordinates'):
+            self._grayordinates = {}
+        if direction not in self._grayordinates:
+            index_map = self.row if direction == "ROW" else self.column
+            self._grayordinates[direction] = GrayordinateIndex(index_map)
+        return self._grayordinates[direction]
+
+    def structure_data(self, structure, direction="COLUMN"):
+        """Data of the grayordinates of a structure, along the rows ("ROW")
+           or the columns ("COLUMN") of the matrix.
+
+           Nothing is copied: the result is a view of the memory map of the
+           file (or of the array of an image built in memory), whose pages
+           are only read when used. Compressed files can not be mapped, only
+           the bytes of the structure are then read"""
+        structure_slice = self.grayordinates(direction).structure_slice(
+            structure)
+
+        data = self.memmap
+        if data is None:
+            data = self.dataobj
+        if direction == "ROW":
+            return data[structure_slice]
+        return data[..., structure_slice]
+
+    def surface_map(self, structure, rows=None, out=None, fill=0):
+        """Data of a surface structure on all the vertices of its mesh,
+           e.g. to plot it or to save it as a GIFTI file.
+
+           Parameters
+           ----------
+           structure: str
+               surface structure along the columns
+           rows: int, slice or array
+               rows (e.g. frames) that are mapped, all of them by default
+           out: array
+               array where the map is written, e.g. the one returned by a
+               previous call, so that mapping many frames does not allocate
+               an array each time
+           fill: scalar
+               value of the vertices that are not in the cifti (e.g. those
+               of the medial wall)
+
+           Returns
+           -------
+           surface_map: array (..., vertices of the mesh)"""
+        index = self.grayordinates("COLUMN")
+        if index.model_type(structure) != models.SURFACE:
+            raise ValueError("{} is not a surface structure".format(structure))
+
+        data = self.structure_data(structure)
+        if rows is not None:
+            if len(data.shape) == 1:
+                raise ValueError("The cifti has a single row")
+            data = data[rows]
+        data = np.asarray(data)
+
+        shape = data.shape[:-1] + (index.n_vertices(structure),)
+        if out is None:
+            out = np.empty(shape, dtype=data.dtype)
+        elif out.shape != shape:
+            raise ValueError("out should have shape {}".format(shape))
+
+        out[...] = fill
+        out[..., index.vertices(structure)] = data
+        return out
+
     @classmethod
     def from_nibabel(klass, nib):
 
@@ -50,16 +171,117 @@ class Cifti(nibabel.Cifti2Image):
                     cifti_header = ext.get_content()
             nifti_header = nib.header
 
-        return klass(nib.dataobj, cifti_header, nifti_header)
+        dataobj = nib.dataobj
+        if len(dataobj.shape) > 4:
+            # NIFTI view of a CIFTI file: the matrix is in dims 5 and 6
+            dataobj = reshape_dataobj(dataobj, dataobj.shape[4:])
+
+        return klass(dataobj, cifti_header, nifti_header)
+
+    @property
+    def memmap(self):
+        """Read-only memory map over the data of the file, with the shape of
+           dataobj. None if the data is not in an uncompressed, unscaled
+           file, e.g. when the image was built in memory"""
+        if not hasattr(self, '_memmap'):
+            self._memmap = _memmap_dataobj(self.dataobj)
+        return self._memmap
+
+
+def _memmap_dataobj(dataobj):
+    """Memory maps an array proxy, if its file allows it"""
+    if not isinstance(dataobj, ArrayProxy):
+        return None
+
+    filename = dataobj.file_like
+    if not isinstance(filename, str) or filename.endswith(('.gz', '.bz2',
+                                                           '.zst')):
+        return None
+
+    slope, inter = dataobj.slope, dataobj.inter
+    if not (slope in (1, None) and inter in (0, None)):
+        return None
+
+    return np.memmap(filename, dtype=dataobj.dtype, mode='r',
+                     offset=dataobj.offset, shape=dataobj.shape,
+                     order=dataobj.order)
 
 
 class DenseDenseConnectivity(Cifti):
+    """Dense connectivity matrix.
+
+       The matrix is never read as a whole: read_row(s), read_column(s) and
+       read_block read only the bytes they need through a memory map of the
+       file. When the file is compressed, rows and columns are gathered
+       from blocks of columns inflated in a single pass over the file (see
+       stream.column_blocks)"""
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         shape = self.dataobj.shape
         if len(shape) > 2:
-            self._dataobj = self.dataobj.reshape(shape[-2:])
+            self._dataobj = reshape_dataobj(self.dataobj, shape[-2:])
+
+    def read_row(self, i):
+        """Returns the i-th row of the matrix"""
+        return self.read_rows([i])[0]
+
+    def read_rows(self, indices):
+        """Returns the rows of the matrix in indices, as a 2D array"""
+        indices = np.asarray(indices, dtype=int)
+        data = self.memmap
+        if data is None and isinstance(self.dataobj, np.ndarray):
+            data = self.dataobj
+
+        if data is not None:
+            return np.array(data[indices])
+
+        # F-order storage: columns are contiguous on disk
+        rows = np.empty((len(indices), self.shape[1]),
+                        dtype=self.dataobj.dtype)
+        for start, block in stream.column_blocks(self.dataobj,
+                                                 block_bytes=BLOCK_BYTES):
+            rows[:, start:start + block.shape[1]] = block[indices]
+        return rows
+
+    def read_column(self, j):
+        """Returns the j-th column of the matrix"""
+        return self.read_columns([j])[:, 0]
+
+    def read_columns(self, indices):
+        """Returns the columns of the matrix in indices, as a 2D array"""
+        indices = np.asarray(indices, dtype=int)
+        data = self.memmap
+        if data is None and isinstance(self.dataobj, np.ndarray):
+            data = self.dataobj
+
+        if data is not None:
+            return np.array(data[:, indices])
+
+        columns = np.empty((self.shape[0], len(indices)),
+                           dtype=self.dataobj.dtype)
+        if len(indices) == 0:
+            return columns
+        # a single pass from the first to the last column wanted
+        for start, block in stream.column_blocks(self.dataobj, indices.min(),
+                                                 indices.max() + 1,
+                                                 BLOCK_BYTES):
+            stop = start + block.shape[1]
+            wanted = np.flatnonzero((indices >= start) & (indices < stop))
+            columns[:, wanted] = block[:, indices[wanted] - start]
+        return columns
+
+    def read_block(self, row_structure, column_structure):
+        """Returns the sub-matrix relating two brain structures: the rows
+           of row_structure and the columns of column_structure"""
+        rows = self.grayordinates("ROW").structure_slice(row_structure)
+        columns = self.grayordinates("COLUMN").structure_slice(column_structure)
+
+        data = self.memmap
+        if data is None:
+            data = self.dataobj
+        return np.array(data[rows, columns])
 
 class DenseTimeSeries(Cifti):
     def __init__(self, *args, **kwargs):
@@ -81,3 +303,17 @@ class DenseScalar(Cifti):
         shape = self.dataobj.shape
         if shape[0] ==  1:
             self._dataobj = self.dataobj.reshape([shape[-1]])
+
+class ParcelTimeSeries(Cifti):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        shape = self.dataobj.shape
+        if shape[0] == 1:
+            self._dataobj = self.dataobj.reshape([shape[-1]])
+
+class ParcelScalar(Cifti):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        shape = self.dataobj.shape
+        if shape[0] == 1:
+            self._dataobj = self.dataobj.reshape([shape[-1]])
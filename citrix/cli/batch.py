@@ -0,0 +1,185 @@
+''' Batch mode of the conversion tools: many files, one process pool '''
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import os
+import sys
+import time
+
+from .. import profiling
+
+# Surfaces and projections shared by the conversions of a worker
+_worker = {}
+
+
+def jobs_from_manifest(filename):
+    """Reads (input, output) pairs from a manifest: one pair per line,
+       separated by whitespace. Empty lines and lines starting with # are
+       ignored"""
+    jobs = []
+    with open(filename) as manifest:
+        for number, line in enumerate(manifest, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                raise ValueError('Line {} of {} should have an input and an '
+                                 'output file'.format(number, filename))
+            jobs.append(tuple(fields))
+    return jobs
+
+
+def jobs_from_glob(pattern, output_template):
+    """Pairs each file matching pattern with an output file name.
+
+       output_template is formatted with {dir} (directory of the input),
+       {name} (its file name) and {stem} (its file name up to the first
+       dot), e.g. '{dir}/{stem}.nii.gz'"""
+    jobs = []
+    for infile in sorted(glob.glob(pattern)):
+        name = os.path.basename(infile)
+        outfile = output_template.format(dir=os.path.dirname(infile) or '.',
+                                         name=name, stem=name.split('.')[0])
+        jobs.append((infile, outfile))
+    return jobs
+
+
+def _init_worker(surface_files, cache_dir):
+    # imported here so that parsers can use add_arguments cheaply
+    from .. import gifti
+    from ..projection import ProjectionCache
+
+    _worker['surfaces'] = None
+    if surface_files is not None:
+        _worker['surfaces'] = gifti.load_surfaces(surface_files)
+    _worker['cache'] = ProjectionCache(cache_dir)
+
+
+def _convert(conversion, infile, outfile, kwargs, profile=False):
+    # worker processes measure their conversions with a profiler of their
+    # own, whose records are sent back with the result
+    profiler = profiling.Profiler().start() if profile else None
+    start = time.time()
+    error = None
+    try:
+        conversion(infile, outfile, surface_files=_worker['surfaces'],
+                   projection_cache=_worker['cache'], **kwargs)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    return {'input': infile, 'output': outfile,
+            'seconds': time.time() - start, 'error': error,
+            'profile': None if profiler is None else profiler.records}
+
+
+def run_batch(conversion, jobs, surface_files=None, n_jobs=1, cache_dir=None,
+              **kwargs):
+    """Runs a conversion (e.g. dtseries_to_nifti) on many files.
+
+       The surfaces are loaded once per worker process and shared, with
+       their projections to the volume, by all the conversions it runs.
+
+       Parameters
+       ----------
+       conversion: function
+           called as conversion(input, output, surface_files=...,
+           projection_cache=..., **kwargs)
+       jobs: list
+           (input, output) pairs
+       surface_files: list
+           surfaces shared by all the inputs
+       n_jobs: int
+           number of worker processes
+       cache_dir: str
+           directory of an on-disk projection cache
+
+       Returns
+       -------
+       results: list
+           one dictionary per job with its input, output, seconds taken,
+           error (None if the conversion succeeded) and profile (the
+           records measured in a worker process while profiling, which are
+           also added to the active profilers, None otherwise)"""
+    init_args = (surface_files, cache_dir)
+    if n_jobs == 1:
+        _init_worker(*init_args)
+        try:
+            return [_convert(conversion, i, o, kwargs) for i, o in jobs]
+        finally:
+            _worker.clear()
+
+    profile = profiling.is_active()
+    with ProcessPoolExecutor(n_jobs, initializer=_init_worker,
+                             initargs=init_args) as pool:
+        futures = [pool.submit(_convert, conversion, i, o, kwargs, profile)
+                   for i, o in jobs]
+        results = [f.result() for f in futures]
+
+    for result in results:
+        if result['profile'] is not None:
+            profiling.add_records(result['profile'])
+    return results
+
+
+def report(results, out=sys.stdout):
+    """Prints the timing of each job and the failures. Returns the number of
+       failed jobs"""
+    failed = 0
+    for result in results:
+        if result['error'] is None:
+            status = 'ok'
+        else:
+            status = 'FAILED'
+            failed += 1
+        out.write('{:6s} {:8.2f}s  {} -> {}\n'.format(status, result['seconds'],
+                                                     result['input'],
+                                                     result['output']))
+        if result['error'] is not None:
+            out.write('       {}\n'.format(result['error']))
+
+    total = sum(r['seconds'] for r in results)
+    out.write('{} files converted, {} failed, {:.2f}s of conversion\n'.format(
+        len(results) - failed, failed, total))
+    return failed
+
+
+def add_arguments(parser):
+    """Adds the batch options to the parser of a ctrx_* script. Its (input,
+       output) positional arguments should be optional (nargs='?'), they
+       are checked by jobs_from_args"""
+    group = parser.add_argument_group('batch mode')
+    group.add_argument('-batch', dest='batch_manifest', default=None,
+                       help=('manifest with one "input output" pair per '
+                             'line, converted in a single run'))
+    group.add_argument('-glob', dest='batch_glob', default=None,
+                       help='pattern of the inputs to convert in a single run')
+    group.add_argument('-output', dest='batch_output', default=None,
+                       help=('output of each input matched by -glob, using '
+                             '{dir}, {name} and {stem}, e.g. '
+                             '"{dir}/{stem}.nii.gz"'))
+    group.add_argument('-jobs', dest='n_jobs', type=int, default=1,
+                       help='number of files converted in parallel')
+
+
+def jobs_from_args(parser, args, positionals):
+    """Jobs requested by the batch options, or None for a single conversion
+       of the positional arguments"""
+    infile, outfile = (getattr(args, p) for p in positionals)
+    if args.batch_manifest is None and args.batch_glob is None:
+        if infile is None or outfile is None:
+            parser.error('an input and an output are needed, unless -batch '
+                         'or -glob is used')
+        return None
+
+    if infile is not None or outfile is not None:
+        parser.error('-batch and -glob do not take positional files')
+    if args.batch_manifest is not None and args.batch_glob is not None:
+        parser.error('-batch and -glob are mutually exclusive')
+
+    if args.batch_manifest is not None:
+        return jobs_from_manifest(args.batch_manifest)
+    if args.batch_output is None:
+        parser.error('-glob needs -output')
+    return jobs_from_glob(args.batch_glob, args.batch_output)
@@ -1,54 +1,230 @@
 ''' Tool to average cifti files '''
-import nibabel
-import numpy
-
-from logpar.utils import cifti_header, cifti_utils, transform
-
-
-def check_input(matrix_files, outfile):
-    ''' Basic input check '''
-    conn_type = matrix_files[0].split('.')[-2]
-
-    if not all([name.split('.')[-2] == conn_type for name in matrix_files]):
-        raise ValueError('All the input files MUST be of the same type')
-    
-    if conn_type != outfile.split('.')[-2]:
-        raise ValueError('The output file MUST be of the same type as inputs')
+from concurrent.futures import ProcessPoolExecutor
+import os
+import tempfile
 
+import nibabel
+import numpy as np
 
-def cifti_average(matrix_files, outfile, in_logodds=False):
+from .. import choices, intersection, load, profiling, stream
 
-    check_input(matrix_files, outfile)
+MODES = choices.AVERAGE_MODES
 
-    nbr_matrices = len(matrix_files)
-    matrices = [nibabel.load(mat) for mat in matrix_files] 
-    headers = [mat.header for mat in matrices]
+# Memory used by each accumulator of a block of the output
+BLOCK_BYTES = 2 ** 26
 
-    # First, we retrieve the strucutures/indices that all the subjects
-    # share for both directions
-    
-    common_header = headers[0]
-    for header in headers:
-        common_header = cifti_header.header_intersection(header, common_header)
+# Probabilities are clipped to [EPS, 1 - EPS] before taking log-odds
+EPS = 1e-7
 
-    sizeR, sizeC = cifti_utils.matrix_size(common_header)
+# Inputs of the blocks processed by a worker, set by _init_worker
+_worker = {}
 
-    average_connectivity = numpy.zeros((sizeR, sizeC), dtype=numpy.float32)
 
-    matrices = [nibabel.load(mat) for mat in matrix_files] 
-    for i, matrix in enumerate(matrices):
-        subject_conn = cifti_utils.retrieve_common_data(common_header, matrix)
-        if in_logodds:
-            subject_conn = transform.to_logodds(subject_conn)
+def check_input(matrix_files, outfile, mode='mean'):
+    ''' Basic input check '''
+    def file_type(name):
+        if name.endswith('.gz'):
+            name = name[:-len('.gz')]
+        return name.split('.')[-2]
 
-        average_connectivity += subject_conn
+    conn_type = file_type(matrix_files[0])
 
-    average_connectivity /= nbr_matrices
+    if not all([file_type(name) == conn_type for name in matrix_files]):
+        raise ValueError('All the input files MUST be of the same type')
 
-    if in_logodds:
-        average_connectivity = transform.from_logodds(average_connectivity)
+    if conn_type != file_type(outfile):
+        raise ValueError('The output file MUST be of the same type as inputs')
 
-    cifti_utils.save_cifti(outfile,
-                           average_connectivity[None, None, None, None, ...],
-                           header=common_header,
-                           affine=matrices[0].affine)
+    if mode not in MODES:
+        raise ValueError('mode should be one of {}'.format(MODES))
+
+
+def to_logodds(probabilities):
+    probabilities = np.clip(probabilities, EPS, 1 - EPS)
+    return np.log(probabilities / (1 - probabilities))
+
+
+def from_logodds(logodds):
+    return 1 / (1 + np.exp(-logodds))
+
+
+def _read_runs(data, columns):
+    """Reads the given columns of a lazy array, sorted into runs of
+       consecutive columns, each read at once, so that the columns in
+       between are not read"""
+    order = np.argsort(columns, kind='stable')
+    ordered = columns[order]
+    breaks = np.flatnonzero(np.diff(ordered) != 1) + 1
+    runs = [np.asarray(data[:, run[0]:run[-1] + 1])[:, run - run[0]]
+            for run in np.split(ordered, breaks)]
+    block = np.empty((data.shape[0], len(columns)), dtype=runs[0].dtype)
+    block[:, order] = np.concatenate(runs, axis=1)
+    return block
+
+
+def read_columns(cifti, start, stop, gather=(None, None)):
+    ''' Reads the columns [start, stop) of a cifti as a 2D array.
+
+        gather holds the row and column indices of the grayordinates to
+        keep (see intersection.intersect_brain_models), None meaning all
+        of them. Columns are then counted among the kept ones '''
+    rows, columns = gather
+    data = cifti.memmap
+    if data is None:
+        data = cifti.dataobj
+    if len(data.shape) == 1:
+        data = data.reshape((1, data.shape[0]))
+
+    if columns is None:
+        block = data[:, start:stop]
+    else:
+        columns = columns[start:stop]
+        if isinstance(data, np.ndarray):
+            block = data[:, columns]
+        else:
+            block = _read_runs(data, columns)
+
+    block = np.asarray(block, dtype=np.float64)
+    if rows is not None:
+        block = block[rows]
+    return block
+
+
+def average_block(ciftis, start, stop, mode='mean', gathers=None):
+    ''' Averages the columns [start, stop) of all the ciftis, reading each
+        of them once. The variance is computed with Welford's online
+        algorithm. gathers holds the (rows, columns) gather indices of
+        each cifti, if they are to be restricted to common grayordinates '''
+    if gathers is None:
+        gathers = [(None, None)] * len(ciftis)
+
+    mean = None
+    for n, (cifti, gather) in enumerate(zip(ciftis, gathers), 1):
+        data = read_columns(cifti, start, stop, gather)
+        if mode == 'logodds':
+            data = to_logodds(data)
+
+        if mean is None:
+            mean = np.zeros_like(data)
+            if mode == 'variance':
+                m2 = np.zeros_like(data)
+
+        delta = data - mean
+        mean += delta / n
+        if mode == 'variance':
+            m2 += delta * (data - mean)
+
+    if mode == 'variance':
+        return m2 / max(len(ciftis) - 1, 1)
+    if mode == 'logodds':
+        return from_logodds(mean)
+    return mean
+
+
+def subject_gathers(ciftis, gathers):
+    ''' Reorganizes the gathers of intersection.intersect_headers into a
+        (rows, columns) pair per cifti, with None for the dimensions that
+        are kept whole '''
+    shape = tuple(ciftis[0].shape)
+    if len(shape) == 1:
+        shape = (1,) + shape
+    subject = []
+    for i in range(len(ciftis)):
+        pair = []
+        for direction, length in zip(intersection.DIRECTIONS, shape):
+            gather = gathers.get(direction, [None] * len(ciftis))[i]
+            if gather is not None and intersection.is_identity(gather,
+                                                               length):
+                gather = None
+            pair.append(gather)
+        subject.append(tuple(pair))
+    return subject
+
+
+def _init_worker(matrix_files, gathers, output, offset, dtype, shape):
+    _worker['ciftis'] = [load(f) for f in matrix_files]
+    _worker['gathers'] = gathers
+    _worker['output'] = np.memmap(output, dtype=dtype, mode='r+',
+                                  offset=offset, shape=shape, order='F')
+
+
+def _average_into_output(start, stop, mode):
+    block = average_block(_worker['ciftis'], start, stop, mode,
+                          _worker['gathers'])
+    output = _worker['output']
+    output.reshape((-1, output.shape[-1]), order='F')[:, start:stop] = block
+    output.flush()
+
+
+@profiling.profiled('cifti_average')
+def cifti_average(matrix_files, outfile, mode='mean', n_jobs=1):
+    ''' Averages (or computes the variance of) cifti files element-wise,
+        over the grayordinates that all of them share.
+
+        The inputs are never loaded in memory: the matrices are read in
+        blocks of columns, which are spread across n_jobs processes, and
+        each averaged block is written into a memory-mapped output.
+
+        Parameters
+        ----------
+        matrix_files: list
+            cifti files
+        outfile: str
+            output cifti file
+        mode: str
+            'mean', 'variance' (unbiased) or 'logodds', which averages in
+            log-odds space and maps the result back to probabilities
+        n_jobs: int
+            number of processes used '''
+    check_input(matrix_files, outfile, mode)
+
+    ciftis = [load(f) for f in matrix_files]
+    with profiling.stage('intersection'):
+        header, gathers = intersection.intersect_headers(ciftis)
+
+    shape = header.matrix.get_data_shape()
+    gathers = subject_gathers(ciftis, gathers)
+
+    n_rows = int(np.prod(shape[:-1]))
+    n_columns = shape[-1]
+
+    image = nibabel.Cifti2Image(stream.empty(shape), header,
+                                ciftis[0].nifti_header, dtype=np.float32)
+
+    compressed = outfile.endswith('.gz')
+    if compressed:
+        fd, output = tempfile.mkstemp(suffix='.nii',
+                                      dir=os.path.dirname(outfile) or '.')
+        os.close(fd)
+    else:
+        output = outfile
+
+    step = max(1, BLOCK_BYTES // (8 * n_rows))
+    blocks = [(start, min(start + step, n_columns))
+              for start in range(0, n_columns, step)]
+
+    try:
+        memmap = stream.memmap(output, image)
+        init_args = (matrix_files, gathers, output, memmap.offset,
+                     memmap.dtype, shape)
+        del memmap
+
+        if n_jobs == 1:
+            _init_worker(*init_args)
+            for start, stop in blocks:
+                _average_into_output(start, stop, mode)
+        else:
+            with ProcessPoolExecutor(n_jobs, initializer=_init_worker,
+                                     initargs=init_args) as pool:
+                futures = [pool.submit(_average_into_output, start, stop,
+                                       mode)
+                           for start, stop in blocks]
+                for future in futures:
+                    future.result()
+
+        if compressed:
+            stream.compress(output, outfile)
+    finally:
+        _worker.clear()
+        if compressed:
+            os.remove(output)
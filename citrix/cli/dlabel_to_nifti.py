@@ -1,8 +1,10 @@
-import nibabel
 import numpy as np
 import os
 
-from .. import models, load, save
+from .. import choices, gifti, models, load, profiling, projection, save
+from .dtseries_to_nifti import load_surface
+
+COLLISION_RULES = choices.COLLISION_RULES
 
 def check_input(infile, outfile, reference_file, surface_files):
 
@@ -10,29 +12,103 @@ def check_input(infile, outfile, reference_file, surface_files):
             or infile.endswith('.dlabel.nii.gz')):
         raise ValueError("dlabel file should end with 'dlabel.nii' or 'dlabel.nii.gz'")
 
-    if not (reference_file.endswith('.nii') or reference_file.endswith('.nii.gz')):
+    if reference_file is not None and not (reference_file.endswith('.nii')
+                                           or reference_file.endswith('.nii.gz')):
         raise ValueError("reference_file should end with '.nii' or '.nii.gz'")
 
     if not (outfile.endswith('.nii') or outfile.endswith('.nii.gz')):
         raise ValueError("outfile should end with '.nii' or '.nii.gz'")
 
-    if surface_files:
+    # surfaces given already loaded, by structure, are not checked
+    if surface_files and not isinstance(surface_files, dict):
         for sfile in surface_files:
             if not os.path.exists(sfile):
                 raise ValueError('The file {} does not exist'.format(sfile))
 
 
+def splat_labels(voxels, labels, shape, collision='majority'):
+    """Assigns the label of each vertex to the 8 voxels surrounding its
+       (continuous) voxel coordinates, all vertices at once.
+
+       Parameters
+       ----------
+       voxels: array (n, 3)
+           continuous voxel coordinates of the vertices
+       labels: array (n,)
+           label of each vertex
+       shape: tuple
+           shape of the volume, neighbors falling outside of it are dropped
+       collision: str
+           rule used when vertices with different labels reach the same
+           voxel. 'majority' keeps the label reaching it most often
+           (ties go to the label of the nearest vertex), 'nearest' keeps
+           the label of the nearest vertex
+
+       Returns
+       -------
+       flat: array
+           flat (column-major) indices of the labeled voxels, without
+           repetitions
+       voxel_labels: array
+           label of each of those voxels"""
+    flat, distances = projection.vertex_voxels(np.asarray(voxels, dtype=float),
+                                               np.eye(4), shape, 'neighbors')
+    return resolve_collisions(flat, labels, distances, collision)
+
+
+def resolve_collisions(flat, labels, distances, collision='majority'):
+    """Labels voxels from the (n, k) voxels reached by n labeled vertices
+       and their distances, as given by projection.vertex_voxels. See
+       splat_labels for the collision rules"""
+    if collision not in COLLISION_RULES:
+        raise ValueError("collision should be one of {}".format(COLLISION_RULES))
+
+    flat = np.asarray(flat)
+    labels = np.repeat(np.asarray(labels), flat.shape[1])
+    flat, distances = flat.ravel(), np.asarray(distances).ravel()
+
+    inside = flat >= 0
+    flat, labels, distances = flat[inside], labels[inside], distances[inside]
+
+    if collision == 'majority':
+        # collapse (voxel, label) pairs, counting votes and keeping
+        # the distance to the nearest voter
+        order = np.lexsort((labels, flat))
+        flat, labels, distances = flat[order], labels[order], distances[order]
+        starts = np.flatnonzero(np.r_[True, (np.diff(flat) != 0) |
+                                            (labels[1:] != labels[:-1])])
+        votes = np.diff(np.r_[starts, len(flat)])
+        distances = np.minimum.reduceat(distances, starts)
+        flat, labels = flat[starts], labels[starts]
+        order = np.lexsort((labels, distances, -votes, flat))
+    else:
+        order = np.lexsort((labels, distances, flat))
+
+    flat, labels = flat[order], labels[order]
+    first = np.r_[True, np.diff(flat) != 0]
+    return flat[first], labels[first]
+
+
+@profiling.profiled('dlabel_to_nifti')
 def dlabel_to_nifti(dlabel_file, outfile,
-                    reference_file=None, surface_files=None):
-    """Transforms a dlabel file into a nifti file"""
+                    reference_file=None, surface_files=None,
+                    collision='majority', projection_cache=None):
+    """Transforms a dlabel file into a nifti file.
+
+       Each vertex labels the 8 voxels around it, collisions between
+       vertices are resolved following the collision rule (see
+       splat_labels). A projection.ProjectionCache can be given to reuse
+       the projections of the surfaces across conversions, and
+       surface_files can be a dictionary of loaded surfaces (see
+       gifti.load_surfaces)"""
     check_input(dlabel_file, outfile, reference_file, surface_files)
     # load time series
     dlabel = load(dlabel_file)
-    labels = dlabel.get_data()
+    labels = np.asarray(dlabel.dataobj)
 
-    # load surfaces if present
-    if surface_files is not None:
-        surfaces = [load(sf) for sf in surface_files]
+    # find the structure of each surface, they are loaded when needed
+    if surface_files is not None and not isinstance(surface_files, dict):
+        surface_files = gifti.surfaces_by_structure(surface_files)
 
     # get information about volume and create it
     if dlabel.column.volume is not None:
@@ -41,42 +117,37 @@ def dlabel_to_nifti(dlabel_file, outfile,
         affine = volume.transformation_matrix_voxel_indices_ijk_to_xyz.matrix
     elif reference_file is not None:
         volume = load(reference_file)
-        shape = volume.shape
+        shape = volume.shape[:3]
         affine = volume.affine
     else:
         raise ValueError("The dlabel has no volume information, and no "
                          "reference volume was given")
 
-    nifti = np.zeros(shape)
+    if projection_cache is None:
+        projection_cache = projection.ProjectionCache()
 
-    for bm in dlabel.column.brain_models:
-        if bm.model_type == models.SURFACE:
+    nifti = np.zeros(shape, order='F')
+    flat_nifti = nifti.reshape(-1, order='F')
+
+    grayordinates = dlabel.grayordinates("COLUMN")
+    for structure in grayordinates.structures:
+        rows = grayordinates.structure_slice(structure)
+        if grayordinates.model_type(structure) == models.SURFACE:
             if surface_files is None:
                 raise ValueError(('There are surface models in the dlabel,'
                                   'but no surface was given as input'))
-            idx_vertices = np.array(bm.vertex_indices)
-
-            for s in surfaces:
-                if s.brain_structure == bm.brain_structure:
-                    surf = s
-
-            vertices = surf.vertices[idx_vertices]
-            voxels = nibabel.affines.apply_affine(np.linalg.inv(affine),
-                                                  vertices)
-
-            off, cnt = bm.index_offset, bm.index_count
+            idx_vertices = grayordinates.vertices(structure)
 
-            for o, (x, y, z) in enumerate(voxels):
-                neighbors = [(x+i, y+j, z+k) for i in range(-1, 1)
-                                             for j in range(-1, 1)
-                                             for k in range(-1, 1)]
+            surf = load_surface(surface_files, structure)
 
-                neighbors = np.round(neighbors).astype(int)
+            projected = projection_cache.get(surf, affine, shape, 'neighbors')
+            flat, distances = projected.select(idx_vertices)
 
-                nifti[tuple(np.transpose(neighbors))] = labels[off+o]
+            flat, voxel_labels = resolve_collisions(flat, labels[rows],
+                                                    distances, collision)
+            flat_nifti[flat] = voxel_labels
         else:
-            voxels = np.array(bm.voxel_indices_ijk).astype(int)
-            off, cnt = bm.index_offset, bm.index_count
-            nifti[tuple(np.transpose(voxels))] = labels[off:off+cnt]
+            voxels = grayordinates.voxels(structure)
+            nifti[tuple(np.transpose(voxels))] = labels[rows]
 
     save(outfile, nifti, None, affine, version=1)
@@ -0,0 +1,164 @@
+''' Tool to compute the dense connectivity (dconn) of a dtseries '''
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import os
+import tempfile
+
+import nibabel
+import numpy as np
+
+from .. import load, profiling, stream
+
+# Memory used by each tile of the correlation matrix
+BLOCK_BYTES = 2 ** 27
+
+# Correlations are clipped to [-1 + EPS, 1 - EPS] before the Fisher z
+EPS = 1e-7
+
+
+def check_input(infile, outfile):
+
+    if not (infile.endswith('.dtseries.nii')
+            or infile.endswith('.dtseries.nii.gz')):
+        raise ValueError("dtseries file should end with 'dtseries.nii' or 'dtseries.nii.gz'")
+
+    if not (outfile.endswith('.dconn.nii') or outfile.endswith('.dconn.nii.gz')):
+        raise ValueError("outfile should end with 'dconn.nii' or 'dconn.nii.gz'")
+
+
+def dconn_image(dtseries):
+    ''' Image describing the dconn of a dtseries: both of its dimensions
+        are the brain models of the dtseries columns '''
+    matrix = nibabel.cifti2.Cifti2Matrix()
+    for dimension in (0, 1):
+        index_map = copy.deepcopy(dtseries.column)
+        index_map.applies_to_matrix_dimension = [dimension]
+        matrix.append(index_map)
+
+    header = nibabel.cifti2.Cifti2Header(matrix)
+    shape = header.matrix.get_data_shape()
+    image = nibabel.Cifti2Image(stream.empty(shape), header)
+    image.nifti_header.set_intent('NIFTI_INTENT_CONNECTIVITY_DENSE')
+    return image
+
+
+def zscore_into(dtseries, zscores, block_bytes=BLOCK_BYTES):
+    ''' Writes the z-scored time series of the dtseries into zscores, a
+        (frames, grayordinates) array, scaled by 1/sqrt(frames) so that
+        the correlation matrix is zscores.T @ zscores. Constant time series
+        get zeros. The dtseries is read once, one block of columns at a
+        time '''
+    data = dtseries.memmap
+    if data is None:
+        data = dtseries.dataobj
+
+    n_frames, n_grayordinates = data.shape
+    step = max(1, block_bytes // (8 * n_frames))
+    for start in range(0, n_grayordinates, step):
+        stop = min(start + step, n_grayordinates)
+        block = np.asarray(data[:, start:stop], dtype=np.float64)
+        block -= block.mean(axis=0)
+        norm = np.linalg.norm(block, axis=0)
+        norm[norm == 0] = np.inf
+        zscores[:, start:stop] = block / norm
+
+
+def tile_ranges(n, tile_size):
+    return [(start, min(start + tile_size, n))
+            for start in range(0, n, tile_size)]
+
+
+def correlate_tiles(zscores, output, column_tile, tiles, fisher_z=False):
+    ''' Computes the tiles of the correlation matrix in the column tile
+        and their transposes, i.e. the tiles (i, j) and (j, i) for all the
+        row tiles i up to the column tile j. Each tile is a single matmul
+        of blocks of zscores '''
+    j0, j1 = column_tile
+    right = np.asarray(zscores[:, j0:j1])
+    for i0, i1 in tiles:
+        if i0 > j0:
+            break
+        left = right if i0 == j0 else np.asarray(zscores[:, i0:i1])
+        tile = left.T @ right
+        if fisher_z:
+            tile = np.arctanh(np.clip(tile, -1 + EPS, 1 - EPS))
+        output[i0:i1, j0:j1] = tile
+        if i0 != j0:
+            output[j0:j1, i0:i1] = tile.T
+    output.flush()
+
+
+@profiling.profiled('dtseries_to_dconn')
+def dtseries_to_dconn(dtseries_file, outfile, fisher_z=False, n_jobs=1,
+                      tile_size=None):
+    ''' Computes the correlation between the time series of every pair of
+        grayordinates of a dtseries, and writes it as a dconn.
+
+        The time series are z-scored once into a temporary file, then the
+        matrix is computed in square tiles, each one a BLAS matmul, by
+        n_jobs threads. Tiles are written into a memory-mapped output as
+        they are computed, so memory usage is bounded by a few tiles and
+        not by the size of the dconn. Only the upper triangle of tiles is
+        computed, the lower one being its transpose.
+
+        Parameters
+        ----------
+        dtseries_file: str
+            input dtseries
+        outfile: str
+            output dconn, compressed at the end if it ends with .gz
+        fisher_z: bool
+            whether to apply the Fisher z-transform (arctanh) to the
+            correlations
+        n_jobs: int
+            number of threads computing tiles
+        tile_size: int
+            number of grayordinates per side of a tile. By default tiles
+            take about BLOCK_BYTES '''
+    check_input(dtseries_file, outfile)
+
+    dtseries = load(dtseries_file)
+    if len(dtseries.shape) != 2:
+        raise ValueError("The dtseries needs more than one frame")
+    n_frames, n_grayordinates = dtseries.shape
+
+    if tile_size is None:
+        tile_size = max(1, int(np.sqrt(BLOCK_BYTES // 4)))
+    tiles = tile_ranges(n_grayordinates, tile_size)
+
+    directory = os.path.dirname(outfile) or '.'
+    fd, zscore_file = tempfile.mkstemp(suffix='.zscore', dir=directory)
+    os.close(fd)
+
+    compressed = outfile.endswith('.gz')
+    if compressed:
+        fd, output_file = tempfile.mkstemp(suffix='.nii', dir=directory)
+        os.close(fd)
+    else:
+        output_file = outfile
+
+    try:
+        zscores = np.memmap(zscore_file, dtype=np.float32, mode='w+',
+                            shape=(n_frames, n_grayordinates), order='F')
+        with profiling.stage('zscore'):
+            zscore_into(dtseries, zscores)
+            zscores.flush()
+
+        output = stream.memmap(output_file, dconn_image(dtseries))
+
+        with profiling.stage('correlate'):
+            with ThreadPoolExecutor(n_jobs) as pool:
+                futures = [pool.submit(correlate_tiles, zscores, output,
+                                       tile, tiles, fisher_z)
+                           for tile in tiles]
+                for future in futures:
+                    future.result()
+
+        del output, zscores
+
+        if compressed:
+            stream.compress(output_file, outfile)
+    finally:
+        os.remove(zscore_file)
+        if compressed and os.path.exists(output_file):
+            os.remove(output_file)
@@ -1,8 +1,14 @@
+from warnings import warn
+
 import nibabel
 import numpy as np
 import os
 
-from .. import models, load, save
+from .. import gifti, models, load, profiling, projection, stream
+
+# Memory used by each block of frames held before writing
+BLOCK_BYTES = 2 ** 27
+
 
 def check_input(infile, outfile, surface_files):
 
@@ -13,49 +19,137 @@ def check_input(infile, outfile, surface_files):
     if not (outfile.endswith('.nii') or outfile.endswith('.nii.gz')):
         raise ValueError("outfile should end with '.nii' or '.nii.gz'")
 
-    if surface_files:
+    # surfaces given already loaded, by structure, are not checked
+    if surface_files and not isinstance(surface_files, dict):
         for sfile in surface_files:
             if not os.path.exists(sfile):
                 raise ValueError('The file {} does not exist'.format(sfile))
 
 
-def dtseries_to_nifti(dtseries_file, outfile, surface_files=None):
-    """Transforms a dtseries file into a nifti file"""
-    check_input(dtseries_file, outfile, surface_files)
-    # load time series
-    dtseries = load(dtseries_file)
-    time_series = dtseries.get_data()
+def load_surface(surface_files, structure):
+    """Loads the surface of a brain structure, given a dictionary mapping
+       structures to files or to surfaces that are already loaded"""
+    if structure not in surface_files:
+        raise ValueError('No surface was given for {}'.format(structure))
+    surface = surface_files[structure]
+    if isinstance(surface, str):
+        surface = load(surface)
+    return surface
 
-    # load surfaces if present
-    if surface_files is not None:
-        surfaces = [load(sf) for sf in surface_files]
 
-    # get information about volume and create it
-    volume = dtseries.column.volume
-    shape = volume.volume_dimensions
-    affine = volume.transformation_matrix_voxel_indices_ijk_to_xyz.matrix
+def grayordinate_voxels(dtseries, shape, affine, surface_files=None,
+                        projection_cache=None):
+    """Returns, for each grayordinate of the dtseries, the flat (column-major)
+       index of the voxel where it lands, along with a mask of the
+       grayordinates that fall inside the volume. The projections of the
+       surfaces are taken from projection_cache when possible"""
+    if projection_cache is None:
+        projection_cache = projection.ProjectionCache()
 
-    nifti = np.zeros(shape)
+    grayordinates = dtseries.grayordinates("COLUMN")
+    flat = np.empty(len(grayordinates), dtype=np.int64)
 
-    for bm in dtseries.column.brain_models:
-        if bm.model_type == models.SURFACE:
+    for structure in grayordinates.structures:
+        rows = grayordinates.structure_slice(structure)
+        if grayordinates.model_type(structure) == models.SURFACE:
             if surface_files is None:
                 raise ValueError(('There are surface models in the dtseries,'
                                   'but no surface was given as input'))
-            idx_vertices = np.array(bm.vertex_indices)
+            idx_vertices = grayordinates.vertices(structure)
 
-            for s in surfaces:
-                if s.brain_structure == bm.brain_structure:
-                    surf = s
+            surf = load_surface(surface_files, structure)
 
-            vertices = surf.vertices[idx_vertices]
-            voxels = nibabel.affines.apply_affine(np.linalg.inv(affine),
-                                                  vertices)
-            voxels = np.floor(voxels).astype(int)
+            projected = projection_cache.get(surf, affine, shape, 'floor')
+            flat[rows] = projected.select(idx_vertices)[0][:, 0]
         else:
-            voxels = bm.voxel_indices_ijk
+            voxels = grayordinates.voxels(structure)
+            inside = np.all((voxels >= 0) & (voxels < shape), axis=1)
+            voxel_flat = np.ravel_multi_index(tuple(voxels.T), shape,
+                                              mode='clip', order='F')
+            voxel_flat[~inside] = -1
+            flat[rows] = voxel_flat
+
+    inside = flat >= 0
+    if not inside.all():
+        warn("{} grayordinates fall outside of the volume and will be "
+             "ignored".format((~inside).sum()))
+
+    return flat[inside], inside
+
+
+def frame_blocks(dtseries, flat, inside, n_voxels, frames_per_block):
+    """Yields blocks of frames of the dtseries projected to the volume,
+       as (n_voxels, frames) arrays. Only one block of the time series
+       is read at a time"""
+    dataobj = dtseries.dataobj
+    if len(dataobj.shape) == 1:
+        dataobj = np.asarray(dataobj)[None]
+
+    n_frames = dataobj.shape[0]
+    for start in range(0, n_frames, frames_per_block):
+        stop = min(start + frames_per_block, n_frames)
+        time_series = np.asarray(dataobj[start:stop], dtype=np.float32)
+
+        block = np.zeros((n_voxels, stop - start), dtype=np.float32)
+        block[flat] = time_series[:, inside].T
+        yield start, block
+
+
+@profiling.profiled('dtseries_to_nifti')
+def dtseries_to_nifti(dtseries_file, outfile, surface_files=None,
+                      frames_per_block=None, projection_cache=None):
+    """Transforms a dtseries file into a (4D) nifti file.
+
+       The time series are read and written in blocks of frames, so that
+       memory usage does not depend on the length of the run. When
+       frames_per_block is None, blocks of about BLOCK_BYTES are used.
+       A projection.ProjectionCache can be given to reuse the projections
+       of the surfaces across conversions, and surface_files can be a
+       dictionary of loaded surfaces (see gifti.load_surfaces)"""
+    check_input(dtseries_file, outfile, surface_files)
+    # load time series (lazily)
+    dtseries = load(dtseries_file)
+
+    # find the structure of each surface, they are loaded when needed
+    if surface_files is not None and not isinstance(surface_files, dict):
+        surface_files = gifti.surfaces_by_structure(surface_files)
+
+    # get information about volume and create it
+    volume = dtseries.column.volume
+    shape = tuple(volume.volume_dimensions)
+    affine = volume.transformation_matrix_voxel_indices_ijk_to_xyz.matrix
+
+    with profiling.stage('geometry'):
+        flat, inside = grayordinate_voxels(dtseries, shape, affine,
+                                           surface_files, projection_cache)
+
+    n_voxels = int(np.prod(shape))
+    if len(dtseries.shape) == 1:
+        n_frames = 1
+        out_shape = shape
+    else:
+        n_frames = dtseries.shape[0]
+        out_shape = shape + (n_frames,)
+
+    if frames_per_block is None:
+        frames_per_block = max(1, BLOCK_BYTES // (4 * n_voxels))
 
-        off, cnt = bm.index_offset, bm.index_count
-        nifti[tuple(np.transpose(voxels))] = time_series[off:off+cnt]
+    # reading (and inflating) the blocks is measured apart from writing them
+    blocks = profiling.iterate('read', frame_blocks(dtseries, flat, inside,
+                                                    n_voxels, frames_per_block))
+    nifti = nibabel.Nifti1Image(stream.empty(out_shape), affine)
 
-    save(outfile, nifti, None, affine, version=1)
+    if outfile.endswith('.gz'):
+        with stream.BlockWriter(outfile, nifti) as writer:
+            for _, block in blocks:
+                with profiling.stage('write'):
+                    writer.write(block)
+    else:
+        output = stream.memmap(outfile, nifti)
+        output = output.reshape((n_voxels, n_frames), order='F')
+        for start, block in blocks:
+            with profiling.stage('write'):
+                output[:, start:start + block.shape[1]] = block
+        with profiling.stage('write'):
+            output.flush()
+        del output
@@ -0,0 +1,249 @@
+''' Tool to compute the group principal components of many dtseries '''
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+
+import numpy as np
+
+from .. import intersection, load, preprocessing, profiling, stream
+from ..build import cifti as build_cifti
+
+# Memory used by each block of columns read from a dtseries
+BLOCK_BYTES = 2 ** 26
+
+# Subjects whose time series take less memory are kept between the two
+# passes of reduce_subject instead of being read again
+KEEP_BYTES = 2 ** 30
+
+
+def check_input(dtseries_files, outfile, n_components, dimension):
+
+    for name in dtseries_files:
+        if not (name.endswith('.dtseries.nii')
+                or name.endswith('.dtseries.nii.gz')):
+            raise ValueError("{} should end with 'dtseries.nii' or "
+                             "'dtseries.nii.gz'".format(name))
+
+    if not (outfile.endswith('.dscalar.nii')
+            or outfile.endswith('.dscalar.nii.gz')):
+        raise ValueError("outfile should end with 'dscalar.nii' or "
+                         "'dscalar.nii.gz'")
+
+    if n_components < 1:
+        raise ValueError("n_components should be positive")
+
+    if dimension is not None and dimension < n_components:
+        raise ValueError("dimension should be at least n_components")
+
+
+def _top_eigenvectors(gram, n):
+    ''' The n eigenvectors of a symmetric matrix with the largest
+        eigenvalues, as columns, in decreasing order '''
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    return eigenvectors[:, ::-1][:, :n]
+
+
+def _gathered_blocks(dtseries, columns, block_bytes):
+    ''' Yields (positions, block) for the blocks of the time series of a
+        dtseries, read in a single pass over the file (see
+        stream.column_blocks), restricted to the gathered columns (all of
+        them if None). positions are those of the columns of the block
+        among the gathered ones '''
+    data = dtseries.memmap
+    if data is None:
+        data = dtseries.dataobj
+    if len(data.shape) == 1:
+        data = data.reshape((1, data.shape[0]))
+    columns_per_block = max(1, block_bytes // (8 * data.shape[0]))
+
+    if columns is None:
+        for start, block in stream.column_blocks(
+                data, columns_per_block=columns_per_block):
+            yield slice(start, start + block.shape[1]), block
+        return
+
+    order = np.argsort(columns, kind='stable')
+    ordered = columns[order]
+    for start, block in stream.column_blocks(
+            data, ordered[0], ordered[-1] + 1,
+            columns_per_block=columns_per_block):
+        first, last = np.searchsorted(ordered, [start,
+                                                start + block.shape[1]])
+        if last > first:
+            yield order[first:last], block[:, ordered[first:last] - start]
+
+
+def reduce_subject(dtseries, dimension, columns=None, normalize='zscore',
+                   block_bytes=BLOCK_BYTES, keep_bytes=KEEP_BYTES):
+    ''' Projects the (normalized) time series of a dtseries onto its first
+        dimension temporal principal components, i.e. returns S V^T of its
+        truncated SVD, a (dimension, grayordinates) array.
+
+        The data is read in blocks of columns, each pass a sequential read
+        of the file: once to accumulate the (frames, frames) Gram matrix,
+        whose eigenvectors are the temporal components, and once to project
+        the blocks onto them. When the (normalized) time series take less
+        than keep_bytes, the blocks of the first pass are kept for the
+        second one instead. columns restricts the grayordinates (see
+        intersection), None keeps all '''
+    n_frames = 1 if len(dtseries.shape) == 1 else dtseries.shape[0]
+    n_grayordinates = (dtseries.shape[-1] if columns is None
+                       else len(columns))
+    stage = (preprocessing.normalize(normalize) if normalize is not None
+             else (lambda block: block))
+
+    def blocks():
+        for positions, block in _gathered_blocks(dtseries, columns,
+                                                 block_bytes):
+            yield positions, stage(np.asarray(block, dtype=np.float64))
+
+    keep = 8 * n_frames * n_grayordinates <= keep_bytes
+    kept = []
+    gram = np.zeros((n_frames, n_frames))
+    for positions, block in blocks():
+        gram += block @ block.T
+        if keep:
+            kept.append((positions, block))
+
+    components = _top_eigenvectors(gram, dimension)
+    reduced = np.empty((components.shape[1], n_grayordinates),
+                       dtype=np.float32)
+    for positions, block in (kept if keep else blocks()):
+        reduced[:, positions] = components.T @ block
+    return reduced
+
+
+def merge(reduced, other, dimension):
+    ''' MIGP update: the first dimension principal components of the
+        stacked rows of two reduced data sets. reduced is None before the
+        first subject '''
+    if reduced is None:
+        return other
+    stacked = np.concatenate([reduced, other]).astype(np.float64)
+    components = _top_eigenvectors(stacked @ stacked.T, dimension)
+    return (components.T @ stacked).astype(np.float32)
+
+
+def _reduce_file(dtseries_file, dimension, columns, normalize):
+    return reduce_subject(load(dtseries_file), dimension, columns, normalize)
+
+
+def migp(dtseries_files, dimension, gathers=None, normalize='zscore',
+         n_jobs=1):
+    ''' Group PCA of many dtseries by MELODIC's Incremental Group PCA.
+
+        Each subject is reduced to its first dimension temporal components
+        (see reduce_subject) by one of n_jobs processes, and merged with the
+        running reduction of the previous subjects in the order of
+        dtseries_files, so the result does not depend on n_jobs. At most
+        two subjects per process are waiting to be merged, so memory is
+        bounded by (dimension, grayordinates) arrays, whatever the number
+        of subjects. gathers holds the columns of the grayordinates kept
+        in each dtseries (see reduce_subject), None keeps all of them.
+
+        Returns
+        -------
+        reduced: array
+            (dimension, grayordinates) approximation of S V^T of the SVD of
+            the concatenated time series of all the subjects '''
+    if gathers is None:
+        gathers = [None] * len(dtseries_files)
+    arguments = [(f, dimension, columns, normalize)
+                 for f, columns in zip(dtseries_files, gathers)]
+
+    reduced = None
+    if n_jobs == 1:
+        for args in arguments:
+            reduced = merge(reduced, _reduce_file(*args), dimension)
+        return reduced
+
+    with ProcessPoolExecutor(n_jobs) as pool:
+        pending = deque()
+        for args in arguments:
+            pending.append(pool.submit(_reduce_file, *args))
+            if len(pending) > 2 * n_jobs:
+                reduced = merge(reduced, pending.popleft().result(),
+                                dimension)
+        while pending:
+            reduced = merge(reduced, pending.popleft().result(), dimension)
+    return reduced
+
+
+def spatial_maps(reduced, n_components):
+    ''' The first n_components rows of a reduction, i.e. the spatial
+        principal components scaled by their singular values, with the
+        sign that makes the largest entry of each one positive '''
+    maps = reduced[:n_components].astype(np.float32)
+    largest = np.abs(maps).argmax(axis=1)
+    signs = np.sign(maps[np.arange(len(maps)), largest])
+    signs[signs == 0] = 1
+    return maps * signs[:, None]
+
+
+def maps_image(dtseries, brain_models, n_components):
+    ''' Image describing the output dscalar: one map per component along
+        the rows, the common brain models of the inputs along the
+        columns '''
+    names = ['component {}'.format(i + 1) for i in range(n_components)]
+    volume_shape, affine = None, np.eye(4)
+    volume = dtseries.column.volume
+    if volume is not None:
+        volume_shape = tuple(volume.volume_dimensions)
+        affine = volume.transformation_matrix_voxel_indices_ijk_to_xyz.matrix
+
+    n_grayordinates = sum(bm.index_count for bm in brain_models)
+    return build_cifti.dscalar(stream.empty((n_components, n_grayordinates)),
+                               brain_models, names, volume_shape, affine)
+
+
+@profiling.profiled('group_pca')
+def group_pca(dtseries_files, outfile, n_components, dimension=None,
+              normalize='zscore', n_jobs=1):
+    ''' Computes the spatial principal components of the concatenated time
+        series of many dtseries, over the grayordinates that all of them
+        share, and writes them as a dscalar.
+
+        The subjects are never concatenated: each one is streamed from
+        disk and reduced by one of n_jobs processes, and the reductions are
+        merged incrementally (MIGP, see migp), so memory is bounded by the
+        dimension of the reduction and not by the number of subjects.
+
+        Parameters
+        ----------
+        dtseries_files: list
+            dtseries files, of any number of frames
+        outfile: str
+            output dscalar, one map per component
+        n_components: int
+            number of components written
+        dimension: int
+            number of components kept while merging subjects, the larger
+            the more accurate. 2 * n_components if None
+        normalize: str
+            one of preprocessing.NORMALIZATIONS applied to each time series
+            of each subject, None to use them as they are
+        n_jobs: int
+            number of processes reducing subjects '''
+    if dimension is None:
+        dimension = 2 * n_components
+    check_input(dtseries_files, outfile, n_components, dimension)
+
+    dtseries = [load(f) for f in dtseries_files]
+    with profiling.stage('intersection'):
+        brain_models, gathers = intersection.intersect_brain_models(
+            dtseries, "COLUMN")
+    if sum(bm.index_count for bm in brain_models) == 0:
+        raise ValueError("The dtseries have no grayordinates in common")
+    gathers = [None if intersection.is_identity(g, d.shape[-1]) else g
+               for g, d in zip(gathers, dtseries)]
+    image = maps_image(dtseries[0], brain_models, n_components)
+    del dtseries
+
+    with profiling.stage('migp'):
+        reduced = migp(dtseries_files, dimension, gathers, normalize, n_jobs)
+
+    if len(reduced) < n_components:
+        raise ValueError("The dtseries have only {} frames in total, less "
+                         "than n_components".format(len(reduced)))
+
+    stream.write_blocks(outfile, image, spatial_maps(reduced, n_components),
+                        axis=0)
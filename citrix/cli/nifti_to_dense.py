@@ -0,0 +1,140 @@
+''' Tool to sample (4D) nifti volumes into dtseries or dscalar files '''
+import copy
+import os
+
+import nibabel
+import numpy as np
+
+from .. import gifti, load, models, profiling, sampling, stream
+from ..build import cifti as build_cifti
+from .dtseries_to_nifti import load_surface
+
+# Memory used by each block of frames read at a time
+BLOCK_BYTES = 2 ** 27
+
+DENSE_INTENTS = {'dtseries': 'NIFTI_INTENT_CONNECTIVITY_DENSE_SERIES',
+                 'dscalar': 'NIFTI_INTENT_CONNECTIVITY_DENSE_SCALARS'}
+
+
+def file_type(filename):
+    if filename.endswith('.gz'):
+        filename = filename[:-len('.gz')]
+    return filename.split('.')[-2]
+
+
+def check_input(infile, template_file, outfile, method):
+
+    if not (infile.endswith('.nii') or infile.endswith('.nii.gz')):
+        raise ValueError("infile should end with '.nii' or '.nii.gz'")
+
+    if file_type(outfile) not in DENSE_INTENTS:
+        raise ValueError("outfile should be a dtseries or a dscalar file")
+
+    if not os.path.exists(template_file):
+        raise ValueError('The file {} does not exist'.format(template_file))
+
+    if method not in sampling.METHODS:
+        raise ValueError('method should be one of {}'.format(sampling.METHODS))
+
+
+def dense_image(template, n_frames, dense_type, step=1.):
+    ''' Image describing the output: the frames (as a series or as
+        scalars) along the rows, the brain models of the template along
+        the columns '''
+    if dense_type == 'dtseries':
+        frames = build_cifti.series_map(n_frames, step)
+    else:
+        frames = build_cifti.scalars_map([str(i) for i in range(n_frames)])
+
+    brain_models = copy.deepcopy(template.column)
+    brain_models.applies_to_matrix_dimension = [1]
+
+    matrix = nibabel.cifti2.Cifti2Matrix()
+    matrix.append(frames)
+    matrix.append(brain_models)
+    header = nibabel.cifti2.Cifti2Header(matrix)
+
+    n_grayordinates = len(template.grayordinates("COLUMN"))
+    image = nibabel.Cifti2Image(stream.empty((n_frames, n_grayordinates)),
+                                header)
+    image.nifti_header.set_intent(DENSE_INTENTS[dense_type])
+    return image
+
+
+def sampled_blocks(nifti, sampler, frames_per_block):
+    ''' Yields the (frames, grayordinates) samples of blocks of frames of
+        the nifti. NIFTI frames are contiguous on disk, so each block is a
+        single sequential read '''
+    dataobj = nifti.dataobj
+    n_voxels = int(np.prod(nifti.shape[:3]))
+    n_frames = nifti.shape[3] if len(nifti.shape) > 3 else 1
+
+    for start in range(0, n_frames, frames_per_block):
+        stop = min(start + frames_per_block, n_frames)
+        if len(nifti.shape) > 3:
+            block = dataobj[..., start:stop]
+        else:
+            block = dataobj[...]
+        block = np.asarray(block, dtype=np.float32)
+        block = block.reshape((n_voxels, stop - start), order='F')
+        yield np.asarray(sampler @ block).T
+
+
+@profiling.profiled('nifti_to_dense')
+def nifti_to_dense(nifti_file, template_file, outfile, surface_files=None,
+                   method='trilinear', frames_per_block=None):
+    ''' Samples a (4D) nifti file at the grayordinates of a template cifti,
+        writing a dtseries or a dscalar (following the extension of
+        outfile).
+
+        Vertices are sampled at their coordinates on the given surfaces,
+        voxel grayordinates at their voxel centers. The sampling weights
+        are computed once as a sparse matrix, and the volume is read in
+        blocks of frames, so a whole run takes a single pass over disk.
+
+        Parameters
+        ----------
+        nifti_file: str
+            3D or 4D nifti file
+        template_file: str
+            cifti file whose (column) brain models are sampled
+        outfile: str
+            output dtseries or dscalar file
+        surface_files: list
+            surfaces of the cortical structures of the template, or a
+            dictionary of loaded surfaces (see gifti.load_surfaces)
+        method: str
+            'trilinear' or 'nearest', see sampling.sampling_matrix
+        frames_per_block: int
+            frames read at a time, by default blocks take about BLOCK_BYTES '''
+    check_input(nifti_file, template_file, outfile, method)
+
+    nifti = load(nifti_file)
+    template = load(template_file)
+    grayordinates = template.grayordinates("COLUMN")
+
+    if surface_files is None:
+        surface_files = {}
+    elif not isinstance(surface_files, dict):
+        surface_files = gifti.surfaces_by_structure(surface_files)
+    surfaces = {s: load_surface(surface_files, s)
+                for s in grayordinates.structures
+                if grayordinates.model_type(s) == models.SURFACE}
+
+    with profiling.stage('sampler'):
+        sampler = sampling.grayordinate_sampler(grayordinates, surfaces,
+                                                nifti.affine, nifti.shape[:3],
+                                                method)
+
+    n_voxels = int(np.prod(nifti.shape[:3]))
+    n_frames = nifti.shape[3] if len(nifti.shape) > 3 else 1
+    if frames_per_block is None:
+        frames_per_block = max(1, BLOCK_BYTES // (4 * n_voxels))
+
+    zooms = nifti.header.get_zooms()
+    step = float(zooms[3]) if len(zooms) > 3 and zooms[3] > 0 else 1.
+
+    image = dense_image(template, n_frames, file_type(outfile), step)
+    stream.write_blocks(outfile, image,
+                        sampled_blocks(nifti, sampler, frames_per_block),
+                        axis=0)
@@ -0,0 +1,118 @@
+''' Tool to reduce dense cifti data to the parcels of a dlabel '''
+import copy
+
+import nibabel
+import numpy as np
+
+from .. import load, profiling, stream
+from ..parcellation import Parcellation, REDUCERS
+
+# Memory used by each block of frames read at a time
+BLOCK_BYTES = 2 ** 27
+
+# Parcellated counterpart of each dense file type, with its intent
+PARCELLATED_TYPES = {'dtseries': ('ptseries',
+                                  'NIFTI_INTENT_CONNECTIVITY_PARCELLATED_SERIES'),
+                     'dscalar': ('pscalar',
+                                 'NIFTI_INTENT_CONNECTIVITY_PARCELLATED_SCALAR')}
+
+
+def file_type(filename):
+    if filename.endswith('.gz'):
+        filename = filename[:-len('.gz')]
+    return filename.split('.')[-2]
+
+
+def check_input(dense_file, dlabel_file, outfile, reducer):
+
+    dense_type = file_type(dense_file)
+    if dense_type not in PARCELLATED_TYPES:
+        raise ValueError("The dense file should be a dtseries or a dscalar")
+
+    if file_type(dlabel_file) != 'dlabel':
+        raise ValueError("dlabel file should end with 'dlabel.nii' or 'dlabel.nii.gz'")
+
+    if file_type(outfile) != PARCELLATED_TYPES[dense_type][0]:
+        raise ValueError("The parcellation of a {} should be a {}".format(
+            dense_type, PARCELLATED_TYPES[dense_type][0]))
+
+    if reducer not in REDUCERS:
+        raise ValueError('reducer should be one of {}'.format(REDUCERS))
+
+
+def frame_blocks(dense, frames_per_block):
+    ''' Yields (frames, grayordinates) blocks of the dense data '''
+    data = dense.memmap
+    if data is None:
+        data = dense.dataobj
+    if len(data.shape) == 1:
+        data = data.reshape((1, data.shape[0]))
+
+    for start in range(0, data.shape[0], frames_per_block):
+        yield np.asarray(data[start:start + frames_per_block],
+                         dtype=np.float64)
+
+
+def parcellated_image(dense, parcellation, intent):
+    ''' Image describing the parcellated data: the first dimension of the
+        dense data (series or scalars) and the parcels '''
+    n_frames = 1 if len(dense.shape) == 1 else dense.shape[0]
+
+    matrix = nibabel.cifti2.Cifti2Matrix()
+    matrix.append(copy.deepcopy(dense.row))
+    matrix.append(parcellation.index_map)
+    header = nibabel.cifti2.Cifti2Header(matrix)
+
+    image = nibabel.Cifti2Image(stream.empty((n_frames, len(parcellation))),
+                                header)
+    image.nifti_header.set_intent(intent)
+    return image
+
+
+@profiling.profiled('parcellate')
+def parcellate(dense_file, dlabel_file, outfile, reducer='mean',
+               frames_per_block=None):
+    ''' Reduces a dtseries (dscalar) to a ptseries (pscalar), summarizing
+        the grayordinates of each parcel of a dlabel.
+
+        The parcellation is built once from the brain models of both files
+        and applied to blocks of frames, so memory usage does not depend on
+        the length of the data. The mean is one sparse matmul per block;
+        'pc1' reads the data twice, once to find the principal components
+        and once to project onto them.
+
+        Parameters
+        ----------
+        dense_file: str
+            dtseries or dscalar file
+        dlabel_file: str
+            dlabel file, its first map defines the parcels
+        outfile: str
+            ptseries or pscalar file
+        reducer: str
+            'mean', 'median' or 'pc1'
+        frames_per_block: int
+            frames read at a time, by default blocks take about BLOCK_BYTES '''
+    check_input(dense_file, dlabel_file, outfile, reducer)
+
+    dense = load(dense_file)
+    with profiling.stage('parcellation'):
+        parcellation = Parcellation(load(dlabel_file), dense)
+
+    if frames_per_block is None:
+        frames_per_block = max(1, BLOCK_BYTES // (8 * dense.shape[-1]))
+
+    blocks = frame_blocks(dense, frames_per_block)
+    if reducer == 'mean':
+        reduced = (parcellation.mean(b) for b in blocks)
+    elif reducer == 'median':
+        reduced = (parcellation.median(b) for b in blocks)
+    else:
+        with profiling.stage('principal_components'):
+            means, weights = parcellation.principal_components(blocks)
+        reduced = (parcellation.project(b, means, weights)
+                   for b in frame_blocks(dense, frames_per_block))
+
+    intent = PARCELLATED_TYPES[file_type(dense_file)][1]
+    image = parcellated_image(dense, parcellation, intent)
+    stream.write_blocks(outfile, image, reduced, axis=0)
@@ -0,0 +1,101 @@
+''' Tool to detrend, filter, regress out confounds from and normalize the
+    time series of a dtseries '''
+import nibabel
+import numpy as np
+
+from .. import load, preprocessing, profiling, stream
+
+
+def check_input(infile, outfile):
+
+    for name in (infile, outfile):
+        if not (name.endswith('.dtseries.nii')
+                or name.endswith('.dtseries.nii.gz')):
+            raise ValueError("{} should end with 'dtseries.nii' or "
+                             "'dtseries.nii.gz'".format(name))
+
+
+def repetition_time(dtseries):
+    ''' Time between two frames of a dtseries, in seconds '''
+    series = dtseries.row
+    if series.series_unit != 'SECOND':
+        raise ValueError("The frames of the dtseries should be in seconds")
+    return series.series_step * 10 ** series.series_exponent
+
+
+def pipeline(n_frames, tr, detrend=None, low=None, high=None,
+             confounds=None, normalize=None):
+    ''' preprocessing.Pipeline of the requested stages, in the order
+        detrend, bandpass, regress, normalize. The confounds go through the
+        detrending and the filtering too, so that the regression does not
+        bring back what they removed '''
+    stages = []
+    if detrend is not None:
+        stages.append(preprocessing.detrend(detrend))
+    if low is not None or high is not None:
+        stages.append(preprocessing.bandpass(low, high, tr))
+
+    if confounds is not None:
+        confounds = np.asarray(confounds, dtype=np.float64)
+        if confounds.ndim == 1:
+            confounds = confounds[:, None]
+        if len(confounds) != n_frames:
+            raise ValueError("The confounds have {} frames and the dtseries "
+                             "{}".format(len(confounds), n_frames))
+        confounds = preprocessing.Pipeline(stages)(confounds)
+        stages.append(preprocessing.regress(confounds))
+
+    if normalize is not None:
+        stages.append(preprocessing.normalize(normalize))
+    return preprocessing.Pipeline(stages)
+
+
+@profiling.profiled('preprocess')
+def preprocess(dtseries_file, outfile, detrend=None, low=None, high=None,
+               confounds=None, normalize=None, n_jobs=1,
+               columns_per_block=None):
+    ''' Applies temporal preprocessing to the time series of a dtseries.
+
+        The dtseries is read in blocks of grayordinates, each block goes
+        through the stages on one of n_jobs threads and is streamed to the
+        output as soon as it is done, so memory is bounded by a few blocks
+        whatever the length of the run.
+
+        Parameters
+        ----------
+        dtseries_file: str
+            input dtseries
+        outfile: str
+            output dtseries, compressed if it ends with .gz
+        detrend: int
+            order of the polynomial trend removed, None to keep it
+        low, high: float
+            cut-off frequencies of the Butterworth filter, in Hz. Only low
+            for a high-pass filter, only high for a low-pass one
+        confounds: array
+            (frames, regressors) nuisance time series regressed out
+        normalize: str
+            one of preprocessing.NORMALIZATIONS, None to keep the scale
+        n_jobs: int
+            number of threads processing blocks
+        columns_per_block: int
+            grayordinates per block, by default blocks take about
+            preprocessing.BLOCK_BYTES '''
+    check_input(dtseries_file, outfile)
+
+    dtseries = load(dtseries_file)
+    if len(dtseries.shape) != 2:
+        raise ValueError("The dtseries needs more than one frame")
+
+    tr = None
+    if low is not None or high is not None:
+        tr = repetition_time(dtseries)
+    stages = pipeline(dtseries.shape[0], tr, detrend, low, high, confounds,
+                      normalize)
+
+    image = nibabel.Cifti2Image(stream.empty(dtseries.shape),
+                                dtseries.header, dtseries.nifti_header,
+                                dtype=np.float32)
+    blocks = stages.blocks(dtseries, n_jobs, columns_per_block)
+    stream.write_blocks(outfile, image, (block for _, block in blocks),
+                        axis=-1)
@@ -0,0 +1,98 @@
+''' Tool to smooth dtseries and dscalar files '''
+import nibabel
+import numpy as np
+
+from .. import gifti, load, models, profiling, smoothing, stream
+from .dtseries_to_nifti import load_surface
+
+# Memory used by each block of frames read at a time
+BLOCK_BYTES = 2 ** 27
+
+
+def check_input(infile, outfile):
+
+    def file_type(name):
+        if name.endswith('.gz'):
+            name = name[:-len('.gz')]
+        return name.split('.')[-2]
+
+    if file_type(infile) not in ['dtseries', 'dscalar']:
+        raise ValueError("The input should be a dtseries or a dscalar file")
+
+    if file_type(outfile) != file_type(infile):
+        raise ValueError('The output file MUST be of the same type as the input')
+
+
+def smoothing_kernel(dense, surface_files, fwhm, volume_fwhm=None):
+    ''' Smoothing operator of the grayordinates of a dense cifti, see
+        smoothing.grayordinate_kernel. surface_files is a list of files or a
+        dictionary of loaded surfaces (see gifti.load_surfaces) '''
+    if surface_files is None:
+        surface_files = {}
+    elif not isinstance(surface_files, dict):
+        surface_files = gifti.surfaces_by_structure(surface_files)
+
+    grayordinates = dense.grayordinates("COLUMN")
+    surfaces = {s: load_surface(surface_files, s)
+                for s in grayordinates.structures
+                if grayordinates.model_type(s) == models.SURFACE}
+    return smoothing.grayordinate_kernel(grayordinates, surfaces, fwhm,
+                                         volume_fwhm)
+
+
+def smoothed_blocks(dense, kernel, frames_per_block):
+    ''' Yields the smoothed (frames, grayordinates) blocks of a dense cifti,
+        each block smoothed with a single sparse-dense product '''
+    data = dense.memmap
+    if data is None:
+        data = dense.dataobj
+    if len(data.shape) == 1:
+        data = data.reshape((1, data.shape[0]))
+
+    for start in range(0, data.shape[0], frames_per_block):
+        block = np.asarray(data[start:start + frames_per_block],
+                           dtype=np.float32)
+        yield np.asarray(kernel @ block.T).T
+
+
+@profiling.profiled('smooth')
+def smooth(dense_file, outfile, fwhm, surface_files=None, volume_fwhm=None,
+           frames_per_block=None):
+    ''' Smooths a dtseries or dscalar with a Gaussian kernel.
+
+        Cortical grayordinates are smoothed along their surfaces, and
+        volume grayordinates within the volume, in the same pass: the
+        kernel is built once as a sparse matrix and applied to blocks of
+        frames that are streamed to the output, so long runs are never
+        held in memory.
+
+        Parameters
+        ----------
+        dense_file: str
+            dtseries or dscalar file
+        outfile: str
+            output, of the same type as the input
+        fwhm: float
+            FWHM of the surface kernel, in mm
+        surface_files: list
+            surfaces of the cortical structures of the input
+        volume_fwhm: float
+            FWHM of the volume kernel, in mm. fwhm if None
+        frames_per_block: int
+            frames smoothed at a time, by default blocks take about
+            BLOCK_BYTES '''
+    check_input(dense_file, outfile)
+
+    dense = load(dense_file)
+    with profiling.stage('kernel'):
+        kernel = smoothing_kernel(dense, surface_files, fwhm, volume_fwhm)
+
+    if frames_per_block is None:
+        frames_per_block = max(1, BLOCK_BYTES // (4 * dense.shape[-1]))
+
+    shape = (1, dense.shape[0]) if len(dense.shape) == 1 else dense.shape
+    image = nibabel.Cifti2Image(stream.empty(shape), dense.header,
+                                dense.nifti_header, dtype=np.float32)
+    stream.write_blocks(outfile, image,
+                        smoothed_blocks(dense, kernel, frames_per_block),
+                        axis=0)
@@ -0,0 +1,49 @@
+''' Tool to keep the strongest connections of a dconn in a sparse file '''
+from .. import connectivity, load, profiling
+
+
+def check_input(infile, outfile, top_k, threshold):
+
+    if not (infile.endswith('.dconn.nii') or infile.endswith('.dconn.nii.gz')):
+        raise ValueError("infile should end with 'dconn.nii' or 'dconn.nii.gz'")
+
+    if not outfile.endswith('.npz'):
+        raise ValueError("outfile should end with '.npz'")
+
+    if top_k is None and threshold is None:
+        raise ValueError("top_k, threshold or both should be given")
+
+
+@profiling.profiled('sparsify_dconn')
+def sparsify_dconn(dconn_file, outfile, top_k=None, threshold=None,
+                   absolute=False, exclude_diagonal=False, compressed=False):
+    ''' Keeps the top_k strongest entries of each row of a dconn, and/or
+        those above a threshold, in a sparse file that citrix.load reads
+        back as a connectivity.SparseDenseConnectivity.
+
+        The dconn is read once, in blocks of columns, so it never needs to
+        fit in memory (see connectivity.sparsify).
+
+        Parameters
+        ----------
+        dconn_file: str
+            dconn file
+        outfile: str
+            output, a .npz file holding the CSR matrix and the CIFTI header
+        top_k: int
+            number of entries kept per row
+        threshold: float
+            only entries of at least threshold are kept
+        absolute: bool
+            whether entries are ranked by their absolute value
+        exclude_diagonal: bool
+            whether to drop the connection of each grayordinate with itself
+        compressed: bool
+            whether the .npz file is compressed '''
+    check_input(dconn_file, outfile, top_k, threshold)
+
+    dconn = load(dconn_file)
+    sparse_dconn = connectivity.sparsify(dconn, top_k, threshold, absolute,
+                                         exclude_diagonal)
+    with profiling.stage('write'):
+        sparse_dconn.save(outfile, compressed)
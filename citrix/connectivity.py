@@ -0,0 +1,226 @@
+''' Sparse (thresholded or top-k) dense connectivity matrices '''
+import os
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+from nibabel.cifti2.parse_cifti2 import Cifti2Extension
+
+from . import stream
+from .cifti import Cifti
+from .utils import CIFTI_EXTENSION_CODE
+
+# Memory used by each block of columns read from the dense matrix
+BLOCK_BYTES = 2 ** 27
+
+# Identifies the files written by SparseDenseConnectivity.save
+FORMAT = 'citrix.sparse_dconn'
+VERSION = 1
+
+
+def column_blocks(dconn, block_bytes=BLOCK_BYTES):
+    ''' Yields (start, columns [start, stop)) of a dconn. CIFTI matrices
+        are stored column-major, so the blocks come from a single
+        sequential pass over the file, compressed or not (see
+        stream.column_blocks) '''
+    data = dconn.memmap
+    if data is None:
+        data = dconn.dataobj
+
+    for start, block in stream.column_blocks(data, block_bytes=block_bytes):
+        yield start, np.asarray(block, dtype=np.float32)
+
+
+def _scores(block, start, threshold, absolute, exclude_diagonal):
+    ''' Ranking score of each entry of a block of columns, -inf for the
+        entries that can not be kept '''
+    scores = np.abs(block) if absolute else block.copy()
+    scores[np.isnan(scores)] = -np.inf
+    if threshold is not None:
+        scores[scores < threshold] = -np.inf
+    if exclude_diagonal:
+        columns = np.arange(start, start + block.shape[1])
+        inside = columns < block.shape[0]
+        scores[columns[inside], np.flatnonzero(inside)] = -np.inf
+    return scores
+
+
+def _merge_top_k(best_scores, best_columns, best_values, scores, block,
+                 columns):
+    ''' Updates in place the k best (scores, columns, values) of some rows
+        with the entries of a block of columns '''
+    top_k = best_scores.shape[1]
+    candidates = np.concatenate([best_scores, scores], axis=1)
+    best = np.argpartition(candidates, candidates.shape[1] - top_k,
+                           axis=1)[:, -top_k:]
+    from_block = best >= top_k
+    block_best = np.where(from_block, best - top_k, 0)
+    previous = np.minimum(best, top_k - 1)
+
+    best_columns[...] = np.where(
+        from_block, columns[block_best],
+        np.take_along_axis(best_columns, previous, axis=1))
+    best_values[...] = np.where(
+        from_block, np.take_along_axis(block, block_best, axis=1),
+        np.take_along_axis(best_values, previous, axis=1))
+    best_scores[...] = np.take_along_axis(candidates, best, axis=1)
+
+
+def sparsify(dconn, top_k=None, threshold=None, absolute=False,
+             exclude_diagonal=False, block_bytes=BLOCK_BYTES):
+    ''' Keeps the strongest entries of each row of a dconn.
+
+        The matrix is read once, in blocks of columns. With top_k, the k
+        best entries of each row seen so far are merged with each block,
+        so memory is (rows, k) plus a block; with threshold alone, the
+        entries above it are gathered block by block.
+
+        Parameters
+        ----------
+        dconn: citrix.cifti.DenseDenseConnectivity
+            matrix to sparsify, never loaded as a whole
+        top_k: int
+            number of entries kept per row
+        threshold: float
+            only entries of at least threshold are kept
+        absolute: bool
+            whether entries are ranked (and thresholded) by their absolute
+            value, so that strong anticorrelations are kept too
+        exclude_diagonal: bool
+            whether to drop the entry of each grayordinate with itself
+
+        Returns
+        -------
+        sparse_dconn: SparseDenseConnectivity'''
+    if top_k is None and threshold is None:
+        raise ValueError("top_k, threshold or both should be given")
+    if top_k is not None and top_k < 1:
+        raise ValueError("top_k should be positive")
+
+    n_rows, n_columns = dconn.shape
+    rows = np.arange(n_rows)[:, None]
+
+    if top_k is not None:
+        top_k = min(top_k, n_columns)
+        best_scores = np.full((n_rows, top_k), -np.inf, dtype=np.float32)
+        best_columns = np.zeros((n_rows, top_k), dtype=np.int64)
+        best_values = np.zeros((n_rows, top_k), dtype=np.float32)
+    else:
+        triplets = []
+
+    for start, block in column_blocks(dconn, block_bytes):
+        scores = _scores(block, start, threshold, absolute, exclude_diagonal)
+
+        if top_k is None:
+            r, c = np.nonzero(scores > -np.inf)
+            triplets.append((r, c + start, block[r, c]))
+            continue
+
+        # merged a few rows at a time, to bound the temporaries
+        columns = np.arange(start, start + block.shape[1])
+        step = max(1, block_bytes // (8 * (top_k + block.shape[1])))
+        for r in range(0, n_rows, step):
+            chunk = slice(r, r + step)
+            _merge_top_k(best_scores[chunk], best_columns[chunk],
+                         best_values[chunk], scores[chunk], block[chunk],
+                         columns)
+
+    if top_k is not None:
+        kept = best_scores > -np.inf
+        triplets = [(np.broadcast_to(rows, kept.shape)[kept],
+                     best_columns[kept], best_values[kept])]
+
+    r, c, values = (np.concatenate(t) for t in zip(*triplets))
+    matrix = sparse.csr_matrix((values.astype(np.float32), (r, c)),
+                               shape=(n_rows, n_columns))
+    matrix.sort_indices()
+    return SparseDenseConnectivity(matrix, dconn.header)
+
+
+class SparseDenseConnectivity:
+    """Dense connectivity matrix of which only some entries are kept (see
+       sparsify), as a scipy CSR matrix along with the CIFTI header that
+       describes its rows and columns.
+
+       Rows are read as from a DenseDenseConnectivity, and the matrix can
+       be multiplied with the @ operator (e.g. by a (grayordinates,
+       frames) array) without ever being made dense"""
+
+    # the brain models are described as in dense ciftis
+    row = Cifti.row
+    column = Cifti.column
+    grayordinates = Cifti.grayordinates
+
+    # numpy arrays defer to __rmatmul__ instead of wrapping the object
+    __array_ufunc__ = None
+
+    def __init__(self, matrix, header):
+        matrix = sparse.csr_matrix(matrix)
+        if matrix.shape != tuple(header.matrix.get_data_shape()):
+            raise ValueError("The matrix and the header have different "
+                             "shapes")
+        self.matrix = matrix
+        self.header = header
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def nnz(self):
+        return self.matrix.nnz
+
+    def read_row(self, i):
+        """Returns the i-th row of the matrix, with zeros for the entries
+           that were not kept"""
+        return self.read_rows([i])[0]
+
+    def read_rows(self, indices):
+        """Returns the rows of the matrix in indices, as a 2D array"""
+        return self.matrix[np.asarray(indices, dtype=int)].toarray()
+
+    def __matmul__(self, other):
+        return self.matrix @ other
+
+    def __rmatmul__(self, other):
+        return other @ self.matrix
+
+    def save(self, filename, compressed=False):
+        """Writes the matrix and the CIFTI XML of its header to a .npz
+           file, which load reads back"""
+        directory = os.path.dirname(filename) or '.'
+        fd, temporary = tempfile.mkstemp(suffix='.npz', dir=directory)
+        os.close(fd)
+
+        arrays = dict(format=np.array(FORMAT), version=np.array(VERSION),
+                      shape=np.array(self.shape, dtype=np.int64),
+                      data=self.matrix.data, indices=self.matrix.indices,
+                      indptr=self.matrix.indptr,
+                      cifti_header=np.frombuffer(self.header.to_xml(),
+                                                 dtype=np.uint8))
+        try:
+            with open(temporary, 'wb') as f:
+                (np.savez_compressed if compressed else np.savez)(f, **arrays)
+            os.replace(temporary, filename)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+
+def load(filename):
+    """Reads a SparseDenseConnectivity written by its save method"""
+    with np.load(filename, allow_pickle=False) as arrays:
+        if 'format' not in arrays or str(arrays['format']) != FORMAT:
+            raise ValueError("{} is not a sparse dconn file".format(filename))
+        if int(arrays['version']) > VERSION:
+            raise ValueError("{} was written by a newer version of "
+                             "citrix".format(filename))
+
+        matrix = sparse.csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=tuple(arrays['shape']))
+        xml = arrays['cifti_header'].tobytes()
+
+    header = Cifti2Extension(CIFTI_EXTENSION_CODE, xml).get_content()
+    return SparseDenseConnectivity(matrix, header)
@@ -1,12 +1,17 @@
+from collections.abc import Mapping
+import re
 from warnings import warn
+import xml.etree.ElementTree as ET
 
 import numpy as np
 
 import nibabel
-import nimesh
 
-from . import models, structures
+from . import models, profiling, structures
 
+STRUCTURE_KEY = 'AnatomicalStructurePrimary'
+
+@profiling.profiled('gifti.load')
 def load(filename):
     gifti_file_types = {'.surf.gii': GiftiMesh,
                         '.func.gii': GiftiFunction}
@@ -20,6 +25,49 @@ def load(filename):
     return nibabel.load(filename)
 
 
+def cifti_structure(gifti_structure):
+    """Translates a GIFTI structure name (e.g. CortexLeft) to its CIFTI
+       counterpart (e.g. CIFTI_STRUCTURE_CORTEX_LEFT)"""
+    if gifti_structure is None:
+        return None
+    name = re.sub('(?<!^)(?=[A-Z])', '_', gifti_structure).upper()
+    structure = 'CIFTI_STRUCTURE_' + name
+    if structure in structures.STRUCTURES:
+        return structure
+    return None
+
+
+def read_brain_structure(filename):
+    """Reads the brain structure of a GIFTI file from its metadata.
+
+       The file is parsed only up to the first data array, so no data is
+       ever decoded. Returns None if the file does not declare its
+       structure"""
+    name = None
+    with open(filename, 'rb') as fileobj:
+        for event, element in ET.iterparse(fileobj, events=('start', 'end')):
+            if event == 'start' and element.tag == 'Data':
+                break
+            if event == 'end' and element.tag == 'MD':
+                if element.findtext('Name') == STRUCTURE_KEY:
+                    name = element.findtext('Value')
+                    break
+    return cifti_structure(name)
+
+
+def surfaces_by_structure(filenames):
+    """Maps the brain structure of each GIFTI file to its filename,
+       reading only the headers of the files"""
+    return {read_brain_structure(f): f for f in filenames}
+
+
+def load_surfaces(filenames):
+    """Loads GIFTI surfaces, mapping the brain structure of each to the
+       loaded surface"""
+    return {structure: load(f)
+            for structure, f in surfaces_by_structure(filenames).items()}
+
+
 class Gifti(nibabel.gifti.GiftiImage):
 
     @property
@@ -28,15 +76,18 @@ class Gifti(nibabel.gifti.GiftiImage):
 
     @property
     def brain_structure(self):
-        str_xml = str(self.to_xml())
-
-        structure = None
-        if 'CortexLeft' in str_xml:
-            structure = structures.CORTEX_LEFT
-        elif 'CortexRight' in str_xml:
-            structure = structures.CORTEX_RIGHT
-
-        return structure
+        """CIFTI structure of the file, taken from the metadata of the file
+           or of its data arrays"""
+        if not hasattr(self, '_brain_structure'):
+            name = None
+            for meta in [self.meta] + [d.meta for d in self.darrays]:
+                meta = meta if isinstance(meta, Mapping) else meta.metadata
+                if STRUCTURE_KEY in meta:
+                    name = meta[STRUCTURE_KEY]
+                    break
+            self._brain_structure = cifti_structure(name)
+
+        return self._brain_structure
 
     def save(self, filename):
         self.to_filename(filename)
@@ -68,3 +119,89 @@ class GiftiMesh(Gifti):
     @property
     def triangles(self):
         return self.darrays[1].data
+
+    @property
+    def adjacency(self):
+        """Sparse (CSR) vertex adjacency matrix of the mesh, with a 1 for
+           each edge in both directions. It is built on first use, in a
+           single pass over the triangles, and cached"""
+        if not hasattr(self, '_adjacency'):
+            self._adjacency = mesh_adjacency(self.triangles, len(self.vertices))
+        return self._adjacency
+
+    def neighbors(self, vertex):
+        """Vertices sharing an edge with a vertex"""
+        adjacency = self.adjacency
+        return adjacency.indices[adjacency.indptr[vertex]:
+                                 adjacency.indptr[vertex + 1]]
+
+    def k_ring(self, vertices, k=1):
+        """Vertices at most k edges away from any of the given vertices,
+           the vertices themselves included"""
+        adjacency = self.adjacency
+        reached = np.zeros(adjacency.shape[0], dtype=bool)
+        reached[np.atleast_1d(vertices)] = True
+        frontier = reached.copy()
+        for _ in range(k):
+            frontier = (adjacency @ frontier.astype(np.int8) > 0) & ~reached
+            if not frontier.any():
+                break
+            reached |= frontier
+        return np.flatnonzero(reached)
+
+    def gaussian_kernel(self, fwhm):
+        """Sparse Gaussian smoothing kernel of the mesh, see
+           smoothing.surface_kernel. It is computed once per FWHM and
+           cached"""
+        # scipy.spatial is only imported when a kernel is needed
+        from . import smoothing
+
+        if not hasattr(self, '_kernels'):
+            self._kernels = {}
+        if fwhm not in self._kernels:
+            self._kernels[fwhm] = smoothing.surface_kernel(
+                self.vertices, self.adjacency, fwhm)
+        return self._kernels[fwhm]
+
+    def submesh(self, vertices):
+        """Mesh restricted to a subset of its vertices (e.g. those of a
+           cifti brain model, without the medial wall): the triangles with
+           all of their vertices in the subset are kept and renumbered
+           following the order of vertices"""
+        vertices = np.asarray(vertices, dtype=np.int64)
+        new_index = np.full(len(self.vertices), -1, dtype=np.int64)
+        new_index[vertices] = np.arange(len(vertices))
+
+        triangles = new_index[self.triangles]
+        triangles = triangles[np.all(triangles >= 0, axis=1)]
+
+        coordinates, faces = self.darrays[0], self.darrays[1]
+        darrays = [
+            nibabel.gifti.GiftiDataArray(
+                data=coordinates.data[vertices], intent=coordinates.intent,
+                datatype=coordinates.datatype, meta=coordinates.meta,
+                coordsys=coordinates.coordsys),
+            nibabel.gifti.GiftiDataArray(
+                data=triangles.astype(faces.data.dtype), intent=faces.intent,
+                datatype=faces.datatype, meta=faces.meta)
+        ]
+        return GiftiMesh(darrays=darrays, meta=self.meta)
+
+
+def mesh_adjacency(triangles, n_vertices):
+    """Sparse (CSR) adjacency matrix of the vertices of a triangle mesh.
+       Memory is proportional to the number of edges"""
+    from scipy import sparse
+
+    triangles = np.asarray(triangles, dtype=np.int64)
+    edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]],
+                            triangles[:, [2, 0]]])
+    rows = np.concatenate([edges[:, 0], edges[:, 1]])
+    columns = np.concatenate([edges[:, 1], edges[:, 0]])
+
+    adjacency = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int8), (rows, columns)),
+        shape=(n_vertices, n_vertices))
+    # edges shared by two triangles were summed
+    adjacency.data[:] = 1
+    return adjacency
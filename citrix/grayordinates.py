@@ -0,0 +1,123 @@
+''' Constant-time lookups between brain structures, vertices, voxels and
+    rows of a cifti matrix '''
+import numpy as np
+
+from . import indices, models
+
+
+class GrayordinateIndex:
+    """Array-backed index of a brain models axis of a cifti.
+
+       It is built once from the brain models: structures map to slices of
+       the axis, and lookup tables map vertices (per structure) and voxels
+       to positions along the axis, which are -1 for the vertices and
+       voxels that are not in the axis. All the lookups accept arrays, so
+       thousands of vertices or voxels are translated in a single call"""
+
+    def __init__(self, index_map):
+        if index_map.indices_map_to_data_type != indices.BRAIN_MODELS:
+            raise ValueError("The index map does not have brain models")
+
+        self.brain_models = list(index_map.brain_models)
+        self.volume = index_map.volume
+        self.volume_shape = None
+        if self.volume is not None:
+            self.volume_shape = tuple(self.volume.volume_dimensions)
+
+        self.structures = [bm.brain_structure for bm in self.brain_models]
+        self.offsets = np.array([bm.index_offset for bm in self.brain_models],
+                                dtype=np.int64)
+        self.counts = np.array([bm.index_count for bm in self.brain_models],
+                               dtype=np.int64)
+        self.size = int(self.counts.sum())
+        self._position = {s: i for i, s in enumerate(self.structures)}
+
+        self._vertices = {}
+        self._vertex_lut = {}
+        self._voxels = {}
+        self._voxel_lut = None
+
+        for bm in self.brain_models:
+            rows = np.arange(bm.index_offset, bm.index_offset + bm.index_count)
+            if bm.model_type == models.SURFACE:
+                vertices = np.asarray(bm.vertex_indices, dtype=np.int64)
+                lut = np.full(bm.surface_number_of_vertices, -1, dtype=np.int64)
+                lut[vertices] = rows
+                self._vertices[bm.brain_structure] = vertices
+                self._vertex_lut[bm.brain_structure] = lut
+            else:
+                voxels = np.asarray(bm.voxel_indices_ijk, dtype=np.int64)
+                self._voxels[bm.brain_structure] = voxels.reshape(-1, 3)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, structure):
+        return structure in self._position
+
+    def _check(self, structure):
+        if structure not in self._position:
+            raise ValueError("{} is not in the index".format(structure))
+        return self._position[structure]
+
+    def model_type(self, structure):
+        """Model type (surface or voxel) of a structure"""
+        return self.brain_models[self._check(structure)].model_type
+
+    def structure_slice(self, structure):
+        """Slice of the axis that corresponds to a structure"""
+        i = self._check(structure)
+        return slice(int(self.offsets[i]), int(self.offsets[i] + self.counts[i]))
+
+    def vertices(self, structure):
+        """Vertex indices of a surface structure, in the order of the axis"""
+        self._check(structure)
+        return self._vertices[structure]
+
+    def n_vertices(self, structure):
+        """Number of vertices of the mesh of a surface structure, including
+           those that are not in the axis (e.g. the medial wall)"""
+        self._check(structure)
+        return len(self._vertex_lut[structure])
+
+    def voxels(self, structure):
+        """(n, 3) voxel indices of a volume structure, in the order of the
+           axis"""
+        self._check(structure)
+        return self._voxels[structure]
+
+    def vertex_rows(self, structure, vertices):
+        """Positions along the axis of vertices of a surface structure"""
+        self._check(structure)
+        lut = self._vertex_lut[structure]
+        vertices = np.asarray(vertices, dtype=np.int64)
+        inside = (vertices >= 0) & (vertices < len(lut))
+        return np.where(inside, lut[np.where(inside, vertices, 0)], -1)
+
+    def voxel_rows(self, voxels):
+        """Positions along the axis of (..., 3) voxel indices"""
+        if self.volume_shape is None:
+            raise ValueError("The index has no volume")
+
+        if self._voxel_lut is None:
+            lut = np.full(int(np.prod(self.volume_shape)), -1, dtype=np.int64)
+            for structure, voxels_ijk in self._voxels.items():
+                flat = np.ravel_multi_index(tuple(voxels_ijk.T),
+                                            self.volume_shape)
+                rows = np.arange(len(voxels_ijk))
+                lut[flat] = self.structure_slice(structure).start + rows
+            self._voxel_lut = lut
+
+        voxels = np.asarray(voxels, dtype=np.int64)
+        inside = np.all((voxels >= 0) & (voxels < self.volume_shape), axis=-1)
+        flat = np.ravel_multi_index(tuple(np.moveaxis(voxels, -1, 0)),
+                                    self.volume_shape, mode='clip')
+        return np.where(inside, self._voxel_lut[flat], -1)
+
+    def row_structures(self, rows):
+        """Structure to which each position along the axis belongs"""
+        rows = np.asarray(rows, dtype=np.int64)
+        order = np.argsort(self.offsets)
+        position = order[np.searchsorted(self.offsets[order], rows,
+                                         side='right') - 1]
+        return np.asarray(self.structures, dtype=object)[position]
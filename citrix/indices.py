@@ -1,3 +1,5 @@
 LABELS = 'CIFTI_INDEX_TYPE_LABELS'
 BRAIN_MODELS = 'CIFTI_INDEX_TYPE_BRAIN_MODELS'
 PARCELS = 'CIFTI_INDEX_TYPE_PARCELS'
+SERIES = 'CIFTI_INDEX_TYPE_SERIES'
+SCALARS = 'CIFTI_INDEX_TYPE_SCALARS'
@@ -0,0 +1,137 @@
+''' Intersection of the brain models of several cifti files '''
+import copy
+
+import numpy as np
+
+import nibabel
+
+from . import indices, models, utils
+
+DIRECTIONS = ["ROW", "COLUMN"]
+
+
+def _grayordinate_keys(index, structure):
+    """Integer key of each grayordinate of a structure: the vertex index
+       for surfaces, the flat voxel index for volumes"""
+    if index.model_type(structure) == models.SURFACE:
+        return index.vertices(structure)
+    return np.ravel_multi_index(tuple(index.voxels(structure).T),
+                                index.volume_shape)
+
+
+def _same_volume(volume, other):
+    if volume is None or other is None:
+        return volume is other
+    return (tuple(volume.volume_dimensions) == tuple(other.volume_dimensions)
+            and np.allclose(
+                volume.transformation_matrix_voxel_indices_ijk_to_xyz.matrix,
+                other.transformation_matrix_voxel_indices_ijk_to_xyz.matrix))
+
+
+def intersect_brain_models(ciftis, direction):
+    """Intersects the brain models of several ciftis in a direction.
+
+       Parameters
+       ----------
+       ciftis: list
+           citrix.cifti.Cifti objects
+       direction: str
+           "ROW" or "COLUMN"
+
+       Returns
+       -------
+       brain_models: list
+           nibabel Cifti2BrainModel with the grayordinates common to all the
+           ciftis, in the order of the first one, with new offsets
+       gathers: list
+           for each cifti, the array of indices along direction of the
+           common grayordinates, i.e. cifti data can be restricted to the
+           intersection with a single fancy-index"""
+    grayordinates = [c.grayordinates(direction) for c in ciftis]
+    volumes = [index.volume for index in grayordinates]
+    volume_shape = grayordinates[0].volume_shape
+
+    brain_models = []
+    gathers = [[] for _ in ciftis]
+    offset = 0
+
+    for reference in grayordinates[0].brain_models:
+        structure = reference.brain_structure
+        if not all(structure in index for index in grayordinates[1:]):
+            continue
+
+        if (reference.model_type == models.VOXEL
+                and not all(_same_volume(volumes[0], v) for v in volumes)):
+            raise ValueError('The ciftis have volume structures defined in '
+                             'different volumes')
+
+        keys = [_grayordinate_keys(index, structure) for index in grayordinates]
+
+        common = keys[0]
+        for k in keys[1:]:
+            common = common[np.isin(common, k, assume_unique=True)]
+        if len(common) == 0:
+            continue
+
+        for gather, index, k in zip(gathers, grayordinates, keys):
+            sorter = np.argsort(k)
+            positions = sorter[np.searchsorted(k, common, sorter=sorter)]
+            gather.append(index.structure_slice(structure).start + positions)
+
+        if reference.model_type == models.SURFACE:
+            new_bm = nibabel.cifti2.Cifti2BrainModel(
+                offset, len(common), reference.model_type, structure,
+                reference.surface_number_of_vertices,
+                vertex_indices=nibabel.cifti2.Cifti2VertexIndices(
+                    common.tolist()))
+        else:
+            voxels = np.transpose(np.unravel_index(common, volume_shape))
+            new_bm = nibabel.cifti2.Cifti2BrainModel(
+                offset, len(common), reference.model_type, structure,
+                voxel_indices_ijk=nibabel.cifti2.Cifti2VoxelIndicesIJK(
+                    voxels.tolist()))
+
+        brain_models.append(new_bm)
+        offset += len(common)
+
+    gathers = [np.concatenate(g) if g else np.zeros(0, dtype=np.int64)
+               for g in gathers]
+    return brain_models, gathers
+
+
+def intersect_headers(ciftis):
+    """Intersects the brain models of several ciftis in both directions.
+
+       Returns
+       -------
+       header: nibabel.cifti2.Cifti2Header
+           header of the first cifti restricted to the common grayordinates
+       gathers: dict
+           for each direction with brain models, the list with the gather
+           indices of each cifti (see intersect_brain_models). Directions
+           without brain models are not in the dictionary"""
+    matrix = nibabel.cifti2.Cifti2Matrix()
+    gathers = {}
+
+    for dimension, direction in enumerate(DIRECTIONS):
+        index_map = utils.retrieve_direction(ciftis[0], direction)
+        if index_map.indices_map_to_data_type != indices.BRAIN_MODELS:
+            matrix.append(copy.deepcopy(index_map))
+            continue
+
+        brain_models, gathers[direction] = intersect_brain_models(ciftis,
+                                                                  direction)
+        new_map = nibabel.cifti2.Cifti2MatrixIndicesMap([dimension],
+                                                        indices.BRAIN_MODELS)
+        for bm in brain_models:
+            new_map.append(bm)
+        if index_map.volume is not None:
+            new_map.volume = copy.deepcopy(index_map.volume)
+        matrix.append(new_map)
+
+    return nibabel.cifti2.Cifti2Header(matrix), gathers
+
+
+def is_identity(gather, length):
+    """Checks if gathering keeps a whole dimension of the given length"""
+    return len(gather) == length and np.array_equal(gather, np.arange(length))
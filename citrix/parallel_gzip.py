@@ -0,0 +1,454 @@
+''' Multi-threaded gzip reading and writing of NIFTI/CIFTI files.
+
+    Data are compressed in independent blocks, each one written as a
+    member of a standard multi-member gzip stream, so any gzip reader
+    (nibabel, gzip, zcat) can read the files. Each member records its
+    compressed and uncompressed sizes in a FEXTRA subfield, which lets
+    GzipReader index the members without inflating them, inflate them on
+    a thread pool and seek anywhere in the file. zlib releases the GIL, so
+    threads compress and inflate in parallel.
+
+    gzip files written by other tools are read sequentially, with a
+    thread reading the compressed stream ahead of the inflation. '''
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+
+import nibabel
+from nibabel.arrayproxy import ArrayProxy
+
+# nibabel's default: the fastest level, NIFTI data compress little more
+# at higher levels
+COMPRESSION_LEVEL = 1
+
+# Uncompressed bytes in each gzip member
+BLOCK_SIZE = 2 ** 22
+
+N_THREADS = os.cpu_count() or 1
+
+# Compressed bytes read at a time from streams without an index
+READ_SIZE = 2 ** 22
+
+# FEXTRA subfield of the members: compressed size of the whole member and
+# uncompressed size of its data, as little-endian uint32
+SUBFIELD_ID = b'CX'
+_SUBFIELD = struct.Struct('<2sHII')
+_HEADER = struct.Struct('<BBBBIBBH')
+_HEADER_SIZE = _HEADER.size + _SUBFIELD.size
+_FEXTRA = 4
+
+
+def compress_member(data, level=COMPRESSION_LEVEL):
+    ''' gzip member holding data, with its sizes in the FEXTRA field '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    size = _HEADER_SIZE + len(body) + 8
+    header = (_HEADER.pack(0x1f, 0x8b, 8, _FEXTRA, 0, 0, 255, _SUBFIELD.size)
+              + _SUBFIELD.pack(SUBFIELD_ID, 8, size, len(data)))
+    trailer = struct.pack('<II', zlib.crc32(data), len(data) & 0xffffffff)
+    return header + body + trailer
+
+
+def _member_sizes(header):
+    ''' (member size, data size) recorded in the header of a member, None
+        if it has no such record '''
+    if len(header) < _HEADER.size or header[:3] != b'\x1f\x8b\x08':
+        return None
+    if not header[3] & _FEXTRA:
+        return None
+
+    xlen = struct.unpack_from('<H', header, 10)[0]
+    extra = header[12:12 + xlen]
+    position = 0
+    while position + 4 <= len(extra):
+        subfield_id, length = struct.unpack_from('<2sH', extra, position)
+        if subfield_id == SUBFIELD_ID and length == 8:
+            return struct.unpack_from('<II', extra, position + 4)
+        position += 4 + length
+    return None
+
+
+class GzipWriter(io.RawIOBase):
+    """Write-only file object that compresses what is written to it in
+       blocks of block_size bytes, on n_threads threads.
+
+       Blocks are written in order as soon as they are compressed, with at
+       most two blocks per thread waiting, so memory does not depend on
+       the size of the file. tell() counts uncompressed bytes, which is
+       all nibabel needs to write images (see save)"""
+
+    def __init__(self, filename, level=None, block_size=None,
+                 n_threads=None):
+        self.level = COMPRESSION_LEVEL if level is None else level
+        self.block_size = BLOCK_SIZE if block_size is None else block_size
+        if not 0 < self.block_size <= 2 ** 30:
+            raise ValueError("block_size should be between 1 and 2**30")
+        n_threads = N_THREADS if n_threads is None else n_threads
+
+        self._file = open(filename, 'wb')
+        self._buffer = bytearray()
+        self._position = 0
+        self._members = 0
+        self._pending = deque()
+        self._max_pending = 2 * n_threads
+        self._pool = None
+        if n_threads > 1:
+            self._pool = ThreadPoolExecutor(n_threads)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self._position += len(data)
+
+        start = 0
+        if self._buffer:
+            start = min(self.block_size - len(self._buffer), len(data))
+            self._buffer += data[:start]
+            if len(self._buffer) < self.block_size:
+                return len(data)
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        # whole blocks are compressed straight from data
+        while len(data) - start >= self.block_size:
+            self._submit(bytes(data[start:start + self.block_size]))
+            start += self.block_size
+        self._buffer += data[start:]
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def seekable(self):
+        return False
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Only moves forwards, writing zeros: nibabel seeks to where it
+           already is before writing, and pads up to the data offset"""
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Can only seek forwards")
+        if offset < self._position:
+            raise io.UnsupportedOperation("Can only seek forwards")
+        while self._position < offset:
+            self.write(bytes(min(offset - self._position, self.block_size)))
+        return self._position
+
+    def _submit(self, block):
+        self._members += 1
+        if self._pool is None:
+            self._file.write(compress_member(block, self.level))
+            return
+
+        self._pending.append(self._pool.submit(compress_member, block,
+                                               self.level))
+        while len(self._pending) > self._max_pending:
+            self._file.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffer or self._members == 0:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+        finally:
+            for future in self._pending:
+                future.cancel()
+            if self._pool is not None:
+                self._pool.shutdown()
+            self._file.close()
+            super().close()
+
+
+class _Prefetcher:
+    """Thread reading a file ahead, in chunks of READ_SIZE bytes"""
+
+    def __init__(self, fd, depth=4):
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(fd,),
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self, fd):
+        offset = 0
+        while not self._stop.is_set():
+            chunk = os.pread(fd, READ_SIZE, offset)
+            offset += len(chunk)
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(chunk, timeout=.1)
+                    break
+                except queue.Full:
+                    pass
+            if not chunk:
+                return
+
+    def get(self):
+        """Next chunk, b'' at the end of the file"""
+        return self._queue.get()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class GzipReader(io.RawIOBase):
+    """Read-only, seekable file object over a gzip file.
+
+       Files written by GzipWriter are indexed when opened: a read spanning
+       several members inflates them on n_threads threads, straight into
+       the destination buffer, and seeking is free. Other gzip files are
+       inflated sequentially (see _Prefetcher), and seeking backwards
+       restarts from their beginning"""
+
+    def __init__(self, filename, n_threads=None):
+        self.name = filename
+        self.n_threads = N_THREADS if n_threads is None else n_threads
+        self._file = open(filename, 'rb')
+        self._fd = self._file.fileno()
+        self._position = 0
+        self._pool = None
+        self._cached = (None, None)
+
+        self._index = self._build_index()
+        if self._index is None:
+            self._restart()
+
+    def _build_index(self):
+        """(compressed offsets, member sizes, uncompressed offsets) of the
+           members, None if some member has no recorded sizes"""
+        file_size = os.fstat(self._fd).st_size
+        offsets, sizes, starts = [], [], [0]
+        offset = 0
+        while offset < file_size:
+            recorded = _member_sizes(os.pread(self._fd, 64, offset))
+            if recorded is None:
+                return None
+            size, data_size = recorded
+            offsets.append(offset)
+            sizes.append(size)
+            starts.append(starts[-1] + data_size)
+            offset += size
+        if offset != file_size or not offsets:
+            return None
+        return offsets, sizes, starts
+
+    @property
+    def indexed(self):
+        return self._index is not None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            if not self.indexed:
+                raise io.UnsupportedOperation(
+                    "The size of gzip files without an index is unknown")
+            offset += self._index[2][-1]
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+
+        if self.indexed:
+            self._position = offset
+            return offset
+
+        if offset < self._position:
+            self._restart()
+        scratch = bytearray(min(offset - self._position, READ_SIZE))
+        while self._position < offset:
+            view = memoryview(scratch)[:offset - self._position]
+            if self.readinto(view) == 0:
+                break
+        return self._position
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        if self.indexed:
+            return self._readinto_indexed(view)
+        return self._readinto_sequential(view)
+
+    # Indexed files
+
+    def _member(self, i):
+        if self._cached[0] == i:
+            return self._cached[1]
+        offsets, sizes, _ = self._index
+        member = os.pread(self._fd, sizes[i], offsets[i])
+        return zlib.decompress(member, 16 + zlib.MAX_WBITS)
+
+    def _readinto_indexed(self, view):
+        starts = self._index[2]
+        stop = min(self._position + len(view), starts[-1])
+        if stop <= self._position:
+            return 0
+
+        first = bisect_right(starts, self._position) - 1
+        last = bisect_right(starts, stop - 1) - 1
+
+        def inflate_into(i):
+            data = self._member(i)
+            begin = max(starts[i], self._position)
+            end = min(starts[i + 1], stop)
+            view[begin - self._position:end - self._position] = \
+                data[begin - starts[i]:end - starts[i]]
+            return data
+
+        members = range(first, last + 1)
+        if len(members) == 1 or self.n_threads == 1:
+            for i in members:
+                data = inflate_into(i)
+        else:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.n_threads)
+            data = list(self._pool.map(inflate_into, members))[-1]
+        # small sequential reads (e.g. of the header) reuse the member
+        self._cached = (last, data)
+
+        read = stop - self._position
+        self._position = stop
+        return read
+
+    # Files without an index
+
+    def _restart(self):
+        if getattr(self, '_prefetcher', None) is not None:
+            self._prefetcher.stop()
+        self._prefetcher = _Prefetcher(self._fd)
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._in_member = False
+        self._input = b''
+        self._output = b''
+        self._end = False
+        self._position = 0
+
+    def _inflate(self):
+        """Inflates the next piece of the stream into _output"""
+        while not self._output and not self._end:
+            if not self._input:
+                self._input = self._prefetcher.get()
+                if not self._input:
+                    if self._in_member:
+                        raise EOFError("Compressed file ended before the "
+                                       "end-of-stream marker was reached")
+                    self._end = True
+                    return
+            if not self._in_member:
+                # members can be followed by zero padding
+                self._input = self._input.lstrip(b'\x00')
+                if not self._input:
+                    continue
+                self._in_member = True
+
+            self._output = self._decompressor.decompress(self._input,
+                                                         READ_SIZE)
+            if self._decompressor.eof:
+                self._input = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self._in_member = False
+            else:
+                self._input = self._decompressor.unconsumed_tail
+
+    def _readinto_sequential(self, view):
+        read = 0
+        while read < len(view):
+            self._inflate()
+            if not self._output:
+                break
+            n = min(len(view) - read, len(self._output))
+            view[read:read + n] = self._output[:n]
+            self._output = self._output[n:]
+            read += n
+        self._position += read
+        return read
+
+    def close(self):
+        if self.closed:
+            return
+        if getattr(self, '_prefetcher', None) is not None:
+            self._prefetcher.stop()
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._file.close()
+        super().close()
+
+
+class GzipArrayProxy(ArrayProxy):
+    """Array proxy of a compressed NIFTI file that opens a GzipReader for
+       each access and closes it afterwards, so that neither the file nor
+       the threads of the reader outlive the read. Opening an indexed file
+       is cheap; other gzip files are inflated from their beginning at
+       each access, and are better recompressed once (see
+       stream.compress)"""
+
+    def __init__(self, file_like, spec, *, mmap=False, order=None,
+                 keep_file_open=False, n_threads=None):
+        # same signature as ArrayProxy, which reshape and copy rely on
+        super().__init__(file_like, spec, mmap=False, order=order,
+                         keep_file_open=False)
+        self.n_threads = n_threads
+
+    @contextmanager
+    def _get_fileobj(self):
+        with GzipReader(self.file_like, self.n_threads) as reader:
+            yield reader
+
+
+def _image_class(raw):
+    """Nifti1Image or Nifti2Image, from the first 4 bytes of a header in
+       either byte order"""
+    for endianness in '<>':
+        sizeof_hdr = struct.unpack(endianness + 'i', raw)[0]
+        if sizeof_hdr == 348:
+            return nibabel.Nifti1Image
+        if sizeof_hdr == 540:
+            return nibabel.Nifti2Image
+    raise ValueError("Not a NIFTI file")
+
+
+def load(filename, n_threads=None):
+    """Loads a compressed NIFTI-1/2 (or CIFTI) file. Only the header is
+       read, the data stay in the file and are inflated by a GzipReader
+       whenever they are read (see GzipArrayProxy)"""
+    with GzipReader(filename, n_threads) as reader:
+        try:
+            klass = _image_class(reader.read(4))
+        except (ValueError, struct.error):
+            raise ValueError("{} is not a NIFTI file".format(filename))
+        reader.seek(0)
+        header = klass.header_class.from_fileobj(reader)
+
+    data = GzipArrayProxy(filename, header.copy(), n_threads=n_threads)
+    image = klass(data, None, header)
+    # as in nibabel's from_file_map, the affine is taken from the header
+    # without updating the header from it
+    image._affine = header.get_best_affine()
+    return image
+
+
+def save(image, filename, level=None, block_size=None, n_threads=None):
+    """Saves a nibabel image as a gzip file compressed by a GzipWriter"""
+    with GzipWriter(filename, level, block_size, n_threads) as writer:
+        image.to_file_map({'image': nibabel.FileHolder(fileobj=writer)})
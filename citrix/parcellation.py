@@ -0,0 +1,185 @@
+''' Reduction of dense cifti data to the parcels of a dlabel '''
+import copy
+
+import numpy as np
+from scipy import sparse
+
+from . import choices, intersection, models
+from .build import cifti as build_cifti
+
+# see choices.PARCEL_REDUCERS
+REDUCERS = choices.PARCEL_REDUCERS
+
+
+class Parcellation:
+    """Parcels of a dlabel, restricted to the grayordinates of dense data.
+
+       It is built once, from the brain models only: operator is a sparse
+       (parcels, grayordinates) matrix averaging the grayordinates of each
+       parcel, so that a block of any number of frames is reduced with a
+       single sparse matmul. Label 0 is not a parcel.
+
+       Attributes
+       ----------
+       keys: array
+           label key of each parcel
+       names: list
+           label name of each parcel
+       members: list
+           for each parcel, the indices of its grayordinates in the dense
+           data
+       operator: scipy.sparse.csr_matrix
+           (parcels, grayordinates) averaging operator
+       index_map: nibabel.cifti2.Cifti2MatrixIndicesMap
+           PARCELS map of the parcellated data"""
+
+    def __init__(self, dlabel, dense, label_map=0):
+        (_, (label_rows, dense_rows)) = intersection.intersect_brain_models(
+            [dlabel, dense], "COLUMN")
+
+        labels = np.asarray(dlabel.dataobj)
+        if labels.ndim > 1:
+            labels = labels[label_map]
+        labels = np.rint(labels[label_rows]).astype(np.int64)
+
+        labeled = labels != 0
+        self.keys, parcel_of = np.unique(labels[labeled], return_inverse=True)
+        label_rows, dense_rows = label_rows[labeled], dense_rows[labeled]
+
+        counts = np.bincount(parcel_of, minlength=len(self.keys))
+        self.operator = sparse.csr_matrix(
+            (1. / counts[parcel_of], (parcel_of, dense_rows)),
+            shape=(len(self.keys), dense.grayordinates("COLUMN").size))
+
+        order = np.argsort(parcel_of, kind='stable')
+        bounds = np.r_[0, np.cumsum(counts)]
+        self.members = [dense_rows[order[bounds[i]:bounds[i + 1]]]
+                        for i in range(len(self.keys))]
+        # members of all the parcels, one parcel after the other
+        self._columns = dense_rows[order]
+        self._bounds = bounds
+
+        self.names = self._names(dlabel, label_map)
+        self.index_map = self._index_map(dlabel, parcel_of, label_rows,
+                                         order, bounds)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _names(self, dlabel, label_map):
+        named_map = list(dlabel.row.named_maps)[label_map]
+        table = named_map.label_table
+        return [table[k].label if k in table else str(k) for k in self.keys]
+
+    def _index_map(self, dlabel, parcel_of, label_rows, order, bounds):
+        index = dlabel.grayordinates("COLUMN")
+        structures = index.row_structures(label_rows)
+
+        surfaces = []
+        for bm in index.brain_models:
+            if bm.model_type == models.SURFACE:
+                surfaces.append((bm.brain_structure,
+                                 bm.surface_number_of_vertices))
+
+        parcels = []
+        for i, name in enumerate(self.names):
+            rows = label_rows[order[bounds[i]:bounds[i + 1]]]
+            row_structures = structures[order[bounds[i]:bounds[i + 1]]]
+            vertices, voxels = {}, []
+            for structure in np.unique(row_structures):
+                in_structure = rows[row_structures == structure]
+                positions = in_structure - index.structure_slice(structure).start
+                if index.model_type(structure) == models.SURFACE:
+                    vertices[structure] = index.vertices(structure)[positions]
+                else:
+                    voxels.append(index.voxels(structure)[positions])
+            voxels = np.concatenate(voxels) if voxels else None
+            parcels.append(build_cifti.parcel(name, vertices, voxels))
+
+        volume = copy.deepcopy(index.volume)
+        return build_cifti.parcels_map(parcels, surfaces, volume)
+
+    def mean(self, block):
+        """Means of the parcels in a (frames, grayordinates) block"""
+        return np.asarray((self.operator @ np.asarray(block).T).T)
+
+    def median(self, block):
+        """Medians of the parcels in a (frames, grayordinates) block.
+
+           The members of all the parcels are sorted at once, by value and
+           then (stably) by parcel, so that the medians are read at the
+           middle of each parcel"""
+        values = np.asarray(block, dtype=np.float64)[:, self._columns]
+        starts, counts = self._bounds[:-1], np.diff(self._bounds)
+        parcel_of = np.repeat(np.arange(len(self)), counts)
+
+        by_value = np.argsort(values, axis=1)
+        by_parcel = np.argsort(parcel_of[by_value], axis=1, kind='stable')
+        ordered = np.take_along_axis(
+            values, np.take_along_axis(by_value, by_parcel, axis=1), axis=1)
+
+        reduced = (ordered[:, starts + (counts - 1) // 2] +
+                   ordered[:, starts + counts // 2]) / 2
+        # as np.median, parcels with a missing value have a missing median
+        missing = np.add.reduceat(np.isnan(values), starts, axis=1) > 0
+        reduced[missing] = np.nan
+        return reduced
+
+    def principal_components(self, blocks):
+        """First principal component (over grayordinates) of each parcel,
+           from an iterable of (frames, grayordinates) blocks covering the
+           data. Returns the mean of each grayordinate and, per parcel,
+           the unit-norm weights of its grayordinates, signed so that they
+           add up to a positive number.
+
+           Each parcel keeps the smaller of its (frames, members) time
+           series and its (members, members) product: parcels with more
+           members than frames are decomposed through the (frames, frames)
+           Gram matrix of their centered time series instead"""
+        n_frames = 0
+        sums = None
+        # per parcel, the list of its blocks until it has as many frames
+        # as members, then the product of its time series
+        kept = [[] for _ in self.members]
+        for block in blocks:
+            block = np.asarray(block, dtype=np.float64)
+            n_frames += block.shape[0]
+            sums = block.sum(axis=0) if sums is None else sums + block.sum(axis=0)
+            for i, members in enumerate(self.members):
+                data = block[:, members]
+                if isinstance(kept[i], list):
+                    kept[i].append(data)
+                    if n_frames >= len(members):
+                        data = np.concatenate(kept[i])
+                        kept[i] = data.T @ data
+                else:
+                    kept[i] += data.T @ data
+
+        means = sums / n_frames
+        weights = []
+        for data, members in zip(kept, self.members):
+            mu = means[members]
+            if isinstance(data, list):
+                centered = np.concatenate(data) - mu
+                _, vectors = np.linalg.eigh(centered @ centered.T)
+                vector = centered.T @ vectors[:, -1]
+                norm = np.linalg.norm(vector)
+                if norm > 0:
+                    vector /= norm
+            else:
+                covariance = data - n_frames * np.outer(mu, mu)
+                _, vectors = np.linalg.eigh(covariance)
+                vector = vectors[:, -1]
+            if vector.sum() < 0:
+                vector = -vector
+            weights.append(vector)
+        return means, weights
+
+    def project(self, block, means, weights):
+        """Projection of a (frames, grayordinates) block onto the principal
+           components of the parcels, see principal_components"""
+        block = np.asarray(block, dtype=np.float64) - means
+        reduced = np.empty((block.shape[0], len(self)))
+        for i, (members, vector) in enumerate(zip(self.members, weights)):
+            reduced[:, i] = block[:, members] @ vector
+        return reduced
@@ -0,0 +1,176 @@
+''' Temporal preprocessing of dtseries, one block of grayordinates at a time.
+
+    Stages are functions of a (frames, grayordinates) block that return the
+    processed block, they work on each time series independently, so a run
+    is processed block by block without ever being held in memory:
+
+        pipeline = Pipeline([detrend(1), bandpass(.009, .08, tr),
+                             regress(confounds), normalize('zscore')])
+        for start, block in pipeline.blocks(dtseries, n_jobs=4):
+            ...
+
+    Each stage computes what only depends on the number of frames (design
+    matrices, filters) once, and reuses it for every block. '''
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import functools
+
+import numpy as np
+from scipy import signal
+
+from . import choices, stream
+
+# Memory used by each block of grayordinates
+BLOCK_BYTES = 2 ** 26
+
+# see choices.NORMALIZATIONS
+NORMALIZATIONS = choices.NORMALIZATIONS
+
+
+def _residualizer(design):
+    """Function removing the span of the (frames, regressors) design columns
+       from a block, as block - design @ (pinv(design) @ block), which costs
+       frames x regressors per time series instead of frames x frames"""
+    pinv = np.linalg.pinv(design)
+
+    def residuals(block):
+        return block - design @ (pinv @ block)
+    return residuals
+
+
+def detrend(order=1):
+    """Stage removing a polynomial trend (of Legendre polynomials up to
+       order, so the mean is removed too) from each time series"""
+    @functools.lru_cache(maxsize=4)
+    def residualizer(n_frames):
+        times = np.linspace(-1, 1, n_frames)
+        design = np.polynomial.legendre.legvander(times, order)
+        return _residualizer(design)
+
+    def stage(block):
+        return residualizer(len(block))(block)
+    return stage
+
+
+def bandpass(low, high, tr, order=2):
+    """Stage applying a zero-phase Butterworth filter to each time series.
+
+       Parameters
+       ----------
+       low, high: float
+           cut-off frequencies in Hz. With low None it is a low-pass filter,
+           with high None a high-pass one
+       tr: float
+           repetition time, in seconds
+       order: int
+           order of the filter, doubled by the forward-backward pass"""
+    if low is None and high is None:
+        raise ValueError("low, high or both should be given")
+
+    nyquist = .5 / tr
+    if high is not None and high >= nyquist:
+        raise ValueError("high should be below the Nyquist frequency "
+                         "({} Hz)".format(nyquist))
+
+    if low is None:
+        sos = signal.butter(order, high, 'lowpass', fs=1 / tr, output='sos')
+    elif high is None:
+        sos = signal.butter(order, low, 'highpass', fs=1 / tr, output='sos')
+    else:
+        sos = signal.butter(order, [low, high], 'bandpass', fs=1 / tr,
+                            output='sos')
+
+    def stage(block):
+        return signal.sosfiltfilt(sos, block, axis=0)
+    return stage
+
+
+def regress(confounds):
+    """Stage keeping the residuals of the regression of each time series on
+       (frames, confounds) nuisance regressors (e.g. motion parameters).
+       Add a column of ones to confounds to remove the mean as well"""
+    confounds = np.asarray(confounds, dtype=np.float64)
+    if confounds.ndim == 1:
+        confounds = confounds[:, None]
+    residuals = _residualizer(confounds)
+
+    def stage(block):
+        if len(block) != len(confounds):
+            raise ValueError("The confounds have {} frames and the data "
+                             "{}".format(len(confounds), len(block)))
+        return residuals(block)
+    return stage
+
+
+def normalize(method='zscore'):
+    """Stage demeaning each time series and, for 'zscore', dividing it by
+       its standard deviation. Constant time series become zeros: those
+       whose standard deviation is within rounding errors of their mean"""
+    if method not in NORMALIZATIONS:
+        raise ValueError("method should be one of {}".format(NORMALIZATIONS))
+
+    def stage(block):
+        mean = block.mean(axis=0)
+        block = block - mean
+        if method == 'zscore':
+            std = block.std(axis=0)
+            eps = np.finfo(np.result_type(block.dtype, np.float32)).eps
+            std[std <= len(block) * eps * np.abs(mean)] = np.inf
+            block /= std
+        return block
+    return stage
+
+
+def _column_blocks(dtseries, columns_per_block):
+    """Yields (start, block) of consecutive blocks of grayordinates of a
+       dtseries. They are contiguous on disk, and read in a single pass
+       (see stream.column_blocks)"""
+    data = dtseries.memmap
+    if data is None:
+        data = dtseries.dataobj
+    if len(data.shape) == 1:
+        raise ValueError("The dtseries needs more than one frame")
+    return stream.column_blocks(data, columns_per_block=columns_per_block)
+
+
+class Pipeline:
+    """Stages applied in order to blocks of time series"""
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+
+    def __call__(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        for stage in self.stages:
+            block = stage(block)
+        return block
+
+    def blocks(self, dtseries, n_jobs=1, columns_per_block=None):
+        """Yields (start, processed block) for consecutive blocks of
+           grayordinates of a dtseries, in order.
+
+           The blocks are read in order by the calling thread. With
+           n_jobs > 1 they are processed by a pool of threads (numpy and
+           scipy release the GIL), with at most two blocks per thread in
+           flight, so memory is bounded by a few blocks whatever the
+           length of the dtseries"""
+        n_frames = dtseries.shape[0]
+        if columns_per_block is None:
+            columns_per_block = max(1, BLOCK_BYTES // (8 * n_frames))
+        blocks = _column_blocks(dtseries, columns_per_block)
+
+        if n_jobs == 1:
+            for start, block in blocks:
+                yield start, self(block)
+            return
+
+        with ThreadPoolExecutor(n_jobs) as pool:
+            pending = deque()
+            for start, block in blocks:
+                pending.append((start, pool.submit(self, block)))
+                if len(pending) > 2 * n_jobs:
+                    start, future = pending.popleft()
+                    yield start, future.result()
+            while pending:
+                start, future = pending.popleft()
+                yield start, future.result()
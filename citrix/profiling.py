@@ -0,0 +1,235 @@
+''' Opt-in instrumentation of the stages of loading, saving and the tools.
+
+    Nothing is measured unless a Profiler is active:
+
+        with profiling.Profiler() as profiler:
+            citrix.load('a.dtseries.nii')
+        profiler.save('profile.json')
+
+    Each stage records its wall time, the bytes read and written by the
+    process (Linux only, through /proc/self/io, which does not count pages
+    of memory-mapped files) and the peak resident memory reached during
+    the stage (the peak of the whole process on systems where it cannot
+    be reset). While no profiler is active, stages cost a single check.
+
+    Stages nest within a thread: a stage run by a worker thread is recorded
+    at the top level, and since the counters and the peak memory are those
+    of the process, the measures of stages that overlap in several threads
+    include each other. Processes (e.g. the workers of cli.batch) are
+    measured by a Profiler of their own, whose records the parent adds
+    with add_records. '''
+import contextlib
+import functools
+import json
+import resource
+import threading
+import time
+
+# Active profilers, innermost last
+_profilers = []
+_profilers_lock = threading.Lock()
+
+# Stages being measured by each thread, outermost first
+_local = threading.local()
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _io_counters():
+    try:
+        with open('/proc/self/io') as io:
+            counters = dict(line.split(':') for line in io)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def reset_peak_rss():
+    """Resets the peak resident memory of the process to its current
+       resident memory (Linux only). Returns whether it could be reset"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """Peak resident memory of the process, in bytes, since it started or
+       since the last reset_peak_rss"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Stage:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        # the peak is reset for this stage, the enclosing ones keep theirs
+        stack = _stack()
+        peak = peak_rss()
+        for outer in stack:
+            outer.peak = max(outer.peak, peak)
+        self.peak = 0
+        self.peak_reset = reset_peak_rss()
+
+        stack.append(self)
+        self.path = '/'.join(s.name for s in stack)
+        self.read, self.written = _io_counters()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        read, written = _io_counters()
+        self.peak = max(self.peak, peak_rss())
+        record = {'stage': self.path, 'seconds': seconds,
+                  'bytes_read': None, 'bytes_written': None,
+                  'peak_rss_bytes': self.peak,
+                  'peak_rss_of_stage': self.peak_reset,
+                  'failed': exc_type is not None}
+        if read is not None and self.read is not None:
+            record['bytes_read'] = read - self.read
+            record['bytes_written'] = written - self.written
+        stack = _stack()
+        stack.pop()
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, self.peak)
+        add_records([record])
+        return False
+
+
+def is_active():
+    """Whether a profiler is collecting measures"""
+    return bool(_profilers)
+
+
+def add_records(records):
+    """Hands records to the active profilers, e.g. those measured in
+       another process"""
+    with _profilers_lock:
+        for record in records:
+            for profiler in _profilers:
+                profiler.record(record)
+
+
+def stage(name):
+    """Context manager measuring a stage, when a profiler is active.
+       Stages can be nested, their names are then joined with /"""
+    if not _profilers:
+        return contextlib.nullcontext()
+    return _Stage(name)
+
+
+def iterate(name, iterable):
+    """Yields the items of iterable, measuring the production of each one
+       as a stage, e.g. the reads and computations of a generator of blocks
+       apart from what is done with the blocks"""
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def profiled(name):
+    """Decorator measuring each call of a function as a stage"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _profilers:
+                return function(*args, **kwargs)
+            with _Stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Profiler:
+    """Collects the measures of the stages run while it is active.
+
+       Parameters
+       ----------
+       callback: function
+           called with the record of each stage as soon as it ends, e.g.
+           to log it. Records are dictionaries with the stage, seconds,
+           bytes_read, bytes_written and peak_rss_bytes"""
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.records = []
+
+    def record(self, record):
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def start(self):
+        with _profilers_lock:
+            _profilers.append(self)
+        return self
+
+    def stop(self):
+        with _profilers_lock:
+            if self in _profilers:
+                _profilers.remove(self)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def totals(self):
+        """Seconds spent in each stage, over all its runs"""
+        totals = {}
+        for record in self.records:
+            totals[record['stage']] = (totals.get(record['stage'], 0) +
+                                       record['seconds'])
+        return totals
+
+    def save(self, filename):
+        """Writes the records as JSON"""
+        with open(filename, 'w') as f:
+            json.dump({'stages': self.records, 'totals': self.totals()}, f,
+                      indent=2)
+
+
+@contextlib.contextmanager
+def profile_to(filename):
+    """Profiles the enclosed code into a JSON file. Does nothing if
+       filename is None, so command line tools can use it unconditionally"""
+    if filename is None:
+        yield None
+        return
+
+    profiler = Profiler()
+    try:
+        with profiler:
+            yield profiler
+    finally:
+        profiler.save(filename)
+
+
+def add_argument(parser):
+    """Adds the --profile option to the parser of a ctrx_* script"""
+    parser.add_argument('-profile', '--profile', dest='profile', default=None,
+                        help=('JSON file where the time, I/O and memory of '
+                              'each stage of the run are written'))
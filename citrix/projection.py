@@ -0,0 +1,168 @@
+''' Precomputed projections of surface vertices to volume voxels '''
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+import nibabel
+
+# 'floor': the voxel containing each vertex.
+# 'neighbors': the 8 voxels around each vertex, with their distances to it.
+METHODS = ['floor', 'neighbors']
+
+# Part of the keys of the cached projections, to be increased whenever
+# vertex_voxels changes so that the maps computed before are not reused
+VERSION = 2
+
+NEIGHBOR_OFFSETS = np.array([(i, j, k) for i in range(-1, 1)
+                                       for j in range(-1, 1)
+                                       for k in range(-1, 1)])
+
+
+def vertex_voxels(vertices, affine, shape, method='floor'):
+    """Projects vertices to a volume.
+
+       Returns
+       -------
+       flat: array (n, k)
+           column-major flat indices of the k voxels of each vertex, -1 for
+           those outside of the volume
+       distances: array (n, k)
+           distance, in voxels, from each vertex to the center of each of
+           its voxels"""
+    if method not in METHODS:
+        raise ValueError("method should be one of {}".format(METHODS))
+
+    voxels = nibabel.affines.apply_affine(np.linalg.inv(affine), vertices)
+    if method == 'floor':
+        neighbors = np.floor(voxels[:, None, :]).astype(np.int64)
+    else:
+        candidates = voxels[:, None, :] + NEIGHBOR_OFFSETS[None, :, :]
+        neighbors = np.round(candidates).astype(np.int64)
+    distances = np.linalg.norm(neighbors - voxels[:, None, :], axis=-1)
+
+    inside = np.all((neighbors >= 0) & (neighbors < shape), axis=-1)
+    flat = np.ravel_multi_index(tuple(np.moveaxis(neighbors, -1, 0)),
+                                shape, mode='clip', order='F')
+    flat[~inside] = -1
+    return flat, distances.astype(np.float32)
+
+
+def projection_key(vertices, affine, shape, method):
+    """Hash identifying the projection of a surface to a volume"""
+    sha = hashlib.sha1()
+    sha.update(str(VERSION).encode())
+    sha.update(np.ascontiguousarray(vertices, dtype=np.float32).tobytes())
+    sha.update(np.asarray(affine, dtype=np.float64).tobytes())
+    sha.update(np.asarray(shape, dtype=np.int64).tobytes())
+    sha.update(method.encode())
+    return sha.hexdigest()
+
+
+class ProjectionMap:
+    """Projection of all the vertices of a surface to a volume, see
+       vertex_voxels. The voxels of the vertices of a brain model are
+       obtained with select"""
+
+    def __init__(self, flat, distances, key=None):
+        self.flat = flat
+        self.distances = distances
+        self.key = key
+
+    @classmethod
+    def from_surface(klass, surface, affine, shape, method='floor'):
+        vertices = surface.vertices
+        flat, distances = vertex_voxels(vertices, affine, shape, method)
+        return klass(flat, distances,
+                     projection_key(vertices, affine, shape, method))
+
+    @classmethod
+    def load(klass, filename):
+        with np.load(filename) as npz:
+            return klass(npz['flat'], npz['distances'], str(npz['key']))
+
+    def save(self, filename):
+        with open(filename, 'wb') as fileobj:
+            np.savez(fileobj, flat=self.flat, distances=self.distances,
+                     key=self.key)
+
+    @property
+    def nbytes(self):
+        return self.flat.nbytes + self.distances.nbytes
+
+    def select(self, vertices):
+        """Flat voxel indices and distances of some vertices"""
+        return self.flat[vertices], self.distances[vertices]
+
+
+class ProjectionCache:
+    """Cache of projection maps, kept in memory and, if a directory is
+       given, on disk. The disk cache holds at most max_bytes, evicting the
+       least recently used maps"""
+
+    def __init__(self, directory=None, max_bytes=2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._memory = {}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, surface, affine, shape, method='floor'):
+        """Projection map of a surface to a volume, computed only if it is
+           not cached"""
+        key = projection_key(surface.vertices, affine, shape, method)
+        if key in self._memory:
+            return self._memory[key]
+
+        projection = None
+        if self.directory is not None:
+            filename = self._filename(key)
+            if os.path.exists(filename):
+                try:
+                    projection = ProjectionMap.load(filename)
+                    os.utime(filename)
+                except (OSError, ValueError, KeyError):
+                    projection = None
+
+        if projection is None:
+            projection = ProjectionMap.from_surface(surface, affine, shape,
+                                                    method)
+            if self.directory is not None:
+                self._store(projection)
+
+        self._memory[key] = projection
+        return projection
+
+    def _store(self, projection):
+        fd, temporary = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(fd)
+        projection.save(temporary)
+        os.replace(temporary, self._filename(projection.key))
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used maps until the cache fits in
+           max_bytes"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
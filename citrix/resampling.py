@@ -0,0 +1,259 @@
+''' Sparse resampling of data between surface meshes '''
+import copy
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+import nibabel
+
+from . import models
+from .gifti import GiftiFunction
+
+# 'barycentric': interpolation within the source triangle where each target
+# vertex falls. 'nearest': the value of the nearest source vertex.
+METHODS = ['barycentric', 'nearest']
+
+
+def _vertex_triangles(triangles, n_vertices):
+    """(n_vertices, max degree) array with the triangles around each
+       vertex, padded with -1"""
+    triangles = np.asarray(triangles, dtype=np.int64)
+    vertex = triangles.ravel()
+    triangle = np.repeat(np.arange(len(triangles)), 3)
+    order = np.argsort(vertex, kind='stable')
+    vertex, triangle = vertex[order], triangle[order]
+
+    degree = np.bincount(vertex, minlength=n_vertices)
+    starts = np.r_[0, np.cumsum(degree)[:-1]]
+    position = np.arange(len(vertex)) - starts[vertex]
+
+    incident = np.full((n_vertices, max(degree.max(), 1)), -1, dtype=np.int64)
+    incident[vertex, position] = triangle
+    return incident
+
+
+def barycentric_coordinates(points, corners):
+    """Barycentric coordinates of (n, 3) points projected onto the planes
+       of (n, 3, 3) triangles"""
+    a, b, c = corners[..., 0, :], corners[..., 1, :], corners[..., 2, :]
+    v0, v1, v2 = b - a, c - a, points - a
+    d00 = np.einsum('...i,...i', v0, v0)
+    d01 = np.einsum('...i,...i', v0, v1)
+    d11 = np.einsum('...i,...i', v1, v1)
+    d20 = np.einsum('...i,...i', v2, v0)
+    d21 = np.einsum('...i,...i', v2, v1)
+    denominator = d00 * d11 - d01 * d01
+    denominator = np.where(denominator == 0, np.finfo(float).eps, denominator)
+    v = (d11 * d20 - d01 * d21) / denominator
+    w = (d00 * d21 - d01 * d20) / denominator
+    return np.stack([1 - v - w, v, w], axis=-1)
+
+
+def resampling_matrix(source, target, method='barycentric'):
+    """Sparse (target vertices, source vertices) matrix moving data from
+       the source mesh to the target mesh, both in the same space (e.g.
+       registered spheres).
+
+       The nearest source vertex of each target vertex is found with a
+       KD-tree; for barycentric weights, the target vertex is then located
+       in the triangle around that vertex that contains it best, and its
+       (clipped) barycentric coordinates are the weights"""
+    if method not in METHODS:
+        raise ValueError("method should be one of {}".format(METHODS))
+
+    source_vertices = np.asarray(source.vertices, dtype=np.float64)
+    target_vertices = np.asarray(target.vertices, dtype=np.float64)
+    n_target, n_source = len(target_vertices), len(source_vertices)
+
+    _, nearest = cKDTree(source_vertices).query(target_vertices)
+    if method == 'nearest':
+        return sparse.csr_matrix((np.ones(n_target),
+                                  (np.arange(n_target), nearest)),
+                                 shape=(n_target, n_source))
+
+    triangles = np.asarray(source.triangles, dtype=np.int64)
+    candidates = _vertex_triangles(triangles, n_source)[nearest]
+    valid = candidates >= 0
+    corners = source_vertices[triangles[np.where(valid, candidates, 0)]]
+    coordinates = barycentric_coordinates(target_vertices[:, None, :], corners)
+
+    fit = np.where(valid, coordinates.min(axis=-1), -np.inf)
+    best = np.argmax(fit, axis=1)
+    rows = np.arange(n_target)
+    weights = np.clip(coordinates[rows, best], 0, None)
+    weights /= weights.sum(axis=1, keepdims=True)
+    columns = triangles[candidates[rows, best]]
+
+    return sparse.csr_matrix(
+        (weights.ravel(), (np.repeat(rows, 3), columns.ravel())),
+        shape=(n_target, n_source))
+
+
+def resampling_key(source, target, method):
+    """Hash identifying the resampling between two meshes"""
+    sha = hashlib.sha1()
+    for mesh in (source, target):
+        sha.update(np.ascontiguousarray(mesh.vertices, dtype=np.float32).tobytes())
+        sha.update(np.ascontiguousarray(mesh.triangles, dtype=np.int64).tobytes())
+    sha.update(method.encode())
+    return sha.hexdigest()
+
+
+class Resampler:
+    """Resampling of data from a source mesh to a target mesh.
+
+       The weights are computed once (see resampling_matrix) and, if a
+       cache directory is given, stored there as a sparse matrix, so that
+       later resamplers between the same meshes just load them. Applying
+       the resampler is then a sparse matmul"""
+
+    def __init__(self, source, target, method='barycentric', cache_dir=None):
+        self.method = method
+        self.matrix = None
+
+        filename = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            key = resampling_key(source, target, method)
+            filename = os.path.join(cache_dir, key + '.npz')
+            if os.path.exists(filename):
+                try:
+                    self.matrix = sparse.load_npz(filename).tocsr()
+                except (OSError, ValueError):
+                    self.matrix = None
+
+        if self.matrix is None:
+            self.matrix = resampling_matrix(source, target, method)
+            if filename is not None:
+                fd, temporary = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+                os.close(fd)
+                sparse.save_npz(temporary, self.matrix)
+                os.replace(temporary, filename)
+
+    @property
+    def n_source(self):
+        return self.matrix.shape[1]
+
+    @property
+    def n_target(self):
+        return self.matrix.shape[0]
+
+    def apply(self, data):
+        """Resamples (source vertices, ...) data to (target vertices, ...)"""
+        data = np.asarray(data)
+        flat = data.reshape((data.shape[0], -1))
+        return np.asarray(self.matrix @ flat).reshape(
+            (self.n_target,) + data.shape[1:])
+
+    def restricted(self, vertices):
+        """Resampling from data defined only at some source vertices (e.g.
+           the cortex of a cifti, without the medial wall): the weights of
+           the other vertices are dropped and the rest normalized. Target
+           vertices without any weight left get 0"""
+        matrix = self.matrix[:, np.asarray(vertices)]
+        totals = np.asarray(matrix.sum(axis=1)).ravel()
+        totals[totals == 0] = 1
+        return (sparse.diags(1 / totals) @ matrix).tocsr()
+
+    def resample_function(self, function):
+        """Resamples a GiftiFunction, each of its data arrays"""
+        darrays = []
+        for darray in function.darrays:
+            data = self.apply(darray.data).astype(darray.data.dtype)
+            darrays.append(nibabel.gifti.GiftiDataArray(
+                data=data, intent=darray.intent, datatype=darray.datatype,
+                meta=darray.meta))
+        return GiftiFunction(darrays=darrays, meta=function.meta)
+
+    def resample_cifti(self, cifti, structure, target_vertices=None):
+        """Resamples the columns of a structure of a cifti.
+
+           Returns
+           -------
+           data: array (rows, target vertices)
+               the structure on the target mesh, at target_vertices (all
+               of them by default)"""
+        index = cifti.grayordinates("COLUMN")
+        if index.model_type(structure) != models.SURFACE:
+            raise ValueError("{} is not a surface structure".format(structure))
+
+        data = cifti.memmap
+        if data is None:
+            data = cifti.dataobj
+        if len(data.shape) == 1:
+            data = data.reshape((1, data.shape[0]))
+
+        block = np.asarray(data[:, index.structure_slice(structure)],
+                           dtype=np.float64)
+        matrix = self.restricted(index.vertices(structure))
+        if target_vertices is not None:
+            matrix = matrix[np.asarray(target_vertices)]
+        return np.asarray(matrix @ block.T).T
+
+
+def resample_cifti(cifti, resamplers, target_vertices=None):
+    """Resamples the cortical structures of a cifti to other meshes.
+
+       Parameters
+       ----------
+       cifti: citrix.cifti.Cifti
+           data with brain models along its columns
+       resamplers: dict
+           Resampler of each surface structure to resample
+       target_vertices: dict
+           vertices of each structure kept on the target mesh (e.g.
+           without the medial wall), all of them if not given
+
+       Returns
+       -------
+       image: nibabel.cifti2.Cifti2Image
+           the cifti with the resampled structures, other structures are
+           copied"""
+    if target_vertices is None:
+        target_vertices = {}
+
+    index = cifti.grayordinates("COLUMN")
+    data = cifti.memmap
+    if data is None:
+        data = cifti.dataobj
+    if len(data.shape) == 1:
+        data = data.reshape((1, data.shape[0]))
+
+    new_map = copy.deepcopy(cifti.column)
+    brain_models = list(new_map.brain_models)
+    for bm in brain_models:
+        new_map.remove(bm)
+
+    blocks = []
+    offset = 0
+    for bm in brain_models:
+        structure = bm.brain_structure
+        if structure in resamplers:
+            resampler = resamplers[structure]
+            vertices = target_vertices.get(structure)
+            if vertices is None:
+                vertices = np.arange(resampler.n_target)
+            blocks.append(resampler.resample_cifti(cifti, structure, vertices))
+            bm = nibabel.cifti2.Cifti2BrainModel(
+                offset, len(vertices), bm.model_type, structure,
+                resampler.n_target,
+                vertex_indices=nibabel.cifti2.Cifti2VertexIndices(
+                    np.asarray(vertices).tolist()))
+        else:
+            blocks.append(np.asarray(data[:, index.structure_slice(structure)]))
+            bm = copy.deepcopy(bm)
+            bm.index_offset = offset
+        new_map.append(bm)
+        offset += bm.index_count
+
+    matrix = nibabel.cifti2.Cifti2Matrix()
+    matrix.append(copy.deepcopy(cifti.row))
+    matrix.append(new_map)
+
+    new_data = np.concatenate(blocks, axis=1).astype(np.float32)
+    return nibabel.Cifti2Image(new_data, nibabel.cifti2.Cifti2Header(matrix),
+                               cifti.nifti_header)
@@ -0,0 +1,114 @@
+''' Sparse sampling of volumes at surface vertices and voxel grayordinates '''
+import numpy as np
+from scipy import sparse
+
+import nibabel
+
+from . import choices, models
+
+# see choices.SAMPLING_METHODS
+METHODS = choices.SAMPLING_METHODS
+
+CORNERS = np.array([(i, j, k) for i in range(2)
+                              for j in range(2)
+                              for k in range(2)])
+
+
+def sampling_matrix(points, affine, shape, method='trilinear'):
+    """Sparse matrix sampling a volume at points.
+
+       Parameters
+       ----------
+       points: array (n, 3)
+           coordinates of the points, in the space of the affine
+       affine: array (4, 4)
+           voxel to world transformation of the volume
+       shape: tuple
+           shape of the volume
+       method: str
+           'trilinear' or 'nearest'
+
+       Returns
+       -------
+       weights: scipy.sparse.csr_matrix (n, voxels)
+           weights of the voxels, flattened in column-major order as in
+           NIFTI files, so that weights @ frames gives the value of n
+           points from a (voxels, frames) block. Voxels outside of the
+           volume are left out, the remaining weights of a point are
+           normalized, and points entirely outside of the volume get an
+           empty row"""
+    if method not in METHODS:
+        raise ValueError("method should be one of {}".format(METHODS))
+
+    shape = tuple(shape[:3])
+    voxels = nibabel.affines.apply_affine(np.linalg.inv(affine),
+                                          np.asarray(points, dtype=float))
+    if method == 'nearest':
+        corners = np.round(voxels).astype(np.int64)[:, None, :]
+        weights = np.ones(corners.shape[:2])
+    else:
+        base = np.floor(voxels)
+        fraction = voxels - base
+        corners = base.astype(np.int64)[:, None, :] + CORNERS[None]
+        weights = np.prod(np.where(CORNERS[None], fraction[:, None, :],
+                                   1 - fraction[:, None, :]), axis=-1)
+
+    inside = np.all((corners >= 0) & (corners < shape), axis=-1)
+    weights = np.where(inside, weights, 0)
+    totals = weights.sum(axis=1, keepdims=True)
+    weights = np.divide(weights, totals, out=np.zeros_like(weights),
+                        where=totals > 0)
+
+    flat = np.ravel_multi_index(tuple(np.moveaxis(corners, -1, 0)), shape,
+                                mode='clip', order='F')
+    rows = np.repeat(np.arange(len(voxels)), corners.shape[1])
+    keep = (weights > 0).ravel()
+    return sparse.csr_matrix(
+        (weights.ravel()[keep], (rows[keep], flat.ravel()[keep])),
+        shape=(len(voxels), int(np.prod(shape))))
+
+
+def grayordinate_points(grayordinates, surfaces):
+    """Coordinates of each grayordinate of a brain models axis: vertex
+       coordinates for surface structures, taken from surfaces (a
+       dictionary mapping structures to loaded GiftiMesh), and voxel
+       centers for volume structures"""
+    points = np.empty((len(grayordinates), 3))
+    for structure in grayordinates.structures:
+        rows = grayordinates.structure_slice(structure)
+        if grayordinates.model_type(structure) == models.SURFACE:
+            if structure not in surfaces:
+                raise ValueError('No surface was given for {}'.format(structure))
+            points[rows] = surfaces[structure].vertices[
+                grayordinates.vertices(structure)]
+        else:
+            volume = grayordinates.volume
+            affine = volume.transformation_matrix_voxel_indices_ijk_to_xyz.matrix
+            points[rows] = nibabel.affines.apply_affine(
+                affine, grayordinates.voxels(structure))
+    return points
+
+
+def grayordinate_sampler(grayordinates, surfaces, affine, shape,
+                         method='trilinear'):
+    """Sparse (grayordinates, voxels) matrix sampling a volume at all the
+       grayordinates of a brain models axis, see sampling_matrix.
+
+       Voxel grayordinates are always sampled at the nearest voxel, so
+       that they copy the volume when it is the one of the brain models"""
+    points = grayordinate_points(grayordinates, surfaces)
+    sampler = sampling_matrix(points, affine, shape, method)
+    if method == 'nearest':
+        return sampler
+
+    is_voxel = np.zeros(len(grayordinates), dtype=bool)
+    for structure in grayordinates.structures:
+        if grayordinates.model_type(structure) == models.VOXEL:
+            is_voxel[grayordinates.structure_slice(structure)] = True
+    if not is_voxel.any():
+        return sampler
+
+    nearest = sampling_matrix(points, affine, shape, 'nearest')
+    keep = sparse.diags((~is_voxel).astype(float))
+    replace = sparse.diags(is_voxel.astype(float))
+    return (keep @ sampler + replace @ nearest).tocsr()
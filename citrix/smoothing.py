@@ -0,0 +1,149 @@
+''' Gaussian smoothing kernels for surface and volume grayordinates '''
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+import nibabel
+
+from . import models
+
+# Kernels are truncated at TRUNCATE standard deviations
+TRUNCATE = 3.
+
+
+def fwhm_to_sigma(fwhm):
+    return fwhm / np.sqrt(8 * np.log(2))
+
+
+def _normalized_kernel(rows, columns, distances, sigma, n):
+    """Row-normalized sparse Gaussian kernel from the distances between
+       pairs of points"""
+    weights = np.exp(-distances ** 2 / (2 * sigma ** 2))
+    kernel = sparse.csr_matrix((weights, (rows, columns)), shape=(n, n))
+    totals = np.asarray(kernel.sum(axis=1)).ravel()
+    totals[totals == 0] = 1
+    return sparse.diags(1 / totals) @ kernel
+
+
+def surface_kernel(vertices, adjacency, fwhm):
+    """Geodesic-approximate Gaussian smoothing kernel of a mesh.
+
+       The neighborhood of each vertex is found walking the edges of the
+       mesh, as many rings as needed to cover TRUNCATE standard deviations
+       with edges of average length. Within it, the weights use the
+       straight-line distance between vertices, which approximates the
+       geodesic one at that scale, while walking the mesh keeps the kernel
+       from crossing sulci.
+
+       Parameters
+       ----------
+       vertices: array (n, 3)
+           coordinates of the vertices
+       adjacency: scipy.sparse matrix (n, n)
+           adjacency of the vertices, see gifti.mesh_adjacency
+       fwhm: float
+           full width at half maximum of the Gaussian, in the units of the
+           coordinates
+
+       Returns
+       -------
+       kernel: scipy.sparse.csr_matrix (n, n)
+           smoothing operator, each row adds up to 1"""
+    vertices = np.asarray(vertices, dtype=np.float64)
+    n_vertices = len(vertices)
+    sigma = fwhm_to_sigma(fwhm)
+    cutoff = TRUNCATE * sigma
+
+    edges = sparse.triu(adjacency).tocoo()
+    if edges.nnz == 0 or fwhm <= 0:
+        return sparse.identity(n_vertices, format='csr')
+    lengths = np.linalg.norm(vertices[edges.row] - vertices[edges.col], axis=1)
+    n_rings = int(np.ceil(cutoff / lengths.mean())) + 1
+
+    step = (adjacency + sparse.identity(n_vertices)).tocsr().astype(np.float32)
+    step.data[:] = 1
+    reach = step
+    for _ in range(n_rings - 1):
+        reach = reach @ step
+        reach.data[:] = 1
+
+    reach = reach.tocoo()
+    distances = np.linalg.norm(vertices[reach.row] - vertices[reach.col],
+                               axis=1)
+    near = distances <= cutoff
+    return _normalized_kernel(reach.row[near], reach.col[near],
+                              distances[near], sigma, n_vertices)
+
+
+def volume_kernel(voxels, affine, fwhm):
+    """Gaussian smoothing kernel between (n, 3) voxels of a volume, with
+       distances measured in the space of the affine. Voxels that are not
+       in the list do not take part in the smoothing"""
+    voxels = np.asarray(voxels).reshape(-1, 3)
+    if fwhm <= 0 or len(voxels) == 0:
+        return sparse.identity(len(voxels), format='csr')
+
+    sigma = fwhm_to_sigma(fwhm)
+    points = nibabel.affines.apply_affine(affine, voxels)
+    pairs = cKDTree(points).sparse_distance_matrix(
+        cKDTree(points), TRUNCATE * sigma, output_type='coo_matrix')
+    # sparse_distance_matrix leaves out the zero distances of the diagonal
+    rows = np.r_[pairs.row, np.arange(len(voxels))]
+    columns = np.r_[pairs.col, np.arange(len(voxels))]
+    distances = np.r_[pairs.data, np.zeros(len(voxels))]
+    return _normalized_kernel(rows, columns, distances, sigma, len(voxels))
+
+
+def grayordinate_kernel(grayordinates, surfaces, fwhm, volume_fwhm=None):
+    """Smoothing operator over all the grayordinates of a brain models axis.
+
+       Each surface structure is smoothed over its mesh restricted to the
+       vertices of the axis (so the medial wall does not leak in), and the
+       voxels of all the volume structures are smoothed together, in the
+       volume. Surface and volume grayordinates never mix.
+
+       Parameters
+       ----------
+       grayordinates: grayordinates.GrayordinateIndex
+           brain models of the data (e.g. cifti.grayordinates("COLUMN"))
+       surfaces: dict
+           maps each surface structure to its (loaded) GiftiMesh
+       fwhm: float
+           FWHM of the surface smoothing, in mm
+       volume_fwhm: float
+           FWHM of the volume smoothing, fwhm if None
+
+       Returns
+       -------
+       kernel: scipy.sparse.csr_matrix
+           (grayordinates, grayordinates) operator"""
+    if volume_fwhm is None:
+        volume_fwhm = fwhm
+
+    blocks = []
+    voxel_rows, voxels = [], []
+    for structure in grayordinates.structures:
+        rows = grayordinates.structure_slice(structure)
+        if grayordinates.model_type(structure) == models.SURFACE:
+            if structure not in surfaces:
+                raise ValueError('No surface was given for {}'.format(structure))
+            mesh = surfaces[structure].submesh(grayordinates.vertices(structure))
+            kernel = mesh.gaussian_kernel(fwhm).tocoo()
+            blocks.append((kernel.row + rows.start, kernel.col + rows.start,
+                           kernel.data))
+        else:
+            voxel_rows.append(np.arange(rows.start, rows.stop))
+            voxels.append(grayordinates.voxels(structure))
+
+    if voxels:
+        volume = grayordinates.volume
+        affine = volume.transformation_matrix_voxel_indices_ijk_to_xyz.matrix
+        voxel_rows = np.concatenate(voxel_rows)
+        kernel = volume_kernel(np.concatenate(voxels), affine,
+                               volume_fwhm).tocoo()
+        blocks.append((voxel_rows[kernel.row], voxel_rows[kernel.col],
+                       kernel.data))
+
+    rows, columns, data = (np.concatenate(parts) for parts in zip(*blocks))
+    return sparse.csr_matrix((data, (rows, columns)),
+                             shape=(len(grayordinates), len(grayordinates)))
@@ -0,0 +1,308 @@
+''' Block-wise reading and writing of NIFTI/CIFTI files that do not fit in
+    memory '''
+import os
+import tempfile
+
+import numpy as np
+
+import nibabel
+from nibabel.arrayproxy import ArrayProxy
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import apply_read_scaling
+
+from . import parallel_gzip, profiling
+
+
+# Memory used by each block read from array-like sources
+BLOCK_BYTES = 2 ** 27
+
+
+def empty(shape, dtype=np.float32):
+    '''Array-like placeholder of the given shape that takes no memory.
+
+       It can be used as the data of a nibabel image whose only purpose
+       is to describe the file that will be written block by block'''
+    return np.broadcast_to(np.zeros((), dtype=dtype), shape)
+
+
+def nifti_header(image):
+    '''Returns the NIFTI header that nibabel would write for image, along
+       with the shape of the data as seen by citrix'''
+    if isinstance(image, nibabel.Cifti2Image):
+        from nibabel.cifti2.parse_cifti2 import Cifti2Extension
+
+        image.update_headers()
+        header = image.nifti_header.copy()
+        header.extensions = nibabel.nifti1.Nifti1Extensions(
+            ext for ext in header.extensions
+            if not isinstance(ext, Cifti2Extension)
+        )
+        header.extensions.append(
+            Cifti2Extension.from_bytes(image.header.to_xml())
+        )
+        if header.get_intent()[0] == 'none':
+            header.set_intent('NIFTI_INTENT_CONNECTIVITY_UNKNOWN')
+        if header['qform_code'] == 0:
+            header['pixdim'][:4] = 1
+        return header, image.shape
+
+    image.update_header()
+    return image.header.copy(), image.shape
+
+
+def _write_header(fileobj, header):
+    '''Writes the header and pads the file up to the data offset'''
+    header.set_data_offset(0)  # nibabel computes the minimum one
+    header.set_slope_inter(None, None)
+    header.write_to(fileobj)
+    offset = header.get_data_offset()
+    fileobj.write(bytes(offset - fileobj.tell()))
+    return offset
+
+
+def memmap(filename, image):
+    '''Creates filename with the header of image and returns a writable
+       memory map over its (uninitialized) data.
+
+       The map has the shape of image, in the column-major order used by
+       NIFTI, so only the pages that are touched are ever in memory'''
+    if filename.endswith('.gz') or filename.endswith('.bz2'):
+        raise ValueError("Only uncompressed files can be memory-mapped")
+
+    header, shape = nifti_header(image)
+    dtype = header.get_data_dtype()
+
+    with open(filename, 'wb') as fileobj:
+        offset = _write_header(fileobj, header)
+        fileobj.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+
+    return np.memmap(filename, dtype=dtype, mode='r+', offset=offset,
+                     shape=shape, order='F')
+
+
+def _open_output(filename):
+    '''Opens a file for writing, compressing .gz files on several threads
+       (see parallel_gzip)'''
+    if filename.endswith('.gz'):
+        return parallel_gzip.GzipWriter(filename)
+    return ImageOpener(filename, 'wb')
+
+
+class BlockWriter:
+    '''Writes the data of a NIFTI/CIFTI file sequentially, block by block.
+
+       NIFTI stores data in column-major order, so consecutive blocks are
+       slabs along the last axis of the image, each one written in
+       column-major order as well. Compressed files are supported.'''
+
+    def __init__(self, filename, image):
+        header, shape = nifti_header(image)
+        self.dtype = header.get_data_dtype()
+        self.expected = int(np.prod(shape))
+        self.written = 0
+
+        self._fileobj = _open_output(filename)
+        _write_header(self._fileobj, header)
+
+    def write(self, block):
+        block = np.asarray(block, dtype=self.dtype)
+        if self.written + block.size > self.expected:
+            raise ValueError("Writing more data than the image holds")
+        self._fileobj.write(block.tobytes(order='F'))
+        self.written += block.size
+
+    def close(self):
+        self._fileobj.close()
+        if self.written != self.expected:
+            raise ValueError(("Only {} of the {} values of the image "
+                              "were written").format(self.written,
+                                                     self.expected))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._fileobj.close()
+
+
+class RowWriter:
+    '''Writes the data of a 2D NIFTI/CIFTI file block by block, each block
+       holding the next consecutive rows of the matrix.
+
+       Rows are strided in column-major files, so blocks are written
+       through a memory map that is flushed after each block, leaving no
+       dirty pages behind. Compressed files are written uncompressed next
+       to their destination and compressed when the writer is closed.'''
+
+    def __init__(self, filename, image):
+        self.filename = filename
+        self._temporary = None
+        if filename.endswith('.gz') or filename.endswith('.bz2'):
+            fd, self._temporary = tempfile.mkstemp(
+                suffix='.nii', dir=os.path.dirname(os.path.abspath(filename)))
+            os.close(fd)
+
+        self._output = memmap(self._temporary or filename, image)
+        if self._output.ndim != 2:
+            raise ValueError("Only 2D images can be written by rows")
+        self.written = 0
+
+    def write(self, block):
+        block = np.asarray(block)
+        if block.ndim == 1:
+            block = block[None]
+        stop = self.written + block.shape[0]
+        if stop > self._output.shape[0]:
+            raise ValueError("Writing more rows than the image holds")
+        self._output[self.written:stop] = block
+        self._output.flush()
+        self.written = stop
+
+    def close(self):
+        expected = self._output.shape[0]
+        self._output.flush()
+        self._output = None
+        try:
+            if self.written != expected:
+                raise ValueError(("Only {} of the {} rows of the image "
+                                  "were written").format(self.written,
+                                                         expected))
+            if self._temporary is not None:
+                compress(self._temporary, self.filename)
+        finally:
+            self._discard()
+
+    def _discard(self):
+        if self._temporary is not None and os.path.exists(self._temporary):
+            os.remove(self._temporary)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._output = None
+            self._discard()
+
+
+def _open_input(filename, n_threads=None):
+    '''Opens a file for reading, inflating .gz files on several threads
+       (see parallel_gzip)'''
+    if filename.endswith('.gz'):
+        return parallel_gzip.GzipReader(filename, n_threads)
+    return ImageOpener(filename, 'rb')
+
+
+def _readinto(fileobj, array):
+    '''Fills an array with the next bytes of a file'''
+    view = memoryview(array.reshape(-1, order='A')).cast('B')
+    read = 0
+    while read < len(view):
+        n = fileobj.readinto(view[read:])
+        if not n:
+            raise ValueError("The file ended before the end of its data")
+        read += n
+
+
+def column_blocks(array, start=0, stop=None, block_bytes=BLOCK_BYTES,
+                  columns_per_block=None):
+    '''Yields (first column, block) for consecutive blocks of the columns
+       [start, stop) of a 2D array-like, of about block_bytes each, or of
+       columns_per_block columns if it is given.
+
+       NIFTI/CIFTI data are stored column-major, so the ArrayProxy of a
+       file (compressed or not, see parallel_gzip.GzipArrayProxy) is read
+       in a single sequential pass over one open file: a gzip file is
+       inflated once, instead of from its beginning for each block. Other
+       array-likes (arrays, memory maps) are sliced. Closing the generator
+       early stops the reading'''
+    n_rows, n_columns = array.shape
+    stop = n_columns if stop is None else stop
+    dtype = np.dtype(getattr(array, 'dtype', np.float64))
+    step = columns_per_block
+    if step is None:
+        step = max(1, block_bytes // (dtype.itemsize * max(n_rows, 1)))
+
+    if not (isinstance(array, ArrayProxy) and array.order == 'F' and
+            isinstance(array.file_like, str)):
+        for first in range(start, stop, step):
+            yield first, np.asarray(array[:, first:min(first + step, stop)])
+        return
+
+    with _open_input(array.file_like,
+                     getattr(array, 'n_threads', None)) as fileobj:
+        fileobj.seek(array.offset + start * n_rows * dtype.itemsize)
+        for first in range(start, stop, step):
+            block = np.empty((n_rows, min(step, stop - first)), dtype=dtype,
+                             order='F')
+            _readinto(fileobj, block)
+            if not dtype.isnative:
+                block = block.astype(dtype.newbyteorder('='))
+            yield first, apply_read_scaling(block, array.slope, array.inter)
+
+
+def array_blocks(array, axis=0, block_bytes=BLOCK_BYTES):
+    '''Yields consecutive blocks along an axis of an array-like (e.g. a
+       memory map or an ArrayProxy), reading one block at a time'''
+    shape = array.shape
+    axis = axis % len(shape)
+    itemsize = np.dtype(getattr(array, 'dtype', np.float64)).itemsize
+    slab_bytes = itemsize * int(np.prod(shape)) // max(shape[axis], 1)
+    step = max(1, block_bytes // max(slab_bytes, 1))
+
+    for start in range(0, shape[axis], step):
+        index = [slice(None)] * len(shape)
+        index[axis] = slice(start, min(start + step, shape[axis]))
+        yield np.asarray(array[tuple(index)])
+
+
+@profiling.profiled('stream.write_blocks')
+def write_blocks(filename, image, source, axis=0, block_bytes=BLOCK_BYTES):
+    '''Writes filename with the header of image and the data of source,
+       never holding more than one block of data in memory.
+
+       Parameters
+       ----------
+       filename: str
+           output file, compressed if it ends with .gz
+       image: nibabel image
+           describes the file, its data is never read (see empty)
+       source: array-like or iterable
+           an array-like (e.g. a memmap) is read in blocks of about
+           block_bytes, otherwise source is iterated for the blocks (e.g.
+           a generator)
+       axis: int
+           0 when the blocks hold consecutive rows of a 2D image (see
+           RowWriter), -1 when they are slabs along its last axis (see
+           BlockWriter)'''
+    if hasattr(source, 'shape') and hasattr(source, '__getitem__'):
+        source = array_blocks(source, axis, block_bytes)
+
+    if axis == 0:
+        writer = RowWriter(filename, image)
+    elif axis in (-1, len(image.shape) - 1):
+        writer = BlockWriter(filename, image)
+    else:
+        raise ValueError("Blocks should be along the first or the last axis")
+
+    with writer:
+        # producing the blocks (reading, computing) is measured apart
+        for block in profiling.iterate('read', source):
+            with profiling.stage('write'):
+                writer.write(block)
+
+
+@profiling.profiled('stream.compress')
+def compress(source, destination, chunk_bytes=2 ** 24):
+    '''Copies the uncompressed file source into the compressed destination'''
+    with open(source, 'rb') as src, _open_output(destination) as dst:
+        while True:
+            chunk = src.read(chunk_bytes)
+            if not chunk:
+                break
+            dst.write(chunk)
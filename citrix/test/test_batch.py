@@ -0,0 +1,89 @@
+''' Test cli/batch.py '''
+import argparse
+import io
+import os
+
+import pytest
+
+from citrix import profiling
+from citrix.cli import batch
+
+
+@profiling.profiled('touch')
+def touch(infile, outfile, surface_files=None, projection_cache=None,
+          fail=()):
+    if os.path.basename(infile) in fail:
+        raise ValueError('cannot convert {}'.format(infile))
+    with open(outfile, 'w') as f:
+        f.write(infile)
+
+
+def test_jobs_from_args(tmp_path):
+    ''' Positional files and batch options exclude each other '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('infile', nargs='?')
+    parser.add_argument('outfile', nargs='?')
+    batch.add_arguments(parser)
+    positionals = ['infile', 'outfile']
+
+    args = parser.parse_args(['a.dtseries.nii', 'a.nii'])
+    assert(batch.jobs_from_args(parser, args, positionals) is None)
+
+    manifest = tmp_path / 'jobs.txt'
+    manifest.write_text('a.dtseries.nii a.nii\n')
+    args = parser.parse_args(['-batch', str(manifest), '-jobs', '2'])
+    assert(batch.jobs_from_args(parser, args, positionals) ==
+           [('a.dtseries.nii', 'a.nii')])
+    assert(args.n_jobs == 2)
+
+    for argv in [[], ['a.dtseries.nii', '-batch', str(manifest)],
+                 ['-glob', '*.dtseries.nii']]:
+        args = parser.parse_args(argv)
+        with pytest.raises(SystemExit):
+            batch.jobs_from_args(parser, args, positionals)
+
+
+def test_jobs_from_manifest(tmp_path):
+    ''' Manifests have one input/output pair per line '''
+    manifest = tmp_path / 'manifest.txt'
+    manifest.write_text('# comment\na.dtseries.nii a.nii\n\nb.dtseries.nii\tb.nii.gz\n')
+    assert(batch.jobs_from_manifest(str(manifest)) ==
+           [('a.dtseries.nii', 'a.nii'), ('b.dtseries.nii', 'b.nii.gz')])
+
+
+def test_jobs_from_glob(tmp_path):
+    ''' Outputs are named after the matched inputs '''
+    for name in ['s2.dtseries.nii', 's1.dtseries.nii', 'other.txt']:
+        (tmp_path / name).write_text('')
+
+    jobs = batch.jobs_from_glob(str(tmp_path / '*.dtseries.nii'),
+                                '{dir}/{stem}.nii.gz')
+    assert(jobs == [(str(tmp_path / 's1.dtseries.nii'), str(tmp_path / 's1.nii.gz')),
+                    (str(tmp_path / 's2.dtseries.nii'), str(tmp_path / 's2.nii.gz'))])
+
+
+def test_run_batch(tmp_path):
+    ''' Every job runs, failures are reported without stopping the batch '''
+    jobs = [(str(tmp_path / '{}.in'.format(i)), str(tmp_path / '{}.out'.format(i)))
+            for i in range(4)]
+
+    for n_jobs in [1, 2]:
+        results = batch.run_batch(touch, jobs, n_jobs=n_jobs, fail=('2.in',))
+        assert([r['input'] for r in results] == [i for i, _ in jobs])
+        assert([r['error'] is None for r in results] == [True, True, False, True])
+        assert(os.path.exists(jobs[3][1]))
+
+        out = io.StringIO()
+        assert(batch.report(results, out) == 1)
+        assert('FAILED' in out.getvalue())
+
+
+def test_run_batch_profiles_workers(tmp_path):
+    ''' The stages measured in worker processes reach the profiler '''
+    jobs = [(str(tmp_path / '{}.in'.format(i)), str(tmp_path / '{}.out'.format(i)))
+            for i in range(3)]
+
+    for n_jobs in [1, 2]:
+        with profiling.Profiler() as profiler:
+            batch.run_batch(touch, jobs, n_jobs=n_jobs)
+        assert([r['stage'] for r in profiler.records] == ['touch'] * 3)
@@ -0,0 +1,136 @@
+''' Test cifti.py '''
+import gzip
+import os
+
+import numpy
+import pytest
+
+import citrix
+from citrix import parallel_gzip, stream, structures
+from citrix.build import cifti as build_cifti
+
+DCONN = './citrix/test/data/merge3.dconn.nii'
+
+
+def test_dconn_is_memory_mapped():
+    dconn = citrix.load(DCONN)
+    assert(isinstance(dconn.memmap, numpy.memmap))
+    assert(dconn.memmap.shape == dconn.shape)
+
+
+def test_dconn_rows_and_columns():
+    ''' Rows and columns match the full matrix '''
+    dconn = citrix.load(DCONN)
+    matrix = numpy.asarray(dconn.dataobj)
+
+    numpy.testing.assert_equal(dconn.read_row(3), matrix[3])
+    numpy.testing.assert_equal(dconn.read_rows([5, 1]), matrix[[5, 1]])
+    numpy.testing.assert_equal(dconn.read_column(7), matrix[:, 7])
+    numpy.testing.assert_equal(dconn.read_columns([9, 0]), matrix[:, [9, 0]])
+
+
+def test_compressed_dconn_keeps_its_dtype(tmp_path):
+    ''' Rows and columns read by blocks have the dtype of the file '''
+    data = numpy.random.RandomState(0).rand(6, 6)
+    model = build_cifti.surface_model(structures.CORTEX_LEFT, range(6), 6)
+    filename = str(tmp_path / 'a.dconn.nii')
+    build_cifti.dconn(data, [model]).to_filename(filename)
+    stream.compress(filename, filename + '.gz')
+
+    dconn = citrix.load(filename + '.gz')
+    assert(dconn.memmap is None)
+    rows, columns = dconn.read_rows([4, 1]), dconn.read_columns([2, 5])
+    assert(rows.dtype == columns.dtype == numpy.float64)
+    numpy.testing.assert_array_equal(rows, data[[4, 1]])
+    numpy.testing.assert_array_equal(columns, data[:, [2, 5]])
+
+
+def test_plain_gzip_dconn_is_inflated_once(tmp_path, monkeypatch):
+    ''' Blocks of a gzip file without an index come from a single pass '''
+    data = numpy.random.RandomState(0).rand(20, 20).astype(numpy.float32)
+    model = build_cifti.surface_model(structures.CORTEX_LEFT, range(20), 20)
+    filename = str(tmp_path / 'a.dconn.nii')
+    build_cifti.dconn(data, [model]).to_filename(filename)
+    with open(filename, 'rb') as f:
+        compressed = gzip.compress(f.read())
+    with open(filename + '.gz', 'wb') as f:
+        f.write(compressed)
+
+    inflated = []
+
+    class Reader(parallel_gzip.GzipReader):
+        def readinto(self, buffer):
+            n = super().readinto(buffer)
+            inflated[-1] += n
+            return n
+
+        def _restart(self):
+            inflated.append(0)
+            super()._restart()
+
+    monkeypatch.setattr(parallel_gzip, 'GzipReader', Reader)
+    monkeypatch.setattr(citrix.cifti, 'BLOCK_BYTES', 4 * 20 * 3)
+    dconn = citrix.load(filename + '.gz')
+    assert(dconn.memmap is None)
+
+    for read, expected in [(lambda: dconn.read_rows([4, 1]), data[[4, 1]]),
+                           (lambda: dconn.read_columns([9, 2]),
+                            data[:, [9, 2]])]:
+        inflated.clear()
+        numpy.testing.assert_array_equal(read(), expected)
+        assert(len(inflated) == 1)
+        assert(inflated[0] <= os.path.getsize(filename))
+
+
+def test_dconn_block():
+    ''' Blocks are delimited by the brain models of each direction '''
+    dconn = citrix.load(DCONN)
+    matrix = numpy.asarray(dconn.dataobj)
+
+    block = dconn.read_block(structures.CORTEX_LEFT, structures.CORTEX_RIGHT)
+    numpy.testing.assert_equal(block, matrix[0:50, 50:150])
+
+
+def dtseries(data, vertices, n_vertices):
+    return build_cifti.dtseries(data, [
+        build_cifti.surface_model(structures.CORTEX_LEFT, vertices, n_vertices),
+        build_cifti.surface_model(structures.CORTEX_RIGHT, [0, 1], 2,
+                                  offset=len(vertices))])
+
+
+def test_structure_data_is_a_view():
+    dconn = citrix.load(DCONN)
+    block = dconn.structure_data(structures.CORTEX_RIGHT)
+    assert(numpy.shares_memory(block, dconn.memmap))
+    numpy.testing.assert_equal(block, numpy.asarray(dconn.dataobj)[:, 50:150])
+    assert(dconn.structure_data(structures.BRAIN_STEM, 'ROW').shape ==
+           (5, dconn.shape[1]))
+
+    data = numpy.random.rand(4, 5).astype(numpy.float32)
+    image = citrix.cifti.DenseTimeSeries.from_nibabel(
+        dtseries(data, [1, 3, 4], 6))
+    left = image.structure_data(structures.CORTEX_LEFT)
+    assert(numpy.shares_memory(left, data))
+
+
+def test_surface_map(tmp_path):
+    data = numpy.arange(20, dtype=numpy.float32).reshape(4, 5)
+    filename = str(tmp_path / 'a.dtseries.nii')
+    dtseries(data, [1, 3, 4], 6).to_filename(filename)
+    stream.compress(filename, filename + '.gz')
+
+    for name in (filename, filename + '.gz'):
+        image = citrix.load(name)
+        full = image.surface_map(structures.CORTEX_LEFT, fill=-1)
+        numpy.testing.assert_equal(full[:, [1, 3, 4]], data[:, :3])
+        numpy.testing.assert_equal(full[:, [0, 2, 5]], -1)
+
+        frame = image.surface_map(structures.CORTEX_LEFT, rows=2)
+        assert(frame.shape == (6,))
+        again = image.surface_map(structures.CORTEX_LEFT, rows=3, out=frame)
+        assert(again is frame)
+        numpy.testing.assert_equal(frame[[1, 3, 4]], data[3, :3])
+
+    with pytest.raises(ValueError):
+        image.surface_map(structures.CORTEX_LEFT, rows=0,
+                          out=numpy.empty(5))
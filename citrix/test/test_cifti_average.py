@@ -0,0 +1,97 @@
+''' Test cli/cifti_average.py '''
+from types import SimpleNamespace
+
+import numpy
+
+import citrix
+from citrix import structures
+from citrix.build import cifti as build_cifti
+from citrix.cli.cifti_average import cifti_average, read_columns
+
+DCONN = './citrix/test/data/merge3.dconn.nii'
+
+
+def write_dconn(filename, data, vertices, n_vertices=10):
+    model = build_cifti.surface_model(structures.CORTEX_LEFT, vertices,
+                                      n_vertices)
+    build_cifti.dconn(data.astype(numpy.float32), [model]).to_filename(
+        filename)
+
+
+def test_average_of_copies(tmp_path):
+    ''' Averaging a matrix with itself gives the matrix, with no variance '''
+    matrix = numpy.asarray(citrix.load(DCONN).dataobj)
+
+    mean_file = str(tmp_path / 'mean.dconn.nii')
+    cifti_average([DCONN, DCONN, DCONN], mean_file)
+    numpy.testing.assert_allclose(citrix.load(mean_file).dataobj, matrix,
+                                  rtol=1e-6)
+
+    variance_file = str(tmp_path / 'variance.dconn.nii.gz')
+    cifti_average([DCONN, DCONN], variance_file, mode='variance', n_jobs=2)
+    numpy.testing.assert_allclose(citrix.load(variance_file).dataobj, 0,
+                                  atol=1e-6)
+
+
+
+def test_average_modes(tmp_path):
+    ''' Each mode matches its numpy computation over different matrices '''
+    random = numpy.random.RandomState(0)
+    matrices = random.uniform(.01, .99, (3, 10, 10)).astype(numpy.float32)
+    filenames = []
+    for i, matrix in enumerate(matrices):
+        filenames.append(str(tmp_path / '{}.dconn.nii'.format(i)))
+        write_dconn(filenames[-1], matrix, range(10))
+    matrices = matrices.astype(numpy.float64)
+    logodds = numpy.log(matrices / (1 - matrices))
+
+    for mode, expected, n_jobs in [
+            ('mean', matrices.mean(axis=0), 1),
+            ('variance', matrices.var(axis=0, ddof=1), 2),
+            ('logodds', 1 / (1 + numpy.exp(-logodds.mean(axis=0))), 1)]:
+        out = str(tmp_path / '{}.dconn.nii'.format(mode))
+        cifti_average(filenames, out, mode, n_jobs=n_jobs)
+        numpy.testing.assert_allclose(citrix.load(out).dataobj, expected,
+                                      rtol=1e-5, atol=1e-7)
+
+
+def test_average_common_grayordinates(tmp_path):
+    ''' Matrices are averaged over the vertices that all of them have '''
+    random = numpy.random.RandomState(1)
+    first, second = random.rand(2, 8, 8)
+    write_dconn(str(tmp_path / 'a.dconn.nii'), first, range(8))
+    write_dconn(str(tmp_path / 'b.dconn.nii'), second, range(2, 10))
+
+    out = str(tmp_path / 'mean.dconn.nii')
+    cifti_average([str(tmp_path / 'a.dconn.nii'),
+                   str(tmp_path / 'b.dconn.nii')], out)
+    result = citrix.load(out)
+    for direction in ("ROW", "COLUMN"):
+        numpy.testing.assert_array_equal(
+            result.grayordinates(direction).vertices(structures.CORTEX_LEFT),
+            numpy.arange(2, 8))
+    numpy.testing.assert_allclose(
+        result.dataobj, (first[2:, 2:] + second[:6, :6]) / 2, rtol=1e-5)
+
+class Recorder:
+    ''' Lazy array recording the columns it is asked for '''
+
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+        self.read = []
+
+    def __getitem__(self, index):
+        self.read.extend(range(self.shape[1])[index[1]])
+        return self.data[index]
+
+
+def test_read_columns_skips_gaps():
+    ''' Gathered columns are read by runs, without what lies between '''
+    data = numpy.arange(40.).reshape(2, 20)
+    cifti = SimpleNamespace(memmap=None, dataobj=Recorder(data))
+    columns = numpy.array([0, 15, 3, 4, 5, 19, 14, 1])
+
+    block = read_columns(cifti, 1, 8, (None, columns))
+    numpy.testing.assert_array_equal(block, data[:, columns[1:8]])
+    assert(sorted(cifti.dataobj.read) == [1, 3, 4, 5, 14, 15, 19])
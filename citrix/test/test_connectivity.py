@@ -0,0 +1,118 @@
+''' Test connectivity.py and cli/sparsify_dconn.py '''
+import gzip
+
+import numpy
+import pytest
+
+import citrix
+from citrix import connectivity, parallel_gzip, stream, structures
+from citrix.build import cifti as build_cifti
+from citrix.cli.sparsify_dconn import sparsify_dconn
+
+
+def write_dconn(filename, data):
+    n = data.shape[0]
+    model = build_cifti.surface_model(structures.CORTEX_LEFT, range(n), n)
+    build_cifti.dconn(data, [model]).to_filename(filename)
+
+
+def brute_force(data, top_k=None, threshold=None, absolute=False,
+                exclude_diagonal=False):
+    scores = numpy.abs(data) if absolute else data.copy()
+    if exclude_diagonal:
+        numpy.fill_diagonal(scores, -numpy.inf)
+    if threshold is not None:
+        scores[scores < threshold] = -numpy.inf
+    expected = numpy.zeros_like(data)
+    for i, row in enumerate(scores):
+        kept = numpy.flatnonzero(row > -numpy.inf)
+        if top_k is not None:
+            kept = kept[numpy.argsort(-row[kept], kind='stable')[:top_k]]
+        expected[i, kept] = data[i, kept]
+    return expected
+
+
+@pytest.mark.parametrize('options', [
+    dict(top_k=3), dict(top_k=4, absolute=True, exclude_diagonal=True),
+    dict(threshold=.5), dict(threshold=.8, absolute=True),
+    dict(top_k=2, threshold=.7), dict(top_k=100)])
+def test_sparsify(tmp_path, options):
+    ''' Blocks of a few columns give the same entries as a brute force '''
+    data = numpy.random.RandomState(0).uniform(-1, 1, (13, 13))
+    data = data.astype(numpy.float32)
+    filename = str(tmp_path / 'a.dconn.nii')
+    write_dconn(filename, data)
+
+    dconn = citrix.load(filename)
+    result = connectivity.sparsify(dconn, block_bytes=4 * 13 * 3, **options)
+    numpy.testing.assert_array_equal(result.matrix.toarray(),
+                                     brute_force(data, **options))
+
+
+def test_sparsify_plain_gzip(tmp_path, monkeypatch):
+    ''' A gzip file without an index is inflated once, whatever the blocks,
+        which are sized with the itemsize of the file '''
+    data = numpy.random.RandomState(0).uniform(-1, 1, (13, 13))
+    filename = str(tmp_path / 'a.dconn.nii')
+    write_dconn(filename, data)
+    with open(filename, 'rb') as f:
+        compressed = gzip.compress(f.read())
+    with open(filename + '.gz', 'wb') as f:
+        f.write(compressed)
+
+    passes = []
+
+    class Reader(parallel_gzip.GzipReader):
+        def _restart(self):
+            passes.append(self.name)
+            super()._restart()
+
+    monkeypatch.setattr(parallel_gzip, 'GzipReader', Reader)
+    dconn = citrix.load(filename + '.gz')
+    assert(dconn.dataobj.dtype == numpy.float64)
+    passes.clear()
+
+    blocks = list(connectivity.column_blocks(dconn, block_bytes=8 * 13 * 3))
+    assert([start for start, _ in blocks] == [0, 3, 6, 9, 12])
+    assert(len(passes) == 1)
+
+    result = connectivity.sparsify(dconn, block_bytes=8 * 13 * 3, top_k=4)
+    numpy.testing.assert_allclose(result.matrix.toarray(),
+                                  brute_force(data.astype(numpy.float32),
+                                              top_k=4))
+    assert(len(passes) == 2)
+
+
+def test_sparse_dconn_file(tmp_path):
+    ''' The sparse file keeps the CIFTI axes, rows and products '''
+    data = numpy.random.RandomState(1).rand(20, 20).astype(numpy.float32)
+    write_dconn(str(tmp_path / 'a.dconn.nii'), data)
+    filename = str(tmp_path / 'a.dconn.nii.gz')
+    stream.compress(str(tmp_path / 'a.dconn.nii'), filename)
+    expected = brute_force(data, top_k=5)
+
+    for compressed in (False, True):
+        outfile = str(tmp_path / 'a{}.dconn.npz'.format(compressed))
+        sparsify_dconn(filename, outfile, top_k=5, compressed=compressed)
+        result = citrix.load(outfile)
+
+        assert(isinstance(result, connectivity.SparseDenseConnectivity))
+        assert(result.nnz == 20 * 5)
+        assert(result.grayordinates("ROW").structures ==
+               ['CIFTI_STRUCTURE_CORTEX_LEFT'])
+        numpy.testing.assert_array_equal(result.read_row(3), expected[3])
+        numpy.testing.assert_array_equal(result.read_rows([1, 7]),
+                                         expected[[1, 7]])
+
+        frames = numpy.random.RandomState(2).rand(20, 4)
+        numpy.testing.assert_allclose(result @ frames, expected @ frames,
+                                      rtol=1e-6)
+        numpy.testing.assert_allclose(frames.T @ result, frames.T @ expected,
+                                      rtol=1e-6)
+
+
+def test_check_input(tmp_path):
+    with pytest.raises(ValueError):
+        sparsify_dconn('a.dconn.nii', 'b.dconn.nii', top_k=1)
+    with pytest.raises(ValueError):
+        sparsify_dconn('a.dconn.nii', 'b.npz')
@@ -0,0 +1,48 @@
+''' Test cli/dlabel_to_nifti.py '''
+import numpy
+import pytest
+
+from citrix.cli.dlabel_to_nifti import splat_labels
+
+
+def test_splat_single_vertex():
+    ''' A vertex labels the 8 voxels around it '''
+    flat, labels = splat_labels([[2.3, 2.3, 2.3]], [7], (5, 5, 5))
+
+    assert(len(flat) == 8)
+    numpy.testing.assert_equal(labels, 7)
+
+
+def test_splat_collisions():
+    ''' Colliding labels are resolved by majority or by nearest vertex '''
+    voxels = [[2.1, 2.1, 2.1], [2.2, 2.2, 2.2], [2.45, 2.45, 2.45]]
+    labels = [1, 1, 2]
+    shape = (5, 5, 5)
+    center = numpy.ravel_multi_index((2, 2, 2), shape)
+
+    flat, voxel_labels = splat_labels(voxels, labels, shape, 'majority')
+    assert(voxel_labels[flat == center] == 1)
+
+    flat, voxel_labels = splat_labels(voxels, labels, shape, 'nearest')
+    assert(voxel_labels[flat == center] == 1)
+
+    voxels[2] = [2.02, 2.02, 2.02]
+    flat, voxel_labels = splat_labels(voxels, labels, shape, 'nearest')
+    assert(voxel_labels[flat == center] == 2)
+
+
+@pytest.mark.parametrize('collision', ['majority', 'nearest'])
+def test_splat_nearest_vertex_second(collision):
+    ''' Ties go to the vertex nearest to the voxel, wherever it comes '''
+    voxels = [[2.1, 2.1, 2.1], [1.4, 1.4, 1.4]]
+    shape = (6, 6, 6)
+    voxel = numpy.ravel_multi_index((1, 1, 1), shape)
+
+    flat, voxel_labels = splat_labels(voxels, [1, 2], shape, collision)
+    assert(voxel_labels[flat == voxel] == 2)
+
+
+def test_splat_outside_volume():
+    ''' Voxels outside of the volume are dropped '''
+    flat, labels = splat_labels([[0.2, 0.2, 0.2]], [3], (5, 5, 5))
+    numpy.testing.assert_equal(flat, [0])
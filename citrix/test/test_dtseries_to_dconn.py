@@ -0,0 +1,38 @@
+''' Test cli/dtseries_to_dconn.py '''
+import numpy
+
+import citrix
+from citrix import structures
+from citrix.build import cifti as build_cifti
+from citrix.cli.dtseries_to_dconn import dtseries_to_dconn
+
+
+def write_dtseries(filename, data):
+    n_vertices = data.shape[1]
+    model = build_cifti.surface_model(structures.CORTEX_LEFT,
+                                      range(n_vertices), n_vertices)
+    build_cifti.dtseries(data, [model]).to_filename(filename)
+
+
+def test_dconn_is_correlation(tmp_path):
+    ''' Tiled correlations match numpy's, whatever the tiling '''
+    data = numpy.random.RandomState(0).rand(20, 11).astype(numpy.float32)
+    data[:, 3] = 1  # constant time series have no correlation
+    dtseries = str(tmp_path / 'a.dtseries.nii')
+    write_dtseries(dtseries, data)
+
+    with numpy.errstate(invalid='ignore'):
+        expected = numpy.corrcoef(data.T)
+    expected[3] = expected[:, 3] = 0
+
+    dconn = str(tmp_path / 'a.dconn.nii')
+    dtseries_to_dconn(dtseries, dconn, tile_size=4, n_jobs=2)
+    result = citrix.load(dconn)
+    assert(isinstance(result, citrix.cifti.DenseDenseConnectivity))
+    numpy.testing.assert_allclose(result.dataobj, expected, atol=1e-5)
+    assert(len(result.grayordinates("ROW")) == 11)
+
+    dconn = str(tmp_path / 'b.dconn.nii.gz')
+    dtseries_to_dconn(dtseries, dconn, fisher_z=True)
+    numpy.testing.assert_allclose(
+        numpy.tanh(citrix.load(dconn).dataobj), expected, atol=1e-5)
@@ -0,0 +1,72 @@
+''' Test cli/dtseries_to_nifti.py '''
+import nibabel
+import numpy
+import pytest
+
+import citrix
+from citrix import structures
+from citrix.build import cifti as build_cifti
+from citrix.cli.dtseries_to_nifti import dtseries_to_nifti
+
+SURFACE = './citrix/test/data/very_inflated.surf.gii'
+SHAPE = (10, 21, 15)
+AFFINE = numpy.array([[8., 0, 0, -70], [0, 8, 0, -100], [0, 0, 8, -48],
+                      [0, 0, 0, 1]])
+THALAMUS = 'CIFTI_STRUCTURE_THALAMUS_LEFT'
+
+
+def write_dtseries(filename, vertices, voxels, n_frames=5):
+    n_vertices = len(citrix.load(SURFACE).vertices)
+    brain_models = [
+        build_cifti.surface_model(structures.CORTEX_LEFT, vertices, n_vertices),
+        build_cifti.voxel_model(THALAMUS, voxels, len(vertices))]
+    data = numpy.random.RandomState(0).rand(n_frames, len(vertices) +
+                                            len(voxels))
+    data = data.astype(numpy.float32)
+    build_cifti.dtseries(data, brain_models, volume_shape=SHAPE,
+                         affine=AFFINE).to_filename(filename)
+    return data
+
+
+def in_memory(data, vertices, voxels):
+    ''' The whole volume filled at once, as dtseries_to_nifti used to '''
+    surface = citrix.load(SURFACE)
+    projected = nibabel.affines.apply_affine(numpy.linalg.inv(AFFINE),
+                                             surface.vertices[vertices])
+    ijk = numpy.r_[numpy.floor(projected).astype(int), voxels]
+    volume = numpy.zeros(SHAPE + (data.shape[0],), dtype=numpy.float32)
+    volume[tuple(ijk.T)] = data.T
+    return volume
+
+
+@pytest.mark.parametrize('name, frames_per_block', [
+    ('a.nii', None), ('a.nii', 2), ('a.nii.gz', 2)])
+def test_dtseries_to_nifti(tmp_path, name, frames_per_block):
+    ''' The 4D volume written by blocks matches the one built in memory '''
+    vertices = numpy.arange(0, 32492, 50)
+    voxels = [[1, 2, 3], [4, 5, 6], [9, 20, 14]]
+    dtseries = str(tmp_path / 'a.dtseries.nii')
+    data = write_dtseries(dtseries, vertices, voxels)
+
+    out = str(tmp_path / name)
+    dtseries_to_nifti(dtseries, out, [SURFACE], frames_per_block)
+    result = nibabel.load(out)
+    assert(result.shape == SHAPE + (5,))
+    numpy.testing.assert_allclose(result.affine, AFFINE)
+    numpy.testing.assert_array_equal(result.get_fdata(dtype=numpy.float32),
+                                     in_memory(data, vertices, voxels))
+
+
+def test_outside_grayordinates_warn(tmp_path):
+    ''' Grayordinates outside of the volume are dropped with a warning '''
+    vertices = numpy.arange(0, 32492, 500)
+    voxels = [[1, 2, 3], [10, 0, 0], [0, 21, 0]]
+    dtseries = str(tmp_path / 'a.dtseries.nii')
+    data = write_dtseries(dtseries, vertices, voxels, n_frames=2)
+
+    out = str(tmp_path / 'a.nii')
+    with pytest.warns(UserWarning, match='2 grayordinates'):
+        dtseries_to_nifti(dtseries, out, [SURFACE])
+    expected = in_memory(data[:, :len(vertices) + 1], vertices, voxels[:1])
+    numpy.testing.assert_array_equal(
+        nibabel.load(out).get_fdata(dtype=numpy.float32), expected)
@@ -0,0 +1,60 @@
+''' Test gifti.py '''
+import numpy
+
+import citrix
+from citrix import gifti, structures
+
+SURFACE = './citrix/test/data/very_inflated.surf.gii'
+
+
+def test_brain_structure():
+    ''' The structure comes from the GIFTI metadata '''
+    surface = citrix.load(SURFACE)
+    assert(surface.brain_structure == structures.CORTEX_LEFT)
+
+
+def test_read_brain_structure():
+    ''' The structure is read from the header of the file '''
+    assert(gifti.read_brain_structure(SURFACE) == structures.CORTEX_LEFT)
+
+
+def test_cifti_structure():
+    assert(gifti.cifti_structure('CortexRight') == structures.CORTEX_RIGHT)
+    assert(gifti.cifti_structure('Cerebellum') == structures.CEREBELLUM)
+    assert(gifti.cifti_structure('NotAStructure') is None)
+
+
+def test_adjacency():
+    ''' The sparse adjacency matches a loop over the triangles '''
+    surface = citrix.load(SURFACE)
+    triangles = surface.triangles
+    n_vertices = len(surface.vertices)
+
+    edges = set()
+    for a, b, c in triangles:
+        edges |= {(a, b), (b, a), (b, c), (c, b), (a, c), (c, a)}
+
+    adjacency = surface.adjacency.tocoo()
+    assert(set(zip(adjacency.row, adjacency.col)) == edges)
+    assert(surface.adjacency is surface.adjacency)
+    assert(set(surface.neighbors(0)) == {b for a, b in edges if a == 0})
+
+    ring = surface.k_ring(0, 2)
+    expected = {0} | set(surface.neighbors(0))
+    expected |= {b for a, b in edges if a in expected}
+    assert(set(ring) == expected)
+    assert(len(surface.k_ring(0, n_vertices)) <= n_vertices)
+
+
+def test_submesh():
+    ''' Submeshes keep the triangles within the vertices, renumbered '''
+    surface = citrix.load(SURFACE)
+    vertices = numpy.arange(0, len(surface.vertices), 2)
+    submesh = surface.submesh(vertices)
+
+    numpy.testing.assert_array_equal(submesh.vertices,
+                                     surface.vertices[vertices])
+    kept = numpy.all(numpy.isin(surface.triangles, vertices), axis=1)
+    numpy.testing.assert_array_equal(vertices[submesh.triangles],
+                                     surface.triangles[kept])
+    assert(submesh.brain_structure == structures.CORTEX_LEFT)
@@ -0,0 +1,45 @@
+''' Test grayordinates.py '''
+import numpy
+
+import citrix
+from citrix import structures
+
+DCONN = './citrix/test/data/merge3.dconn.nii'
+
+
+def test_index_is_cached():
+    dconn = citrix.load(DCONN)
+    assert(dconn.grayordinates('ROW') is dconn.grayordinates('ROW'))
+
+
+def test_structure_slices():
+    index = citrix.load(DCONN).grayordinates('ROW')
+
+    assert(index.structure_slice(structures.CORTEX_LEFT) == slice(0, 50))
+    assert(index.structure_slice(structures.BRAIN_STEM) == slice(150, 155))
+    assert(len(index) == 155)
+
+
+def test_vertex_rows():
+    index = citrix.load(DCONN).grayordinates('ROW')
+    vertices = index.vertices(structures.CORTEX_LEFT)
+
+    rows = index.vertex_rows(structures.CORTEX_LEFT, vertices)
+    numpy.testing.assert_equal(rows, numpy.arange(50))
+
+    missing = numpy.setdiff1d(numpy.arange(vertices.max()), vertices)[:3]
+    rows = index.vertex_rows(structures.CORTEX_LEFT, missing)
+    numpy.testing.assert_equal(rows, -1)
+
+
+def test_voxel_rows():
+    index = citrix.load(DCONN).grayordinates('ROW')
+    voxels = index.voxels(structures.BRAIN_STEM)
+
+    numpy.testing.assert_equal(index.voxel_rows(voxels), numpy.arange(150, 155))
+    numpy.testing.assert_equal(index.voxel_rows([[0, 0, 0], [-1, 0, 0]]), -1)
+
+    numpy.testing.assert_equal(index.row_structures([0, 60, 152]),
+                               [structures.CORTEX_LEFT,
+                                structures.CORTEX_RIGHT,
+                                structures.BRAIN_STEM])
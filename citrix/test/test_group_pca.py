@@ -0,0 +1,147 @@
+''' Test cli/group_pca.py '''
+import gzip
+
+import numpy
+import pytest
+
+import citrix
+from citrix import parallel_gzip, preprocessing
+from citrix.build import cifti as build_cifti
+from citrix.cli.group_pca import group_pca, reduce_subject
+
+LEFT = 'CIFTI_STRUCTURE_CORTEX_LEFT'
+
+
+def write_dtseries(filename, data, vertices=None):
+    if vertices is None:
+        vertices = range(data.shape[1])
+    build_cifti.dtseries(data, [build_cifti.surface_model(LEFT, vertices, 40)]
+                         ).to_filename(filename)
+
+
+def exact_maps(subjects, n_components):
+    ''' Spatial components of the concatenated z-scored subjects '''
+    zscore = preprocessing.normalize('zscore')
+    data = numpy.concatenate([zscore(s.astype(numpy.float64))
+                              for s in subjects])
+    _, s, vt = numpy.linalg.svd(data, full_matrices=False)
+    maps = s[:n_components, None] * vt[:n_components]
+    largest = numpy.abs(maps).argmax(axis=1)
+    signs = numpy.sign(maps[numpy.arange(n_components), largest])
+    return maps * signs[:, None]
+
+
+def write_subjects(tmp_path, subjects, vertices=None):
+    filenames = []
+    for i, data in enumerate(subjects):
+        filenames.append(str(tmp_path / '{}.dtseries.nii'.format(i)))
+        write_dtseries(filenames[-1], data,
+                       None if vertices is None else vertices[i])
+    return filenames
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_group_pca_is_exact_without_truncation(tmp_path, n_jobs):
+    ''' With a dimension larger than the rank of the data, MIGP gives the
+        PCA of the concatenated subjects '''
+    random = numpy.random.RandomState(0)
+    subjects = [random.randn(n, 25).astype(numpy.float32)
+                for n in (8, 10, 12, 9)]
+    filenames = write_subjects(tmp_path, subjects)
+
+    out = str(tmp_path / 'group.dscalar.nii')
+    group_pca(filenames, out, n_components=3, dimension=25, n_jobs=n_jobs)
+
+    maps = citrix.load(out)
+    assert maps.shape == (3, 25)
+    assert [m.map_name for m in maps.row] == ['component 1', 'component 2',
+                                              'component 3']
+    numpy.testing.assert_array_equal(
+        maps.grayordinates("COLUMN").vertices(LEFT), numpy.arange(25))
+    numpy.testing.assert_allclose(numpy.asarray(maps.dataobj),
+                                  exact_maps(subjects, 3), atol=1e-4)
+
+
+def test_group_pca_recovers_low_rank_maps(tmp_path):
+    ''' A small dimension is enough to recover strong components '''
+    random = numpy.random.RandomState(0)
+    spatial = random.randn(3, 30) * [[10], [6], [3]]
+    subjects = [(random.randn(40, 3) @ spatial
+                 + random.randn(40, 30) * .1).astype(numpy.float32)
+                for _ in range(5)]
+    filenames = write_subjects(tmp_path, subjects)
+
+    out = str(tmp_path / 'group.dscalar.nii.gz')
+    group_pca(filenames, out, n_components=3, dimension=4, n_jobs=2)
+
+    result = numpy.asarray(citrix.load(out).dataobj)
+    expected = exact_maps(subjects, 3)
+    for found, reference in zip(result, expected):
+        assert numpy.corrcoef(found, reference)[0, 1] > .999
+
+
+def test_group_pca_common_grayordinates(tmp_path):
+    ''' Only the grayordinates shared by all subjects are decomposed '''
+    random = numpy.random.RandomState(0)
+    subjects = [random.randn(10, 20).astype(numpy.float32),
+                random.randn(12, 15).astype(numpy.float32)]
+    vertices = [list(range(20)), list(range(30, 4, -2)) + [1, 0]]
+    filenames = write_subjects(tmp_path, subjects, vertices)
+
+    out = str(tmp_path / 'group.dscalar.nii')
+    group_pca(filenames, out, n_components=2, dimension=22)
+
+    common = [0, 1] + list(range(6, 20, 2))
+    maps = citrix.load(out)
+    numpy.testing.assert_array_equal(
+        maps.grayordinates("COLUMN").vertices(LEFT), common)
+    second = [vertices[1].index(v) for v in common]
+    expected = exact_maps([subjects[0][:, common], subjects[1][:, second]], 2)
+    numpy.testing.assert_allclose(numpy.asarray(maps.dataobj), expected,
+                                  atol=1e-4)
+
+
+@pytest.mark.parametrize('keep_bytes, readers', [(2 ** 20, 1), (0, 2)])
+def test_reduce_subject_reads(tmp_path, monkeypatch, keep_bytes, readers):
+    ''' Gathered columns of a gzip file without an index are read in one
+        pass, or two if the subject is not kept in memory '''
+    data = numpy.random.RandomState(0).randn(6, 30).astype(numpy.float32)
+    filename = str(tmp_path / 'a.dtseries.nii')
+    write_dtseries(filename, data)
+    with open(filename, 'rb') as f:
+        compressed = gzip.compress(f.read())
+    with open(filename + '.gz', 'wb') as f:
+        f.write(compressed)
+
+    opened = []
+
+    class Reader(parallel_gzip.GzipReader):
+        def __init__(self, filename, n_threads=None):
+            opened.append(filename)
+            super().__init__(filename, n_threads)
+
+    monkeypatch.setattr(parallel_gzip, 'GzipReader', Reader)
+    dtseries = citrix.load(filename + '.gz')
+    opened.clear()
+
+    columns = numpy.array([25, 3, 4, 17, 2, 9, 28])
+    reduced = reduce_subject(dtseries, 6, columns, normalize=None,
+                             block_bytes=8 * 6 * 4, keep_bytes=keep_bytes)
+    assert(len(opened) == readers)
+
+    _, s, vt = numpy.linalg.svd(data[:, columns].astype(numpy.float64),
+                                full_matrices=False)
+    expected = s[:, None] * vt
+    numpy.testing.assert_allclose(numpy.abs(reduced), numpy.abs(expected),
+                                  atol=1e-4)
+
+
+def test_group_pca_checks(tmp_path):
+    filenames = write_subjects(tmp_path, [numpy.ones((3, 5),
+                                                     dtype=numpy.float32)])
+    with pytest.raises(ValueError):
+        group_pca(filenames, str(tmp_path / 'a.dtseries.nii'), 2)
+    with pytest.raises(ValueError):
+        group_pca(filenames, str(tmp_path / 'a.dscalar.nii'), 3, dimension=2)
+    with pytest.raises(ValueError):
+        group_pca(filenames, str(tmp_path / 'a.dscalar.nii'), 4)
@@ -1,3 +1,6 @@
+import os
+import subprocess
+import sys
 import unittest
 
 import citrix
@@ -14,3 +17,23 @@ class TestLoad(unittest.TestCase):
 
         cifti = citrix.load('./citrix/test/data/merge3.dconn.nii')
         self.assertEqual(type(cifti), citrix.cifti.DenseDenseConnectivity)
+
+
+class TestImport(unittest.TestCase):
+
+    def test_lazy_submodules(self):
+        ''' Importing citrix does not import its dependencies, they are
+            imported on first access to the submodules '''
+        code = ('import sys, citrix; '
+                'assert "nibabel" not in sys.modules; '
+                'assert "scipy" not in sys.modules; '
+                'citrix.cifti.DenseTimeSeries; '
+                'assert "nibabel" in sys.modules; '
+                'assert "utils" in dir(citrix)')
+        subprocess.check_call([sys.executable, '-c', code],
+                              cwd=os.path.dirname(os.path.dirname(
+                                  os.path.dirname(os.path.abspath(__file__)))))
+
+    def test_unknown_attribute(self):
+        with self.assertRaises(AttributeError):
+            citrix.not_a_submodule
@@ -0,0 +1,49 @@
+''' Test intersection.py '''
+import numpy
+import nibabel
+from nibabel.cifti2 import cifti2_axes
+
+from citrix import cifti, intersection, structures
+
+
+def scalar_cifti(vertices, voxels):
+    mask = numpy.zeros((4, 4, 4), dtype=bool)
+    mask[tuple(numpy.transpose(voxels))] = True
+    brain_models = (
+        cifti2_axes.BrainModelAxis.from_surface(vertices, 20, 'CortexLeft') +
+        cifti2_axes.BrainModelAxis.from_mask(mask, 'ThalamusLeft',
+                                             affine=numpy.eye(4))
+    )
+    data = numpy.arange(len(brain_models), dtype=numpy.float32)[None]
+    image = nibabel.Cifti2Image(data, (cifti2_axes.ScalarAxis(['s']),
+                                       brain_models))
+    return cifti.DenseScalar.from_nibabel(image)
+
+
+def test_intersect_brain_models():
+    ''' Common grayordinates keep the order of the first cifti '''
+    first = scalar_cifti([0, 2, 4, 6], [(0, 0, 0), (1, 1, 1)])
+    second = scalar_cifti([6, 5, 4, 3, 2], [(1, 1, 1), (2, 2, 2)])
+
+    brain_models, gathers = intersection.intersect_brain_models(
+        [first, second], 'COLUMN'
+    )
+
+    assert([bm.brain_structure for bm in brain_models] ==
+           [structures.CORTEX_LEFT, structures.THALAMUS_LEFT])
+    assert(list(brain_models[0].vertex_indices) == [2, 4, 6])
+    assert(brain_models[1].index_offset == 3)
+
+    numpy.testing.assert_equal(gathers[0], [1, 2, 3, 5])
+    numpy.testing.assert_equal(gathers[1], [4, 2, 0, 5])
+
+
+def test_intersect_headers():
+    ''' Only the brain models are intersected '''
+    first = scalar_cifti([0, 2, 4, 6], [(0, 0, 0), (1, 1, 1)])
+    second = scalar_cifti([6, 5, 4, 3, 2], [(1, 1, 1), (2, 2, 2)])
+
+    header, gathers = intersection.intersect_headers([first, second])
+
+    assert(list(gathers) == ['COLUMN'])
+    assert(header.matrix.get_data_shape() == (1, 4))
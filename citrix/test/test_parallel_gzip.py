@@ -0,0 +1,93 @@
+''' Test parallel_gzip.py '''
+import gzip
+import os
+import threading
+
+import nibabel
+import numpy
+import pytest
+
+import citrix
+from citrix import parallel_gzip
+
+
+@pytest.mark.parametrize('n_threads', [1, 3])
+def test_indexed_members(tmp_path, n_threads):
+    ''' Blocks are standard gzip members, read back at any position '''
+    data = numpy.random.RandomState(0).bytes(100000)
+    filename = str(tmp_path / 'a.gz')
+    with parallel_gzip.GzipWriter(filename, block_size=7000,
+                                  n_threads=n_threads) as writer:
+        writer.write(data[:10])
+        writer.write(data[10:])
+    assert(gzip.open(filename).read() == data)
+
+    reader = parallel_gzip.GzipReader(filename, n_threads)
+    assert(reader.indexed)
+    assert(reader.read() == data)
+    reader.seek(12345)
+    assert(reader.read(50000) == data[12345:62345])
+    reader.seek(5)
+    assert(reader.read(3) == data[5:8])
+    assert(reader.seek(0, 2) == len(data))
+
+
+def test_plain_gzip(tmp_path):
+    ''' Streams of other tools are read sequentially, members and
+        padding included '''
+    filename = str(tmp_path / 'a.gz')
+    with open(filename, 'wb') as f:
+        f.write(gzip.compress(b'abc') + gzip.compress(b'defg') + bytes(3))
+
+    reader = parallel_gzip.GzipReader(filename)
+    assert(not reader.indexed)
+    assert(reader.read() == b'abcdefg')
+    reader.seek(4)
+    assert(reader.read(2) == b'ef')
+    reader.seek(1)
+    assert(reader.read(2) == b'bc')
+
+    with open(filename, 'wb') as f:
+        f.write(gzip.compress(bytes(10000), 0)[:-100])
+    with pytest.raises(EOFError):
+        parallel_gzip.GzipReader(filename).read()
+
+
+@pytest.mark.parametrize('klass', [nibabel.Nifti1Image, nibabel.Nifti2Image])
+@pytest.mark.parametrize('endianness', ['<', '>'])
+def test_load_byte_orders(tmp_path, klass, endianness):
+    ''' NIFTI-1 and 2 files are told apart in both byte orders '''
+    data = numpy.arange(24, dtype=numpy.float32).reshape((2, 3, 4))
+    header = klass.header_class(endianness=endianness)
+    filename = str(tmp_path / 'a.nii.gz')
+    parallel_gzip.save(klass(data, numpy.eye(4), header), filename)
+
+    image = citrix.load(filename)
+    assert(type(image) is klass)
+    assert(image.header.endianness == endianness)
+    numpy.testing.assert_array_equal(image.get_fdata(), data)
+
+
+def test_load_closes_the_file(tmp_path):
+    ''' The reader only lives for the duration of each read '''
+    filename = str(tmp_path / 'a.nii.gz')
+    citrix.save(filename, numpy.ones((4, 4, 4), dtype=numpy.float32),
+                affine=numpy.eye(4))
+    files, threads = len(os.listdir('/proc/self/fd')), threading.active_count()
+    image = citrix.load(filename)
+    numpy.testing.assert_array_equal(image.dataobj[1], 1)
+    assert(len(os.listdir('/proc/self/fd')) == files)
+    assert(threading.active_count() == threads)
+
+
+def test_save_load(tmp_path):
+    data = numpy.random.RandomState(0).rand(5, 6, 7, 8).astype(numpy.float32)
+    filename = str(tmp_path / 'a.nii.gz')
+    citrix.save(filename, data, affine=numpy.eye(4), compresslevel=6,
+                block_size=1000)
+    numpy.testing.assert_array_equal(nibabel.load(filename).get_fdata(), data)
+
+    image = citrix.load(filename)
+    assert(isinstance(image.dataobj, parallel_gzip.GzipArrayProxy))
+    numpy.testing.assert_array_equal(image.dataobj[..., 3:5], data[..., 3:5])
+    numpy.testing.assert_array_equal(image.get_fdata(), data)
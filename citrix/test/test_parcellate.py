@@ -0,0 +1,88 @@
+''' Test parcellation.py and cli/parcellate.py '''
+import numpy
+
+import citrix
+from citrix import structures
+from citrix.build import cifti as build_cifti
+from citrix.cli.parcellate import parcellate
+
+N_VERTICES = 12
+LABELS = numpy.array([0, 1, 1, 2, 2, 2, 3, 3, 1, 0, 3, 2])
+
+
+def brain_model(vertices):
+    return build_cifti.surface_model(structures.CORTEX_LEFT, vertices,
+                                     N_VERTICES)
+
+
+def write_files(tmp_path, data, vertices):
+    table = build_cifti.label_table([0, 1, 2, 3], ['???', 'a', 'b', 'c'],
+                                    [[0, 0, 0, 0], [1, 0, 0, 1],
+                                     [0, 1, 0, 1], [0, 0, 1, 1]])
+    dlabel = build_cifti.dlabel(LABELS.astype(numpy.float32),
+                                [brain_model(range(N_VERTICES))], table)
+    dlabel.nifti_header.set_intent('NIFTI_INTENT_CONNECTIVITY_DENSE_LABELS')
+    dlabel.to_filename(str(tmp_path / 'a.dlabel.nii'))
+
+    build_cifti.dtseries(data, [brain_model(vertices)]).to_filename(
+        str(tmp_path / 'a.dtseries.nii'))
+    return str(tmp_path / 'a.dtseries.nii'), str(tmp_path / 'a.dlabel.nii')
+
+
+def test_parcellate(tmp_path):
+    ''' Parcels are reduced with each reducer, over the shared vertices '''
+    vertices = numpy.arange(1, N_VERTICES)  # vertex 0 is not in the dtseries
+    data = numpy.random.RandomState(0).rand(15, len(vertices))
+    dtseries, dlabel = write_files(tmp_path, data.astype(numpy.float32),
+                                   vertices)
+    data = data.astype(numpy.float32).astype(float)
+    labels = LABELS[vertices]
+
+    ptseries = str(tmp_path / 'a.ptseries.nii')
+    for reducer, function in [('mean', numpy.mean), ('median', numpy.median)]:
+        parcellate(dtseries, dlabel, ptseries, reducer, frames_per_block=4)
+        result = citrix.load(ptseries)
+        expected = numpy.stack([function(data[:, labels == k], axis=1)
+                                for k in [1, 2, 3]], axis=1)
+        numpy.testing.assert_allclose(result.dataobj, expected, rtol=1e-5)
+
+    parcels = list(result.column.parcels)
+    assert([p.name for p in parcels] == ['a', 'b', 'c'])
+    assert(list(parcels[0].vertices[0]) == [1, 2, 8])
+
+    parcellate(dtseries, dlabel, ptseries, 'pc1', frames_per_block=4)
+    result = numpy.asarray(citrix.load(ptseries).dataobj)
+    for i, k in enumerate([1, 2, 3]):
+        members = data[:, labels == k]
+        centered = members - members.mean(axis=0)
+        u, s, _ = numpy.linalg.svd(centered, full_matrices=False)
+        numpy.testing.assert_allclose(numpy.abs(result[:, i]),
+                                      numpy.abs(u[:, 0] * s[0]), rtol=1e-4)
+
+
+def test_parcellate_few_frames(tmp_path):
+    ''' Parcels with more members than frames give the same components '''
+    vertices = numpy.arange(N_VERTICES)
+    data = numpy.random.RandomState(1).rand(3, N_VERTICES)
+    data[1, 4] = numpy.nan  # in parcel 2
+    dtseries, dlabel = write_files(tmp_path, data.astype(numpy.float32),
+                                   vertices)
+    data = data.astype(numpy.float32).astype(float)
+
+    ptseries = str(tmp_path / 'a.ptseries.nii')
+    parcellate(dtseries, dlabel, ptseries, 'median', frames_per_block=2)
+    expected = numpy.stack([numpy.median(data[:, LABELS == k], axis=1)
+                            for k in [1, 2, 3]], axis=1)
+    numpy.testing.assert_allclose(citrix.load(ptseries).dataobj, expected,
+                                  rtol=1e-6)
+
+    data[1, 4] = 0
+    write_files(tmp_path, data.astype(numpy.float32), vertices)
+    parcellate(dtseries, dlabel, ptseries, 'pc1', frames_per_block=2)
+    result = numpy.asarray(citrix.load(ptseries).dataobj)
+    for i, k in enumerate([1, 2, 3]):
+        members = data[:, LABELS == k]
+        centered = members - members.mean(axis=0)
+        u, s, _ = numpy.linalg.svd(centered, full_matrices=False)
+        numpy.testing.assert_allclose(numpy.abs(result[:, i]),
+                                      numpy.abs(u[:, 0] * s[0]), rtol=1e-4)
@@ -0,0 +1,124 @@
+''' Test preprocessing.py and cli/preprocess.py '''
+import gzip
+
+import numpy
+import pytest
+from scipy import signal
+
+import citrix
+from citrix import parallel_gzip, preprocessing, structures
+from citrix.build import cifti as build_cifti
+from citrix.cli.preprocess import preprocess
+
+
+def write_dtseries(filename, data, tr=.8):
+    n_vertices = data.shape[1]
+    model = build_cifti.surface_model(structures.CORTEX_LEFT,
+                                      range(n_vertices), n_vertices)
+    build_cifti.dtseries(data, [model], step=tr).to_filename(filename)
+
+
+def test_stages():
+    ''' Each stage matches its direct numpy/scipy computation '''
+    random = numpy.random.RandomState(0)
+    frames = numpy.arange(50.)
+    data = random.randn(50, 6) + numpy.outer(frames, random.rand(6)) + 3
+    data[:, 2] = 5
+
+    detrended = preprocessing.detrend(1)(data)
+    numpy.testing.assert_allclose(detrended, signal.detrend(data, axis=0),
+                                  atol=1e-10)
+
+    confounds = random.randn(50, 2)
+    residuals = preprocessing.regress(confounds)(data)
+    numpy.testing.assert_allclose(confounds.T @ residuals, 0, atol=1e-10)
+
+    zscores = preprocessing.normalize('zscore')(data)
+    numpy.testing.assert_allclose(zscores.mean(axis=0), 0, atol=1e-12)
+    numpy.testing.assert_allclose(zscores.std(axis=0), [1, 1, 0, 1, 1, 1])
+
+    # constant up to rounding errors, e.g. after resampling
+    data[:, 2] = 5 + numpy.spacing(5.) * random.randint(-2, 3, 50)
+    zscores = preprocessing.normalize('zscore')(data)
+    numpy.testing.assert_array_equal(zscores[:, 2], 0)
+
+    sos = signal.butter(2, [.01, .1], 'bandpass', fs=1 / .8, output='sos')
+    numpy.testing.assert_allclose(
+        preprocessing.bandpass(.01, .1, .8)(data),
+        signal.sosfiltfilt(sos, data, axis=0))
+
+
+def test_stage_errors():
+    with pytest.raises(ValueError):
+        preprocessing.bandpass(None, None, .8)
+    with pytest.raises(ValueError):
+        preprocessing.bandpass(None, 1, .8)  # above Nyquist
+    with pytest.raises(ValueError):
+        preprocessing.normalize('median')
+    with pytest.raises(ValueError):
+        preprocessing.regress(numpy.ones((10, 1)))(numpy.ones((12, 3)))
+
+
+@pytest.mark.parametrize('columns_per_block, n_jobs', [
+    (None, 1), (1, 1), (3, 2), (4, 3)])
+def test_preprocess(tmp_path, columns_per_block, n_jobs):
+    ''' The blocks and the threads do not change the result, which is the
+        pipeline applied to the whole matrix '''
+    random = numpy.random.RandomState(0)
+    data = random.randn(60, 11).astype(numpy.float32)
+    confounds = random.randn(60, 2)
+    dtseries = str(tmp_path / 'a.dtseries.nii')
+    write_dtseries(dtseries, data)
+
+    out = str(tmp_path / 'b.dtseries.nii')
+    preprocess(dtseries, out, detrend=2, low=.01, high=.2,
+               confounds=confounds, normalize='zscore', n_jobs=n_jobs,
+               columns_per_block=columns_per_block)
+
+    stages = [preprocessing.detrend(2), preprocessing.bandpass(.01, .2, .8)]
+    filtered_confounds = preprocessing.Pipeline(stages)(confounds)
+    expected = preprocessing.Pipeline(
+        stages + [preprocessing.regress(filtered_confounds),
+                  preprocessing.normalize('zscore')])(data)
+
+    result = citrix.load(out)
+    assert result.header.to_xml() == citrix.load(dtseries).header.to_xml()
+    numpy.testing.assert_allclose(numpy.asarray(result.dataobj), expected,
+                                  rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_preprocess_compressed(tmp_path, monkeypatch, n_jobs):
+    ''' The blocks of a gzip input without an index are read from a single
+        open file, whatever the threads '''
+    data = numpy.random.RandomState(0).randn(30, 7).astype(numpy.float32)
+    dtseries = str(tmp_path / 'a.dtseries.nii')
+    write_dtseries(dtseries, data)
+    with open(dtseries, 'rb') as f:
+        compressed = gzip.compress(f.read())
+    with open(dtseries + '.gz', 'wb') as f:
+        f.write(compressed)
+
+    opened = []
+
+    class Reader(parallel_gzip.GzipReader):
+        def __init__(self, filename, n_threads=None):
+            opened.append(filename)
+            super().__init__(filename, n_threads)
+
+    monkeypatch.setattr(parallel_gzip, 'GzipReader', Reader)
+    out = str(tmp_path / 'b.dtseries.nii.gz')
+    preprocess(dtseries + '.gz', out, detrend=0, normalize='demean',
+               n_jobs=n_jobs, columns_per_block=2)
+    # one reader for the header, one for the data
+    assert(opened == [dtseries + '.gz'] * 2)
+    numpy.testing.assert_allclose(numpy.asarray(citrix.load(out).dataobj),
+                                  data - data.mean(axis=0), atol=1e-6)
+
+
+def test_preprocess_wrong_confounds(tmp_path):
+    dtseries = str(tmp_path / 'a.dtseries.nii')
+    write_dtseries(dtseries, numpy.ones((30, 4), dtype=numpy.float32))
+    with pytest.raises(ValueError):
+        preprocess(dtseries, str(tmp_path / 'b.dtseries.nii'),
+                   confounds=numpy.ones((20, 1)))
@@ -0,0 +1,115 @@
+''' Test profiling.py '''
+from concurrent.futures import ThreadPoolExecutor
+import json
+
+import numpy
+
+import citrix
+from citrix import profiling
+
+
+def test_disabled():
+    ''' Nothing is recorded, nor stays active, without a profiler '''
+    with profiling.stage('outer'):
+        pass
+    assert(profiling._stack() == [])
+
+    profiler = profiling.Profiler()
+    with profiling.stage('outer'):
+        pass
+    assert(profiler.records == [])
+
+
+def test_nested_stages():
+    records = []
+
+    @profiling.profiled('function')
+    def function():
+        with profiling.stage('inner'):
+            return numpy.ones(1000).sum()
+
+    with profiling.Profiler(callback=records.append) as profiler:
+        with profiling.stage('outer'):
+            assert(function() == 1000)
+
+    assert([r['stage'] for r in profiler.records] ==
+           ['outer/function/inner', 'outer/function', 'outer'])
+    assert(records == profiler.records)
+
+    inner, middle, outer = profiler.records
+    assert(inner['seconds'] <= middle['seconds'] <= outer['seconds'])
+    # the peak of a stage covers the peaks of the stages it contains
+    assert(inner['peak_rss_bytes'] <= outer['peak_rss_bytes'])
+    assert(not outer['failed'])
+
+
+def test_iterate():
+    ''' Producing each item is measured, not what is done with it '''
+    def produce():
+        for i in range(3):
+            yield i
+
+    with profiling.Profiler() as profiler:
+        with profiling.stage('outer'):
+            for i in profiling.iterate('read', produce()):
+                with profiling.stage('write'):
+                    pass
+
+    stages = [r['stage'] for r in profiler.records]
+    assert(stages.count('outer/read') == 4)  # the last one ends the loop
+    assert(stages.count('outer/write') == 3)
+    assert(stages[-1] == 'outer')
+
+
+def test_threads():
+    ''' Each thread nests its own stages '''
+    def work():
+        with profiling.stage('thread'):
+            pass
+
+    with profiling.Profiler() as profiler:
+        with profiling.stage('main'):
+            with ThreadPoolExecutor(2) as pool:
+                list(pool.map(lambda _: work(), range(4)))
+            assert([s.name for s in profiling._stack()] == ['main'])
+
+    stages = [r['stage'] for r in profiler.records]
+    assert(stages == ['thread'] * 4 + ['main'])
+
+
+def test_failed_stage():
+    profiler = profiling.Profiler()
+    try:
+        with profiler, profiling.stage('failing'):
+            raise ValueError()
+    except ValueError:
+        pass
+    assert(profiler.records[0]['failed'])
+    assert(profiling._stack() == [] and profiling._profilers == [])
+
+
+def test_profile_to(tmp_path):
+    ''' citrix.save and citrix.load are recorded in the JSON file '''
+    filename = str(tmp_path / 'a.nii')
+    output = str(tmp_path / 'profile.json')
+    with profiling.profile_to(output):
+        citrix.save(filename, numpy.zeros((2, 3, 4)), affine=numpy.eye(4))
+        citrix.load(filename)
+
+    with open(output) as f:
+        profile = json.load(f)
+    stages = [r['stage'] for r in profile['stages']]
+    assert(stages == ['citrix.save', 'citrix.load'])
+    assert(set(profile['totals']) == set(stages))
+
+    with profiling.profile_to(None) as profiler:
+        assert(profiler is None)
+
+
+def test_peak_rss():
+    ''' The peak follows allocations, and can be reset where supported '''
+    if profiling.reset_peak_rss():
+        baseline = profiling.peak_rss()
+        numpy.ones(2 ** 24).sum()  # 128 MB
+        assert(profiling.peak_rss() - baseline >= 2 ** 26)
+    assert(profiling.peak_rss() > 0)
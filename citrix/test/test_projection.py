@@ -0,0 +1,57 @@
+''' Test projection.py '''
+import os
+
+import numpy
+
+import citrix
+from citrix import projection
+
+SURFACE = './citrix/test/data/very_inflated.surf.gii'
+
+
+def test_vertex_voxels():
+    ''' Flat indices are column-major, -1 outside of the volume '''
+    vertices = numpy.array([[1.5, 2.5, 0.5], [10, 0, 0]])
+    flat, distances = projection.vertex_voxels(vertices, numpy.eye(4),
+                                               (4, 4, 4), 'floor')
+
+    numpy.testing.assert_equal(flat[:, 0], [1 + 2 * 4, -1])
+    numpy.testing.assert_allclose(distances[0], numpy.sqrt(3) / 2)
+
+
+def test_neighbor_distances():
+    ''' Distances go from the vertex to each of its 8 voxels '''
+    vertices = numpy.array([[2.1, 2.1, 2.1]])
+    flat, distances = projection.vertex_voxels(vertices, numpy.eye(4),
+                                               (6, 6, 6), 'neighbors')
+
+    voxels = numpy.transpose(numpy.unravel_index(flat[0], (6, 6, 6),
+                                                 order='F'))
+    numpy.testing.assert_allclose(distances[0],
+                                  numpy.linalg.norm(voxels - vertices,
+                                                    axis=1), rtol=1e-6)
+
+
+def test_cache(tmp_path):
+    ''' Maps are stored on disk and reused '''
+    surface = citrix.load(SURFACE)
+    affine = numpy.diag([2, 2, 2, 1])
+    affine[:3, 3] = -100
+    shape = (100, 100, 100)
+
+    cache = projection.ProjectionCache(str(tmp_path))
+    first = cache.get(surface, affine, shape, 'neighbors')
+    assert(len(os.listdir(str(tmp_path))) == 1)
+
+    second = projection.ProjectionCache(str(tmp_path)).get(surface, affine,
+                                                            shape, 'neighbors')
+    numpy.testing.assert_equal(first.flat, second.flat)
+    assert(first.flat.shape == (len(surface.vertices), 8))
+
+
+def test_cache_eviction(tmp_path):
+    ''' The cache does not grow past its size '''
+    surface = citrix.load(SURFACE)
+    cache = projection.ProjectionCache(str(tmp_path), max_bytes=1)
+    cache.get(surface, numpy.eye(4), (10, 10, 10))
+    assert(os.listdir(str(tmp_path)) == [])
@@ -0,0 +1,77 @@
+''' Test resampling.py '''
+import os
+
+import numpy
+
+import citrix
+from citrix import resampling, structures
+from citrix.build import cifti as build_cifti
+from citrix.build import gifti as build_gifti
+
+SURFACE = './citrix/test/data/very_inflated.surf.gii'
+
+
+def shifted(surface, seed=0):
+    ''' Target mesh: the source with its vertices moved a bit '''
+    noise = numpy.random.RandomState(seed).normal(0, .1, surface.vertices.shape)
+    return build_gifti.mesh(surface.vertices[::3] + noise[::3],
+                            numpy.zeros((0, 3), dtype=int),
+                            structures.CORTEX_LEFT)
+
+
+def test_barycentric_weights():
+    ''' Barycentric weights reproduce linear functions of the coordinates '''
+    source = citrix.load(SURFACE)
+    target = shifted(source)
+    matrix = resampling.resampling_matrix(source, target)
+
+    numpy.testing.assert_allclose(matrix.sum(axis=1), 1)
+    assert(matrix.getnnz(axis=1).max() <= 3)
+
+    # on a smooth mesh, interpolating the coordinates gives back points
+    # close to the target vertices
+    interpolated = matrix @ source.vertices
+    error = numpy.linalg.norm(interpolated - target.vertices, axis=1)
+    nearest = resampling.resampling_matrix(source, target, 'nearest')
+    nearest_error = numpy.linalg.norm(nearest @ source.vertices -
+                                      target.vertices, axis=1)
+    assert(numpy.median(error) < numpy.median(nearest_error))
+
+
+def test_resampler_cache(tmp_path):
+    ''' Weights are stored once and loaded afterwards '''
+    source = citrix.load(SURFACE)
+    target = shifted(source)
+    first = resampling.Resampler(source, target, cache_dir=str(tmp_path))
+    assert(len(os.listdir(str(tmp_path))) == 1)
+    second = resampling.Resampler(source, target, cache_dir=str(tmp_path))
+    assert((first.matrix != second.matrix).nnz == 0)
+
+    function = build_gifti.function(source.vertices[:, 0],
+                                    structures.CORTEX_LEFT)
+    resampled = first.resample_function(function)
+    numpy.testing.assert_allclose(resampled.function_data,
+                                  first.apply(source.vertices[:, 0]),
+                                  rtol=1e-5)
+
+
+def test_resample_cifti():
+    ''' Cortex slices are resampled without the missing vertices '''
+    source = citrix.load(SURFACE)
+    n_vertices = len(source.vertices)
+    target = shifted(source)
+    resampler = resampling.Resampler(source, target, 'nearest')
+
+    vertices = numpy.arange(0, n_vertices, 2)
+    data = numpy.ones((1, len(vertices)), dtype=numpy.float32)
+    model = build_cifti.surface_model(structures.CORTEX_LEFT, vertices,
+                                      n_vertices)
+    dscalar = citrix.cifti.DenseScalar.from_nibabel(
+        build_cifti.dscalar(data, [model], ['a']))
+
+    image = resampling.resample_cifti(dscalar, {structures.CORTEX_LEFT: resampler})
+    assert(image.shape == (1, len(target.vertices)))
+    # target vertices closest to a missing source vertex get 0
+    values = numpy.asarray(image.dataobj)[0]
+    assert(set(numpy.unique(values)) <= {0, 1})
+    assert(values.sum() > 0)
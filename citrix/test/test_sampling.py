@@ -0,0 +1,65 @@
+''' Test sampling.py and cli/nifti_to_dense.py '''
+import nibabel
+import numpy
+
+import citrix
+from citrix import sampling, structures
+from citrix.build import cifti as build_cifti
+from citrix.build import gifti as build_gifti
+from citrix.cli.nifti_to_dense import nifti_to_dense
+
+SHAPE = (6, 5, 4)
+AFFINE = numpy.diag([2., 2., 2., 1.])
+
+
+def linear_volume(n_frames):
+    i, j, k = numpy.meshgrid(*[numpy.arange(s) for s in SHAPE], indexing='ij')
+    return numpy.stack([i + 2 * j + 3 * k + t for t in range(n_frames)],
+                       axis=-1).astype(numpy.float32)
+
+
+def test_sampling_matrix():
+    ''' Trilinear sampling is exact on linear volumes '''
+    volume = linear_volume(1)[..., 0]
+    voxels = numpy.random.RandomState(0).uniform(0, 3, (20, 3))
+    points = nibabel.affines.apply_affine(AFFINE, voxels)
+
+    weights = sampling.sampling_matrix(points, AFFINE, SHAPE)
+    values = weights @ volume.ravel(order='F')
+    numpy.testing.assert_allclose(values, voxels @ [1, 2, 3], rtol=1e-6)
+
+    weights = sampling.sampling_matrix(points, AFFINE, SHAPE, 'nearest')
+    values = weights @ volume.ravel(order='F')
+    numpy.testing.assert_allclose(values, numpy.round(voxels) @ [1, 2, 3])
+
+    outside = sampling.sampling_matrix([[-10, -10, -10]], AFFINE, SHAPE)
+    assert(outside.nnz == 0)
+
+
+def test_nifti_to_dense(tmp_path):
+    ''' Frames are sampled at the vertices and at the voxels '''
+    nifti = str(tmp_path / 'a.nii')
+    nibabel.Nifti1Image(linear_volume(7), AFFINE).to_filename(nifti)
+
+    vertices = numpy.array([[1., 1., 1.], [3., 4., 2.], [5., 2., 4.5]])
+    triangles = numpy.array([[0, 1, 2]])
+    surface = str(tmp_path / 'a.surf.gii')
+    build_gifti.mesh(vertices, triangles, structures.CORTEX_LEFT).save(surface)
+
+    voxels = [[0, 0, 0], [1, 2, 3]]
+    brain_models = [
+        build_cifti.surface_model(structures.CORTEX_LEFT, [0, 1, 2], 3),
+        build_cifti.voxel_model('CIFTI_STRUCTURE_THALAMUS_LEFT', voxels, 3)]
+    template = str(tmp_path / 'template.dscalar.nii')
+    build_cifti.dscalar(numpy.zeros((1, 5), dtype=numpy.float32),
+                        brain_models, ['a'], SHAPE, AFFINE
+                        ).to_filename(template)
+
+    dtseries = str(tmp_path / 'a.dtseries.nii')
+    nifti_to_dense(nifti, template, dtseries, [surface], frames_per_block=3)
+    result = citrix.load(dtseries)
+    assert(isinstance(result, citrix.cifti.DenseTimeSeries))
+
+    positions = numpy.r_[vertices / 2, voxels]
+    expected = (positions @ [1, 2, 3])[None] + numpy.arange(7)[:, None]
+    numpy.testing.assert_allclose(result.dataobj, expected, rtol=1e-5)
@@ -0,0 +1,63 @@
+''' Test smoothing.py and cli/smooth.py '''
+import numpy
+
+import citrix
+from citrix import smoothing, structures
+from citrix.build import cifti as build_cifti
+from citrix.cli.smooth import smooth
+
+SURFACE = './citrix/test/data/very_inflated.surf.gii'
+
+
+def test_surface_kernel():
+    ''' Kernels are local averages, and fwhm 0 leaves data untouched '''
+    surface = citrix.load(SURFACE)
+    kernel = surface.gaussian_kernel(4.)
+    assert(kernel is surface.gaussian_kernel(4.))
+    numpy.testing.assert_allclose(kernel.sum(axis=1), 1)
+
+    neighbors = set(surface.k_ring(0, 100))
+    assert(set(kernel[0].indices) <= neighbors)
+
+    identity = smoothing.surface_kernel(surface.vertices, surface.adjacency, 0)
+    assert((identity != smoothing.sparse.identity(len(surface.vertices))).nnz == 0)
+
+
+def test_volume_kernel():
+    ''' Voxels are smoothed with their neighbors within the truncation '''
+    voxels = numpy.array([[0, 0, 0], [1, 0, 0], [10, 0, 0]])
+    kernel = smoothing.volume_kernel(voxels, numpy.eye(4), 2.).toarray()
+    numpy.testing.assert_allclose(kernel.sum(axis=1), 1)
+    assert(kernel[0, 1] > 0 and kernel[0, 2] == 0)
+    assert(kernel[2, 2] == 1)
+
+
+def test_smooth(tmp_path):
+    ''' Surface and volume grayordinates are smoothed apart '''
+    surface = citrix.load(SURFACE)
+    n_vertices = len(surface.vertices)
+    vertices = numpy.arange(100, n_vertices)
+    voxels = [[i, j, 0] for i in range(3) for j in range(3)]
+
+    brain_models = [
+        build_cifti.surface_model(structures.CORTEX_LEFT, vertices, n_vertices),
+        build_cifti.voxel_model('CIFTI_STRUCTURE_THALAMUS_LEFT', voxels,
+                                len(vertices))]
+
+    data = numpy.zeros((2, len(vertices) + len(voxels)), dtype=numpy.float32)
+    data[0, len(vertices):] = 1
+    data[1] = numpy.random.RandomState(0).rand(data.shape[1])
+    dscalar = str(tmp_path / 'a.dscalar.nii')
+    build_cifti.dscalar(data, brain_models, ['a', 'b'], (3, 3, 1)
+                        ).to_filename(dscalar)
+
+    out = str(tmp_path / 'b.dscalar.nii')
+    smooth(dscalar, out, 4., [SURFACE], frames_per_block=1)
+    smoothed = numpy.asarray(citrix.load(out).dataobj)
+
+    numpy.testing.assert_allclose(smoothed[0], data[0], atol=1e-6)
+    assert(smoothed[1].std() < data[1].std())
+
+    kernel = surface.submesh(vertices).gaussian_kernel(4.)
+    numpy.testing.assert_allclose(smoothed[1, :len(vertices)],
+                                  kernel @ data[1, :len(vertices)], rtol=1e-5)
@@ -0,0 +1,68 @@
+''' Test stream.py and the streaming builders '''
+import nibabel
+import numpy
+
+from citrix import stream, structures
+from citrix.build import cifti as build_cifti
+from citrix.cifti import Parcel, Vertices
+
+
+def surface_model(n_vertices):
+    return build_cifti.surface_model(structures.CORTEX_LEFT, range(n_vertices),
+                                     n_vertices)
+
+
+def test_write_pdconn_by_rows(tmp_path):
+    ''' Row blocks from a generator or a memmap give the same file '''
+    n_vertices, n_parcels = 10, 3
+    data = numpy.random.rand(n_vertices, n_parcels).astype(numpy.float32)
+    parcels = [Parcel('p{}'.format(i), vertices=[
+        Vertices('CIFTI_STRUCTURE_CORTEX_LEFT', [i])]) for i in range(n_parcels)]
+
+    def rows():
+        for start in range(0, n_vertices, 4):
+            yield data[start:start + 4]
+
+    for name in ['a.pdconn.nii', 'b.pdconn.nii.gz']:
+        filename = str(tmp_path / name)
+        build_cifti.write_pdconn(filename, rows(), parcels,
+                                 [surface_model(n_vertices)])
+        # nibabel reads compressed ciftis as plain 6D NIFTI-2 images
+        image = nibabel.load(filename)
+        numpy.testing.assert_array_equal(
+            image.get_fdata().reshape(data.shape), data)
+        header = getattr(image, 'nifti_header', image.header)
+        assert(header.get_intent()[0] == 'ConnParcelDense')
+
+    numpy.save(str(tmp_path / 'data.npy'), data)
+    source = numpy.load(str(tmp_path / 'data.npy'), mmap_mode='r')
+    filename = str(tmp_path / 'c.pdconn.nii')
+    build_cifti.write_pdconn(filename, source, parcels,
+                             [surface_model(n_vertices)])
+    numpy.testing.assert_array_equal(nibabel.load(filename).get_fdata(), data)
+
+
+def test_write_dlabel_by_blocks(tmp_path):
+    ''' Labels are written by blocks of grayordinates '''
+    labels = numpy.arange(10) % 3
+    table = build_cifti.label_table([0, 1, 2], ['a', 'b', 'c'],
+                                    [[0, 0, 0, 0], [1, 0, 0, 1], [0, 1, 0, 1]])
+    filename = str(tmp_path / 'a.dlabel.nii')
+    build_cifti.write_dlabel(filename, (labels[i:i + 3] for i in range(0, 10, 3)),
+                             [surface_model(10)], table)
+    numpy.testing.assert_array_equal(nibabel.load(filename).get_fdata(),
+                                     labels[None])
+
+
+def test_row_writer_checks_rows(tmp_path):
+    ''' Writing too many or too few rows fails '''
+    image = nibabel.Nifti2Image(stream.empty((4, 2)), numpy.eye(4))
+    filename = str(tmp_path / 'a.nii')
+
+    with stream.RowWriter(filename, image) as writer:
+        writer.write(numpy.ones((4, 2)))
+        numpy.testing.assert_raises(ValueError, writer.write, numpy.ones((1, 2)))
+
+    writer = stream.RowWriter(filename, image)
+    writer.write(numpy.ones((3, 2)))
+    numpy.testing.assert_raises(ValueError, writer.close)
@@ -0,0 +1,16 @@
+''' Test utils.py '''
+from citrix import utils
+
+
+def test_probe_header():
+    ''' The CIFTI extension is found without parsing the file '''
+    intent, codes = utils.probe_header('./citrix/test/data/merge3.dconn.nii')
+    assert(codes == [utils.CIFTI_EXTENSION_CODE])
+
+    intent, codes = utils.probe_header('./citrix/test/data/test.nii')
+    assert(codes == [])
+
+
+def test_is_cifti():
+    assert(utils.is_cifti('./citrix/test/data/merge3.dconn.nii'))
+    assert(not utils.is_cifti('./citrix/test/data/test.nii'))
@@ -1,15 +1,70 @@
-import nibabel
+import struct
+
+from nibabel.openers import ImageOpener
+
+CIFTI_EXTENSION_CODE = 32
+
+# sizeof_hdr: (struct format of vox_offset, its position,
+#              struct format of intent_code, its position)
+NIFTI_HEADER_LAYOUTS = {348: ('f', 108, 'h', 68),
+                        540: ('q', 168, 'i', 504)}
+
+
+def probe_header(filename):
+    """Reads the NIFTI-1/2 header of a file and the table of its extensions.
+
+       Only the first bytes of the file are read: the content of the
+       extensions (e.g. the CIFTI XML) is skipped and the data block is
+       never touched.
+
+       Returns
+       -------
+       intent_code: int
+           NIFTI intent code of the file
+       extension_codes: list
+           codes of the extensions present in the file"""
+    with ImageOpener(filename, 'rb') as fileobj:
+        raw = fileobj.read(4)
+        for endianness in '<>':
+            sizeof_hdr = struct.unpack(endianness + 'i', raw)[0]
+            if sizeof_hdr in NIFTI_HEADER_LAYOUTS:
+                break
+        else:
+            raise ValueError('{} is not a NIFTI file'.format(filename))
+
+        offset_fmt, offset_pos, intent_fmt, intent_pos = \
+            NIFTI_HEADER_LAYOUTS[sizeof_hdr]
+        header = raw + fileobj.read(sizeof_hdr - 4)
+        vox_offset = int(struct.unpack_from(endianness + offset_fmt,
+                                            header, offset_pos)[0])
+        intent_code = struct.unpack_from(endianness + intent_fmt,
+                                         header, intent_pos)[0]
+
+        extension_codes = []
+        flag = fileobj.read(4)
+        if len(flag) < 4 or flag[0] == 0:
+            return intent_code, extension_codes
+
+        position = sizeof_hdr + 4
+        while vox_offset == 0 or position + 8 <= vox_offset:
+            raw = fileobj.read(8)
+            if len(raw) < 8:
+                break
+            esize, ecode = struct.unpack(endianness + 'ii', raw)
+            if esize < 8:
+                break
+            extension_codes.append(ecode)
+            position += esize
+            fileobj.seek(position)
+
+    return intent_code, extension_codes
+
 
 def is_cifti(filename):
     """Checks if the file is a cifti file"""
     # check it has a cifti header
-    header = nibabel.load(filename).header
-
-    if isinstance(header, nibabel.Cifti2Header):
-        return True
-
-    codes = [e.get_code() for e in header.extensions]
-    return 32 in codes
+    _, codes = probe_header(filename)
+    return CIFTI_EXTENSION_CODE in codes
 
 def retrieve_direction(cifti, direction):
     """Returns either the row or column of the cifti matrix"""
@@ -17,12 +72,12 @@ def retrieve_direction(cifti, direction):
         raise ValueError("direction should be ROW or COLUMN")
 
     if direction == "ROW":
-        return cifti.header.row
-    return cifti.header.column
+        return cifti.row
+    return cifti.column
 
 def brain_models_from_direction(cifti, direction):
     """Returns the brain models of a given direction"""
-    return retrieve_direction(cifti, direction).brain_models
+    return cifti.grayordinates(direction).brain_models
 
 def volume_from_direction(cifti, direction):
     """Returns the volume information of a given direction"""
@@ -19,5 +19,13 @@ setup(name=package_name,
       include_package_data=True,
       packages=[package_name, cli_module, build_module],# utils_module],
       scripts=['scripts/ctrx_dtseries_to_nifti', 
-               'scripts/ctrx_dlabel_to_nifti'],
+               'scripts/ctrx_dlabel_to_nifti',
+               'scripts/ctrx_cifti_average',
+               'scripts/ctrx_dtseries_to_dconn',
+               'scripts/ctrx_parcellate',
+               'scripts/ctrx_smooth',
+               'scripts/ctrx_nifti_to_dense',
+               'scripts/ctrx_sparsify_dconn',
+               'scripts/ctrx_preprocess',
+               'scripts/ctrx_group_pca'],
       zip_safe=False)